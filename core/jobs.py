@@ -0,0 +1,96 @@
+import itertools
+from dataclasses import dataclass, field
+from typing import FrozenSet, List, Optional
+
+QUEUED = "Queued"
+RUNNING = "Running"
+DONE = "Done"
+FAILED = "Failed"
+CANCELLED = "Cancelled"
+
+_job_ids = itertools.count(1)
+
+
+@dataclass
+class ImagingJob:
+    source: str
+    target: str
+    size: int
+    devices: FrozenSet[str]  # whole disks the source lives on
+    options: dict
+    id: int = field(default_factory=lambda: next(_job_ids))
+    state: str = QUEUED
+    progress: int = 0
+    message: str = ""
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, FAILED, CANCELLED)
+
+
+class JobScheduler:
+    """Orders imaging jobs so that no two run on the same physical device
+
+    Jobs on different disks run concurrently (up to max_parallel); jobs
+    sharing a spindle or NVMe namespace run one after another in the order
+    they were queued, since concurrent streams would only make the device
+    seek between them.
+    """
+
+    def __init__(self, max_parallel: Optional[int] = None):
+        self.max_parallel = max_parallel
+        self.jobs: List[ImagingJob] = []
+        self.cancelled = False
+
+    def add(self, job: ImagingJob) -> ImagingJob:
+        self.jobs.append(job)
+        return job
+
+    @property
+    def running(self) -> List[ImagingJob]:
+        return [job for job in self.jobs if job.state == RUNNING]
+
+    @property
+    def queued(self) -> List[ImagingJob]:
+        return [job for job in self.jobs if job.state == QUEUED]
+
+    @property
+    def finished(self) -> bool:
+        return all(job.finished for job in self.jobs)
+
+    def start_ready(self) -> List[ImagingJob]:
+        """Mark and return the queued jobs that can start now"""
+        if self.cancelled:
+            return []
+        running = self.running
+        busy = set().union(*(job.devices for job in running))
+        started = []
+        for job in self.queued:
+            if self.max_parallel and len(running) + len(started) >= self.max_parallel:
+                break
+            if not job.devices & busy:
+                job.state = RUNNING
+                started.append(job)
+            # A waiting job keeps its devices reserved, so later jobs cannot overtake it
+            busy |= job.devices
+        return started
+
+    def finish(self, job: ImagingJob, success: bool, message: str):
+        if job.state == RUNNING:
+            job.state = DONE if success else CANCELLED if self.cancelled else FAILED
+        job.message = message
+        if success:
+            job.progress = 100
+
+    def cancel(self):
+        """Drop the queued jobs; running jobs finish as cancelled"""
+        self.cancelled = True
+        for job in self.queued:
+            job.state = CANCELLED
+
+    def overall_progress(self) -> int:
+        """Size-weighted progress of all jobs"""
+        total = sum(job.size for job in self.jobs)
+        if not total:
+            return 0
+        return int(sum(job.size * (100 if job.finished else job.progress) for job in self.jobs) / total)
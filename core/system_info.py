@@ -1,6 +1,6 @@
 import json
 import subprocess
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 
 import psutil
 
@@ -32,6 +32,34 @@ class SystemInfoCollector:
 
         return drives
 
+    @staticmethod
+    def get_device_roots() -> Dict[str, Set[str]]:
+        """Map every block device to the whole disks (or NVMe namespaces) it lives on, following lsblk PKNAME links"""
+        parents: Dict[str, Set[str]] = {}
+        try:
+            # In list mode a device with several parents (md, dm) appears once per parent
+            cmd = ["lsblk", "-J", "-l", "-o", "NAME,PKNAME"]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode == 0:
+                for device in json.loads(result.stdout).get("blockdevices", []):
+                    links = parents.setdefault(f"/dev/{device['name']}", set())
+                    if device.get("pkname"):
+                        links.add(f"/dev/{device['pkname']}")
+        except Exception as e:
+            print(f"Error getting device topology: {e}")
+
+        roots: Dict[str, Set[str]] = {}
+
+        def resolve(device: str, seen: Set[str]) -> Set[str]:
+            if device not in roots:
+                links = parents.get(device, set()) - seen
+                roots[device] = set().union(*(resolve(parent, seen | {device}) for parent in links)) if links else {device}
+            return roots[device]
+
+        for device in parents:
+            resolve(device, set())
+        return roots
+
     @staticmethod
     def get_device_size_with_sudo(device_path: str, sudo_password: str = None) -> int:
         """Gets device size using blockdev command, with sudo if needed"""
@@ -1,12 +1,45 @@
 import logging
 
+_SIZE_MULTIPLIERS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
 
 def parse_size(size_str: str) -> int:
-    return 0
+    """Convert dd-style size string (e.g. 4M, 512K, 1G, 4096) to bytes"""
+    if not size_str:
+        return 0
+
+    size_str = str(size_str).strip().upper()
+    if size_str.endswith('IB'):
+        size_str = size_str[:-2]
+    elif size_str.endswith('B') and len(size_str) > 1 and size_str[-2] in _SIZE_MULTIPLIERS:
+        size_str = size_str[:-1]
+
+    multiplier = 1
+    if size_str and size_str[-1] in _SIZE_MULTIPLIERS:
+        multiplier = _SIZE_MULTIPLIERS[size_str[-1]]
+        size_str = size_str[:-1]
+
+    try:
+        return int(float(size_str) * multiplier)
+    except ValueError:
+        return 0
 
 
 def format_size(size_bytes: int) -> str:
-    return "0 B"
+    """Format byte count as human readable string"""
+    size = float(size_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds: float) -> str:
+    """Format seconds as H:MM:SS (or M:SS below an hour)"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
 
 
 def setup_logging(level=logging.INFO):
@@ -0,0 +1,153 @@
+# dd_core/compression.py
+
+import bz2
+import lzma
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from dd_core.engine import ParallelChunkStage, Stage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ChunkedCompressStage(ParallelChunkStage):
+    """Splits the stream into fixed-size chunks compressed on a thread pool
+
+    Chunks are compressed independently and emitted in input order, so the
+    output is a concatenation of self-contained compressed frames.
+    """
+
+    name = "compress"
+    kind = "compress"
+
+    def __init__(self, level: int, threads: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.level = level
+        super().__init__(threads, chunk_size)
+
+    def compress_chunk(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def transform_chunk(self, index: int, data: bytes, final: bool) -> bytes:
+        return self.compress_chunk(data)
+
+
+@dataclass
+class Codec:
+    """Compression codec description used by the registry"""
+    name: str
+    suffix: str
+    compress: Callable[[bytes, int], bytes]
+    decompressor: Callable[[], object]  # single-frame object with decompress(), eof and unused_data
+    default_level: int
+    min_level: int
+    max_level: int
+
+
+def _gzip_compress(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zstd_compress(data: bytes, level: int) -> bytes:
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _lz4_compress(data: bytes, level: int) -> bytes:
+    return lz4.frame.compress(data, compression_level=level)
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(Codec("gzip", ".gz", _gzip_compress, lambda: zlib.decompressobj(31), 6, 1, 9))
+register_codec(Codec("xz", ".xz", lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor, 6, 0, 9))
+register_codec(Codec("bz2", ".bz2", lambda data, level: bz2.compress(data, level), bz2.BZ2Decompressor, 9, 1, 9))
+if zstandard is not None:
+    register_codec(Codec("zstd", ".zst", _zstd_compress, lambda: zstandard.ZstdDecompressor().decompressobj(), 3, 1, 22))
+if lz4 is not None:
+    register_codec(Codec("lz4", ".lz4", _lz4_compress, lz4.frame.LZ4FrameDecompressor, 0, 0, 16))
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported compression codec: {name}") from None
+
+
+def codec_for_suffix(suffix: str) -> Optional[Codec]:
+    return next((codec for codec in CODECS.values() if codec.suffix == suffix), None)
+
+
+class DecompressStage(Stage):
+    """Decompresses a stream of concatenated frames of one codec"""
+
+    kind = "compress"
+
+    def __init__(self, codec_name: str):
+        self.codec = get_codec(codec_name)
+        self.name = f"{self.codec.name}-decompress"
+        self.decompressor = self.codec.decompressor()
+        self.in_frame = False
+
+    def process(self, data: memoryview) -> List:
+        output = []
+        data = bytes(data)
+        while data:
+            chunk = self.decompressor.decompress(data)
+            self.in_frame = True
+            if chunk:
+                output.append(chunk)
+            if not self.decompressor.eof:
+                break
+            # Frame finished: start the next one on the remaining input
+            data = self.decompressor.unused_data
+            self.decompressor = self.codec.decompressor()
+            self.in_frame = False
+        return output
+
+    def flush(self) -> List:
+        if self.in_frame and not self.decompressor.eof:
+            raise ValueError(f"Truncated {self.codec.name} stream")
+        return []
+
+
+class CodecStage(ChunkedCompressStage):
+    """Parallel compression with a registered codec
+
+    Every chunk becomes a complete frame (a gzip member, an xz/bz2/zstd/lz4
+    stream), and all of these formats accept concatenated frames, so the
+    output opens with the codec's standard command line tool.
+    """
+
+    def __init__(self, codec_name: str = "gzip", level: Optional[int] = None, threads: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.codec = get_codec(codec_name)
+        self.name = self.codec.name
+        self.suffix = self.codec.suffix
+        if level is None:
+            level = self.codec.default_level
+        level = min(self.codec.max_level, max(self.codec.min_level, level))
+        super().__init__(level, threads, chunk_size)
+
+    def describe(self) -> dict:
+        return dict(super().describe(), level=self.level, chunk_size=self.chunk_size)
+
+    def compress_chunk(self, data: bytes) -> bytes:
+        # The codecs release the GIL while compressing, so frames compress concurrently
+        return self.codec.compress(data, self.level)
@@ -0,0 +1,249 @@
+# dd_core/crypto.py
+
+"""
+Chunked authenticated encryption container (HCENC).
+
+Layout (all integers big-endian):
+
+    header (40 bytes)
+        magic        8s   b"HCLONENC"
+        version      B    1
+        cipher       B    1 = AES-256-GCM, 2 = ChaCha20-Poly1305
+        kdf          B    1 = PBKDF2-HMAC-SHA256
+        reserved     B    0
+        iterations   I    KDF iteration count
+        chunk_size   I    plaintext bytes per chunk
+        salt         16s  KDF salt
+        nonce_prefix 4s   random per image
+
+    records, one per chunk
+        length       I    ciphertext length (plaintext + 16 byte tag)
+        ciphertext   ...
+
+The key is derived once per image. Chunk i is sealed with the nonce
+nonce_prefix || u64(i) and the associated data header || u64(i) || final,
+where final is 1 only for the last chunk. Reordered, spliced or truncated
+images therefore fail authentication. Every chunk but the last holds exactly
+chunk_size plaintext bytes, so record i starts at
+HEADER_SIZE + i * (4 + chunk_size + 16) and can be decrypted on its own.
+"""
+
+import base64
+import hashlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from dd_core.engine import DeviceSource, ParallelChunkStage
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = None
+
+MAGIC = b"HCLONENC"
+FORMAT_VERSION = 1
+HEADER_FORMAT = ">8sBBBBII16s4s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_PREFIX = struct.Struct(">I")
+TAG_SIZE = 16
+KDF_PBKDF2_SHA256 = 1
+DEFAULT_ITERATIONS = 600000
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+CIPHERS = {
+    "aes-256-gcm": 1,
+    "chacha20-poly1305": 2,
+}
+
+
+class EncryptionError(Exception):
+    """Raised for unsupported, corrupted or unauthenticated containers"""
+
+
+def aead_available() -> bool:
+    return AESGCM is not None
+
+
+def _make_aead(cipher_id: int, key: bytes):
+    if not aead_available():
+        raise EncryptionError("Python 'cryptography' package is required for authenticated encryption")
+    if cipher_id == CIPHERS["aes-256-gcm"]:
+        return AESGCM(key)
+    if cipher_id == CIPHERS["chacha20-poly1305"]:
+        return ChaCha20Poly1305(key)
+    raise EncryptionError(f"Unsupported cipher id: {cipher_id}")
+
+
+class ChunkCipher:
+    """Per-image key and nonce schedule shared by encryption and decryption"""
+
+    def __init__(self, header: bytes, password: str):
+        if len(header) != HEADER_SIZE:
+            raise EncryptionError("Truncated encryption header")
+        magic, version, cipher_id, kdf, _, iterations, chunk_size, salt, nonce_prefix = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise EncryptionError("Not an encrypted HardClone image")
+        if version != FORMAT_VERSION or kdf != KDF_PBKDF2_SHA256:
+            raise EncryptionError(f"Unsupported encryption format version {version} / kdf {kdf}")
+
+        self.header = header
+        self.cipher_id = cipher_id
+        self.chunk_size = chunk_size
+        self.nonce_prefix = nonce_prefix
+        key = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations, 32)
+        self.aead = _make_aead(cipher_id, key)
+        # Lets a resumed image check the password without decrypting anything
+        self.key_check = hashlib.blake2b(key, digest_size=16, person=b"HCENC key check").hexdigest()
+
+    @classmethod
+    def create(cls, password: str, cipher: str = "aes-256-gcm", iterations: int = DEFAULT_ITERATIONS,
+               chunk_size: int = DEFAULT_CHUNK_SIZE) -> "ChunkCipher":
+        if cipher not in CIPHERS:
+            raise EncryptionError(f"Unsupported cipher: {cipher}")
+        header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, CIPHERS[cipher], KDF_PBKDF2_SHA256, 0, iterations, chunk_size,
+                             os.urandom(16), os.urandom(4))
+        return cls(header, password)
+
+    @property
+    def record_size(self) -> int:
+        return RECORD_PREFIX.size + self.chunk_size + TAG_SIZE
+
+    def _nonce(self, index: int) -> bytes:
+        return self.nonce_prefix + struct.pack(">Q", index)
+
+    def _aad(self, index: int, final: bool) -> bytes:
+        return self.header + struct.pack(">QB", index, 1 if final else 0)
+
+    def seal(self, index: int, data: bytes, final: bool) -> bytes:
+        ciphertext = self.aead.encrypt(self._nonce(index), data, self._aad(index, final))
+        return RECORD_PREFIX.pack(len(ciphertext)) + ciphertext
+
+    def open(self, index: int, ciphertext: bytes, final: bool) -> bytes:
+        try:
+            return self.aead.decrypt(self._nonce(index), ciphertext, self._aad(index, final))
+        except Exception:
+            raise EncryptionError(f"Authentication failed for chunk {index} (wrong password or corrupted image)") from None
+
+
+class AEADEncryptStage(ParallelChunkStage):
+    """Encrypts independent chunks with AES-GCM or ChaCha20-Poly1305 on a thread pool"""
+
+    name = "aead"
+    kind = "encrypt"
+    suffix = ".enc"
+
+    def __init__(self, password: str, cipher: str = "aes-256-gcm", threads: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, iterations: int = DEFAULT_ITERATIONS):
+        self.cipher_name = cipher
+        self.iterations = iterations
+        self.chunk_cipher = ChunkCipher.create(password, cipher, iterations, chunk_size)
+        self.password = password
+        self.header_sent = False
+        super().__init__(threads, chunk_size)
+
+    def describe(self) -> dict:
+        return dict(super().describe(), cipher=self.cipher_name, kdf="pbkdf2-sha256", iterations=self.iterations,
+                    chunk_size=self.chunk_size, format="hcenc1")
+
+    def transform_chunk(self, index: int, data: bytes, final: bool) -> bytes:
+        return self.chunk_cipher.seal(index, data, final)
+
+    def _with_header(self, output):
+        if not self.header_sent:
+            self.header_sent = True
+            return [self.chunk_cipher.header] + output
+        return output
+
+    def process(self, data: memoryview):
+        return self._with_header(super().process(data))
+
+    def flush(self):
+        return self._with_header(super().flush())
+
+    def state(self) -> dict:
+        # The header holds the salt and nonce prefix, not the key
+        return dict(super().state(), header=base64.b64encode(self.chunk_cipher.header).decode(), header_sent=self.header_sent,
+                    key_check=self.chunk_cipher.key_check)
+
+    def resume(self, state: dict):
+        super().resume(state)
+        self.chunk_cipher = ChunkCipher(base64.b64decode(state["header"]), self.password)
+        if self.chunk_cipher.key_check != state["key_check"]:
+            raise EncryptionError("Wrong password for the interrupted image")
+        self.header_sent = state["header_sent"]
+
+
+class EncryptedImageReader:
+    """Random-access and parallel decryption of an HCENC container
+
+    image is a path or an engine Source providing read(offset, length) and
+    size (e.g. a split image).
+    """
+
+    def __init__(self, image, password: str):
+        self.source = DeviceSource(image) if isinstance(image, str) else image
+        self.cipher = ChunkCipher(self.source.read(0, HEADER_SIZE), password)
+        self.file_size = self.source.size
+        body = self.file_size - HEADER_SIZE
+        self.chunk_count = max(1, -(-body // self.cipher.record_size))
+        last = body - (self.chunk_count - 1) * self.cipher.record_size
+        self.size = (self.chunk_count - 1) * self.chunk_size + max(0, last - RECORD_PREFIX.size - TAG_SIZE)
+        self._cached = (-1, b"")
+
+    @property
+    def chunk_size(self) -> int:
+        return self.cipher.chunk_size
+
+    def read_record(self, index: int) -> bytes:
+        offset = HEADER_SIZE + index * self.cipher.record_size
+        prefix = self.source.read(offset, RECORD_PREFIX.size)
+        if len(prefix) != RECORD_PREFIX.size:
+            raise EncryptionError(f"Truncated record {index}")
+        (length,) = RECORD_PREFIX.unpack(prefix)
+        ciphertext = self.source.read(offset + RECORD_PREFIX.size, length)
+        if len(ciphertext) != length:
+            raise EncryptionError(f"Truncated record {index}")
+        return ciphertext
+
+    def read_chunk(self, index: int) -> bytes:
+        """Decrypt chunk index without touching the rest of the image"""
+        if not 0 <= index < self.chunk_count:
+            raise IndexError(index)
+        return self.cipher.open(index, self.read_record(index), index == self.chunk_count - 1)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Plaintext bytes at offset, so the reader can stand in for a Source"""
+        length = max(0, min(length, self.size - offset))
+        parts = []
+        while length:
+            index, start = divmod(offset, self.chunk_size)
+            cached_index, chunk = self._cached
+            if cached_index != index:
+                chunk = self.read_chunk(index)
+                self._cached = (index, chunk)
+            data = chunk[start:start + length]
+            parts.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b"".join(parts)
+
+    def iter_chunks(self, threads: Optional[int] = None, start: int = 0) -> Iterator[bytes]:
+        """Decrypt chunks in order, several at a time on a thread pool"""
+        threads = max(1, threads or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            index = start
+            while index < self.chunk_count:
+                batch = range(index, min(self.chunk_count, index + threads * 2))
+                yield from executor.map(self.read_chunk, batch)
+                index = batch.stop
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,423 @@
+# dd_core/dedup.py
+
+"""
+Deduplicating image repository.
+
+Repository directory layout:
+
+    repository.json     chunking parameters and chunk codec, fixed at creation
+    index.sqlite        sha256 digest -> pack, offset, stored length, size
+    packs/NNNNNN.pack   chunk records: digest (32s), stored length (I), data
+    repository.lock     held while an image is being added
+
+An image stored in a repository becomes a recipe file (<target>.recipe):
+
+    magic "HCRECIP1", path length (I), repository path (UTF-8),
+    chunk count (Q), then one (sha256 digest 32s, size I) entry per chunk
+
+Chunk boundaries are content defined. Every byte is reduced to one
+fingerprint bit through a fixed random table, and a chunk ends right after
+the first occurrence of a fixed bit pattern (searched with bytes.find, so
+chunking runs at C speed). As in FastCDC's normalized chunking, a longer
+pattern applies below the average chunk size and a shorter one above it,
+within hard minimum and maximum sizes. A boundary depends only on the
+bytes just before it, so data shifted by an insertion still produces the
+same chunks.
+"""
+
+import bisect
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from dd_core.compression import CODECS, get_codec
+from dd_core.engine import EngineError, Sink, Source, ZeroRun, default_threads
+
+REPOSITORY_VERSION = 1
+RECIPE_MAGIC = b"HCRECIP1"
+RECIPE_SUFFIX = ".recipe"
+RECIPE_ENTRY = struct.Struct(">32sI")
+PACK_RECORD = struct.Struct(">32sI")
+PACK_SIZE = 1024 * 1024 * 1024
+DEFAULT_MIN_CHUNK = 16 * 1024
+DEFAULT_AVG_CHUNK = 64 * 1024
+DEFAULT_MAX_CHUNK = 256 * 1024
+_LOOKUP_BATCH = 500
+_ZEROS = bytes(4 * 1024 * 1024)
+
+
+class RepositoryError(EngineError):
+    """Raised for missing, locked or inconsistent repositories"""
+
+
+def recipe_path(target_file: str) -> str:
+    return target_file + RECIPE_SUFFIX
+
+
+def is_recipe(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(RECIPE_MAGIC)) == RECIPE_MAGIC
+    except OSError:
+        return False
+
+
+def _fingerprint_table() -> bytes:
+    """Fixed byte -> fingerprint bit table, half of the byte values map to 1"""
+    order = sorted(range(256), key=lambda b: hashlib.sha256(b"hardclone-cdc" + bytes([b])).digest())
+    table = bytearray(256)
+    for b in order[:128]:
+        table[b] = 1
+    return bytes(table)
+
+
+def _pattern(length: int) -> bytes:
+    """Fixed fingerprint pattern; never constant, so long zero runs never match"""
+    digest = hashlib.sha256(b"hardclone-cdc-pattern").digest()
+    bits = bytes((digest[i // 8] >> (i % 8)) & 1 for i in range(length))
+    return b"\x01\x00" + bits[2:]
+
+
+_TABLE = _fingerprint_table()
+
+
+class ContentChunker:
+    """Splits a byte stream into content-defined chunks"""
+
+    def __init__(self, min_size: int = DEFAULT_MIN_CHUNK, avg_size: int = DEFAULT_AVG_CHUNK, max_size: int = DEFAULT_MAX_CHUNK):
+        bits = max(8, avg_size.bit_length() - 1)
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.strict = _pattern(bits + 2)
+        self.loose = _pattern(bits - 2)
+        if min_size < len(self.strict) or not min_size <= avg_size <= max_size:
+            raise ValueError("Invalid chunk size bounds")
+        self.pending = bytearray()
+        # Fingerprinting runs over several maximum-size chunks at a time
+        self.round_size = max_size * 16
+
+    def _cut(self, fingerprint: bytes, start: int) -> int:
+        index = fingerprint.find(self.strict, start + self.min_size - len(self.strict), start + self.avg_size)
+        if index >= 0:
+            return index + len(self.strict)
+        index = fingerprint.find(self.loose, start + self.avg_size - len(self.loose), start + self.max_size)
+        if index >= 0:
+            return index + len(self.loose)
+        return start + self.max_size
+
+    def _split(self, final: bool) -> List[bytes]:
+        fingerprint = self.pending.translate(_TABLE)
+        chunks = []
+        start = 0
+        # A cut can only be decided once max_size bytes past the chunk start are known
+        while start + self.max_size <= len(self.pending) or (final and start < len(self.pending)):
+            cut = min(self._cut(fingerprint, start), len(self.pending))
+            chunks.append(bytes(self.pending[start:cut]))
+            start = cut
+        del self.pending[:start]
+        return chunks
+
+    def feed(self, data) -> List[bytes]:
+        self.pending += data
+        if len(self.pending) < self.round_size:
+            return []
+        return self._split(final=False)
+
+    def flush(self) -> List[bytes]:
+        return self._split(final=True)
+
+
+class DedupRepository:
+    """Content-addressed chunk store with a SQLite index"""
+
+    def __init__(self, path: str, codec: Optional[str] = None, create: bool = True):
+        self.path = path
+        self.config_path = os.path.join(path, "repository.json")
+        if not os.path.exists(self.config_path):
+            if not create:
+                raise RepositoryError(f"No repository at {path}")
+            self._create(codec)
+        with open(self.config_path, "r") as f:
+            self.config = json.load(f)
+        if self.config.get("version") != REPOSITORY_VERSION:
+            raise RepositoryError(f"Unsupported repository version: {self.config.get('version')}")
+
+        self.codec = get_codec(self.config["codec"])
+        self.level = self.config["level"]
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, pack INTEGER, offset INTEGER, "
+                        "length INTEGER, size INTEGER) WITHOUT ROWID")
+        self.lock_fd = None
+        self.pack_fd = None
+        self.pack_id = 0
+        self.pack_offset = 0
+        self.pack_fds = {}
+
+    def _create(self, codec: Optional[str]):
+        if codec is None:
+            codec = "zstd" if "zstd" in CODECS else "gzip"
+        os.makedirs(os.path.join(self.path, "packs"), exist_ok=True)
+        config = {"version": REPOSITORY_VERSION, "codec": codec, "level": 3 if codec == "zstd" else 1,
+                  "min_chunk": DEFAULT_MIN_CHUNK, "avg_chunk": DEFAULT_AVG_CHUNK, "max_chunk": DEFAULT_MAX_CHUNK}
+        with open(self.config_path, "w") as f:
+            json.dump(config, f, indent=2)
+
+    def chunker(self) -> ContentChunker:
+        return ContentChunker(self.config["min_chunk"], self.config["avg_chunk"], self.config["max_chunk"])
+
+    def _pack_path(self, pack_id: int) -> str:
+        return os.path.join(self.path, "packs", f"{pack_id:06d}.pack")
+
+    def begin(self):
+        """Take the writer lock and start a transaction for one image"""
+        self.lock_fd = os.open(os.path.join(self.path, "repository.lock"), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+            raise RepositoryError(f"Repository {self.path} is in use by another backup") from None
+        row = self.db.execute("SELECT MAX(pack) FROM chunks").fetchone()
+        self.pack_id = (row[0] or 0) + 1
+        self.db.execute("BEGIN")
+
+    def _open_pack(self):
+        self.pack_fd = os.open(self._pack_path(self.pack_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.pack_offset = os.lseek(self.pack_fd, 0, os.SEEK_END)
+
+    def missing(self, digests: Iterable[bytes]) -> Set[bytes]:
+        """Digests that are not stored yet"""
+        wanted = list(set(digests))
+        present = set()
+        with self.lock:
+            for start in range(0, len(wanted), _LOOKUP_BATCH):
+                batch = wanted[start:start + _LOOKUP_BATCH]
+                query = f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})"
+                present.update(row[0] for row in self.db.execute(query, batch))
+        return set(wanted) - present
+
+    def compress(self, data: bytes) -> bytes:
+        return self.codec.compress(data, self.level)
+
+    def store(self, records: List[Tuple[bytes, bytes, int]]):
+        """Append (digest, compressed data, size) records to the current pack"""
+        rows = []
+        for digest, stored, size in records:
+            if self.pack_fd is None or self.pack_offset >= PACK_SIZE:
+                if self.pack_fd is not None:
+                    os.fsync(self.pack_fd)
+                    os.close(self.pack_fd)
+                    self.pack_id += 1
+                self._open_pack()
+            os.write(self.pack_fd, PACK_RECORD.pack(digest, len(stored)) + stored)
+            rows.append((digest, self.pack_id, self.pack_offset + PACK_RECORD.size, len(stored), size))
+            self.pack_offset += PACK_RECORD.size + len(stored)
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?, ?)", rows)
+
+    def commit(self, complete: bool = True):
+        """Sync packs, then commit (or roll back) the index and release the lock"""
+        try:
+            if self.pack_fd is not None:
+                os.fsync(self.pack_fd)
+                os.close(self.pack_fd)
+                self.pack_fd = None
+            with self.lock:
+                # Index rows only become visible once the data they point to is on disk
+                self.db.execute("COMMIT" if complete else "ROLLBACK")
+        finally:
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+    def read_chunk(self, digest: bytes) -> bytes:
+        with self.lock:
+            row = self.db.execute("SELECT pack, offset, length, size FROM chunks WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                raise RepositoryError(f"Chunk {digest.hex()} is missing from the repository")
+            pack, offset, length, size = row
+            if pack not in self.pack_fds:
+                self.pack_fds[pack] = os.open(self._pack_path(pack), os.O_RDONLY)
+            fd = self.pack_fds[pack]
+        decompressor = self.codec.decompressor()
+        data = decompressor.decompress(os.pread(fd, length, offset))
+        if len(data) != size or hashlib.sha256(data).digest() != digest:
+            raise RepositoryError(f"Chunk {digest.hex()} is corrupted")
+        return data
+
+    def close(self):
+        for fd in self.pack_fds.values():
+            os.close(fd)
+        self.pack_fds = {}
+        self.db.close()
+
+
+class DedupSink(Sink):
+    """Stores the stream in a repository and writes a recipe for it
+
+    Chunks are hashed and compressed on a thread pool; only chunks the
+    repository does not hold yet are written.
+    """
+
+    kind = "dedup"
+    name = "dedup"
+
+    def __init__(self, repository_path: str, recipe_file: str, threads: Optional[int] = None):
+        self.repository = DedupRepository(repository_path)
+        self.repository.begin()
+        self.recipe_file = recipe_file
+        self.chunker = self.repository.chunker()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads or default_threads()), thread_name_prefix="dedup")
+        path = os.path.abspath(repository_path).encode()
+        self.recipe = open(recipe_file, "wb")
+        self.recipe.write(RECIPE_MAGIC + struct.pack(">I", len(path)) + path)
+        self.count_offset = self.recipe.tell()
+        self.recipe.write(struct.pack(">Q", 0))
+        self.chunk_count = 0
+        self.total = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.stored_bytes = 0
+        self.zero_digests = {}
+
+    def describe(self) -> dict:
+        return {"kind": self.kind, "name": self.name, "repository": os.path.abspath(self.repository.path),
+                "chunks": self.chunk_count, "new_chunks": self.new_chunks, "new_bytes": self.new_bytes,
+                "stored_bytes": self.stored_bytes}
+
+    def _digest(self, chunk: bytes) -> bytes:
+        # Unallocated space arrives as long zero runs; hash each zero chunk size once
+        if _ZEROS.startswith(chunk):
+            if len(chunk) not in self.zero_digests:
+                self.zero_digests[len(chunk)] = hashlib.sha256(chunk).digest()
+            return self.zero_digests[len(chunk)]
+        return hashlib.sha256(chunk).digest()
+
+    def _store_chunks(self, chunks: List[bytes]):
+        if not chunks:
+            return
+        digests = list(self.executor.map(self._digest, chunks))
+        missing = self.repository.missing(digests)
+
+        new: Dict[bytes, bytes] = {}
+        for digest, chunk in zip(digests, chunks):
+            if digest in missing and digest not in new:
+                new[digest] = chunk
+        if new:
+            compressed = self.executor.map(self.repository.compress, new.values())
+            records = [(digest, stored, len(new[digest])) for digest, stored in zip(new, compressed)]
+            self.repository.store(records)
+            self.new_chunks += len(records)
+            self.new_bytes += sum(size for _, _, size in records)
+            self.stored_bytes += sum(len(stored) for _, stored, _ in records)
+
+        self.recipe.write(b"".join(RECIPE_ENTRY.pack(digest, len(chunk)) for digest, chunk in zip(digests, chunks)))
+        self.chunk_count += len(chunks)
+
+    def write(self, chunks: List) -> int:
+        """Returns the bytes of the stream accepted; new_bytes and stored_bytes count what reached the repository"""
+        accepted = 0
+        for chunk in chunks:
+            if isinstance(chunk, ZeroRun):
+                remaining = chunk.length
+                while remaining:
+                    step = min(remaining, len(_ZEROS))
+                    self._store_chunks(self.chunker.feed(memoryview(_ZEROS)[:step]))
+                    remaining -= step
+            else:
+                self._store_chunks(self.chunker.feed(chunk))
+            accepted += len(chunk)
+        self.total += accepted
+        return accepted
+
+    def close(self, complete: bool = True):
+        try:
+            if complete:
+                self._store_chunks(self.chunker.flush())
+                self.recipe.seek(self.count_offset)
+                self.recipe.write(struct.pack(">Q", self.chunk_count))
+                self.recipe.flush()
+                os.fsync(self.recipe.fileno())
+            self.recipe.close()
+            self.repository.commit(complete)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.repository.close()
+        if not complete:
+            os.unlink(self.recipe_file)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+class RecipeSource(Source):
+    """Reads an image back from its recipe and repository"""
+
+    def __init__(self, recipe_file: str):
+        with open(recipe_file, "rb") as f:
+            data = f.read()
+        if not data.startswith(RECIPE_MAGIC):
+            raise RepositoryError(f"{recipe_file} is not a recipe")
+        (path_length,) = struct.unpack_from(">I", data, len(RECIPE_MAGIC))
+        position = len(RECIPE_MAGIC) + 4
+        repository_path = data[position:position + path_length].decode()
+        (count,) = struct.unpack_from(">Q", data, position + path_length)
+        position += path_length + 8
+
+        self.repository = DedupRepository(repository_path, create=False)
+        self.digests = []
+        self.offsets = []
+        self.size = 0
+        for i in range(count):
+            digest, size = RECIPE_ENTRY.unpack_from(data, position + i * RECIPE_ENTRY.size)
+            self.digests.append(digest)
+            self.offsets.append(self.size)
+            self.size += size
+        self._cached = (-1, b"")
+
+    def _chunk(self, index: int) -> bytes:
+        cached_index, data = self._cached
+        if cached_index != index:
+            data = self.repository.read_chunk(self.digests[index])
+            self._cached = (index, data)
+        return data
+
+    def iter_chunks(self, threads: Optional[int] = None) -> Iterator[bytes]:
+        """Chunks in order, read and decompressed on a thread pool"""
+        threads = max(1, threads or default_threads())
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for start in range(0, len(self.digests), threads * 4):
+                batch = self.digests[start:start + threads * 4]
+                # Repeated chunks (typically zeros) are only read once per batch
+                unique = list(dict.fromkeys(batch))
+                loaded = dict(zip(unique, executor.map(self.repository.read_chunk, unique)))
+                for digest in batch:
+                    yield loaded[digest]
+
+    def read(self, offset: int, length: int) -> bytes:
+        length = max(0, min(length, self.size - offset))
+        parts = []
+        while length:
+            index = bisect.bisect_right(self.offsets, offset) - 1
+            data = self._chunk(index)[offset - self.offsets[index]:][:length]
+            parts.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b"".join(parts)
+
+    def readinto(self, buffer: memoryview, offset: int) -> int:
+        data = self.read(offset, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.repository.close()
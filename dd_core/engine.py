@@ -0,0 +1,1310 @@
+# dd_core/engine.py
+
+import base64
+import errno
+import fcntl
+import mmap
+import os
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_CHECKPOINT_INTERVAL = 30.0
+BUFFER_ALIGNMENT = 4096
+KERNEL_COPY_CHUNK = 32 * 1024 * 1024
+PIPE_SIZE = 1024 * 1024
+CACHE_DROP_WINDOW = 32 * 1024 * 1024
+READ_AHEAD_LIMIT = 256 * 1024 * 1024  # buffers a parallel reader may hold
+QUEUE_POLL = 0.25  # keeps cancellation and failures of other stages noticed while waiting
+FILL_SMOOTHING = 0.05
+
+_ZERO_BLOCK = bytes(DEFAULT_BLOCK_SIZE)
+
+
+class EngineError(Exception):
+    """Raised when the copy engine cannot complete an operation"""
+
+
+class CopyCancelled(EngineError):
+    """Raised when the copy was cancelled through cancel_check"""
+
+
+def allocate_buffer(size: int) -> mmap.mmap:
+    """Allocate a page-aligned buffer suitable for direct I/O"""
+    size = max(BUFFER_ALIGNMENT, (size + BUFFER_ALIGNMENT - 1) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT)
+    return mmap.mmap(-1, size)
+
+
+class ZeroRun:
+    """Marker for length zero bytes that were not materialised"""
+
+    __slots__ = ("length",)
+
+    def __init__(self, length: int):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+def set_direct(fd: int, enabled: bool) -> bool:
+    """Switch O_DIRECT on an open descriptor; False when the file does not support it"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT if enabled else flags & ~os.O_DIRECT)
+    except OSError:
+        return False
+    return True
+
+
+def drop_cache(fd: int, offset: int, length: int):
+    if length > 0:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def pwritev_all(fd: int, buffers: Sequence, offset: int) -> int:
+    """Write all buffers at offset, retrying on short writes"""
+    views = [memoryview(b).cast('B') for b in buffers if len(b)]
+    total = 0
+    while views:
+        written = os.pwritev(fd, views, offset + total)
+        if written <= 0:
+            raise EngineError("Short write to target")
+        total += written
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written:
+            views[0] = views[0][written:]
+    return total
+
+
+# errno values meaning "not for this pair of descriptors" rather than an I/O error
+_KERNEL_COPY_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE}
+
+
+class KernelCopier:
+    """Copies between descriptors without passing the data through user space
+
+    Tries copy_file_range, then splice through a pipe, then sendfile. A
+    method the kernel rejects for the descriptors (EXDEV, EINVAL, ...) is
+    not tried again; copy() returns None once none is left so the caller
+    can fall back to the buffered path. Every method copies by offset, so
+    the failed range is simply copied again by the next one.
+    """
+
+    def __init__(self):
+        self.methods = [method for name, method in (("copy_file_range", self._copy_file_range), ("splice", self._splice),
+                                                    ("sendfile", self._sendfile)) if hasattr(os, name)]
+        self.pipe = None
+
+    @property
+    def method(self) -> Optional[str]:
+        return self.methods[0].__name__.lstrip("_") if self.methods else None
+
+    def _copy_file_range(self, src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> int:
+        return os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+
+    def _splice(self, src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> int:
+        if self.pipe is None:
+            self.pipe = os.pipe()
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+            except (AttributeError, OSError):
+                pass  # the default pipe size only means more calls
+        read_end, write_end = self.pipe
+        total = 0
+        while total < length:
+            count = os.splice(src_fd, write_end, min(length - total, PIPE_SIZE), offset_src=src_offset + total)
+            if count == 0:
+                break
+            while count:
+                written = os.splice(read_end, dst_fd, count, offset_dst=dst_offset + total)
+                count -= written
+                total += written
+        return total
+
+    def _sendfile(self, src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> int:
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, src_offset, length)
+
+    def _reset_pipe(self):
+        # A failed splice may leave data in the pipe
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+    def copy(self, src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> Optional[int]:
+        """Copy up to length bytes; returns the count (0 at EOF) or None when no method works"""
+        while self.methods:
+            try:
+                return self.methods[0](src_fd, src_offset, dst_fd, dst_offset, length)
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+                self._reset_pipe()
+                self.methods.pop(0)
+        return None
+
+    def close(self):
+        self._reset_pipe()
+
+
+class Source:
+    """Base class for data sources read by the copy engine"""
+
+    size = 0
+    cache_avoided = 0  # bytes read without leaving them in the page cache
+    concurrent = False  # readinto() may be called from several threads at once
+
+    def readinto(self, buffer: memoryview, offset: int) -> int:
+        raise NotImplementedError
+
+    def fileno(self) -> Optional[int]:
+        """Descriptor the data can be copied from in the kernel, or None"""
+        return None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class DeviceSource(Source):
+    """Block device or regular file read with positioned preadv calls
+
+    With direct=True the page cache is bypassed: aligned reads use
+    O_DIRECT, and reads that cannot (unaligned ranges, files without
+    O_DIRECT support) are dropped from the cache right after reading.
+    Reads may run concurrently; buffered reads of a direct source are
+    serialized, since they switch O_DIRECT off on the shared descriptor.
+    """
+
+    concurrent = True
+
+    def __init__(self, path: str, fd: Optional[int] = None, direct: bool = False):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY) if fd is None else fd
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.drop_cache = direct
+        self.direct = direct and set_direct(self.fd, True)
+        self.cache_avoided = 0
+        self.lock = threading.Lock()
+
+    def _read_buffered(self, buffer: memoryview, offset: int) -> int:
+        with self.lock:
+            if self.direct:
+                set_direct(self.fd, False)
+            try:
+                count = os.preadv(self.fd, [buffer], offset)
+            finally:
+                if self.direct:
+                    set_direct(self.fd, True)
+            if self.drop_cache:
+                drop_cache(self.fd, offset, count)
+                self.cache_avoided += count
+        return count
+
+    def read(self, offset: int, length: int) -> bytes:
+        buffer = bytearray(length)
+        return bytes(buffer[:self._read_buffered(memoryview(buffer), offset)])
+
+    def fileno(self) -> Optional[int]:
+        return self.fd
+
+    def readinto(self, buffer: memoryview, offset: int) -> int:
+        total = 0
+        while total < len(buffer):
+            position = offset + total
+            aligned = (len(buffer) - total) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT
+            if self.direct and aligned and position % BUFFER_ALIGNMENT == 0:
+                try:
+                    count = os.preadv(self.fd, [buffer[total:total + aligned]], position)
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        raise
+                    # Alignment the device does not accept: stay on the buffered path
+                    with self.lock:
+                        set_direct(self.fd, False)
+                        self.direct = False
+                    continue
+                with self.lock:
+                    self.cache_avoided += count
+            else:
+                count = self._read_buffered(buffer[total:], position)
+            if count == 0:
+                break
+            total += count
+        return total
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_source(path: str, sudo_password: Optional[str] = None, direct: bool = False) -> DeviceSource:
+    """Open path directly, falling back to a descriptor opened through sudo on permission errors"""
+    try:
+        return DeviceSource(path, direct=direct)
+    except PermissionError:
+        if not sudo_password:
+            raise
+        return DeviceSource(path, open_privileged(path, os.O_RDONLY, sudo_password), direct=direct)
+
+
+# Runs as root: opens the path and passes the descriptor back over a unix socket
+_FD_HELPER = ("import os, socket, sys; s = socket.socket(socket.AF_UNIX); s.connect(sys.argv[1]); "
+              "socket.send_fds(s, [b'0'], [os.open(sys.argv[2], int(sys.argv[3]))])")
+
+
+def open_privileged(path: str, flags: int, sudo_password: str) -> int:
+    """Open path through sudo and return a descriptor usable in this process"""
+    with tempfile.TemporaryDirectory(prefix="hardclone-") as directory:
+        socket_path = os.path.join(directory, "fd.sock")
+        with socket.socket(socket.AF_UNIX) as server:
+            server.bind(socket_path)
+            server.listen(1)
+            server.settimeout(0.5)
+            process = subprocess.Popen(["sudo", "-S", "-p", "", "python3", "-c", _FD_HELPER, socket_path, path, str(flags)],
+                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            process.stdin.write(f"{sudo_password}\n".encode())
+            process.stdin.close()
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    connection, _ = server.accept()
+                    break
+                except socket.timeout:
+                    if process.poll() is None and time.monotonic() < deadline:
+                        continue
+                    if process.poll() is None:
+                        process.kill()
+                    process.wait()
+                    error = process.stderr.read().decode(errors="replace").strip()
+                    raise EngineError(f"Privileged helper could not open {path}: {error}") from None
+            with connection:
+                _, fds, _, _ = socket.recv_fds(connection, 1, 1)
+            process.wait()
+            if not fds:
+                error = process.stderr.read().decode(errors="replace").strip().splitlines()
+                raise EngineError(f"Privileged helper could not open {path}: {error[-1] if error else 'unknown error'}")
+    return fds[0]
+
+
+class Sink:
+    """Base class for output targets written by the copy engine"""
+
+    # Whether state()/resume() can continue a partially written target
+    resumable = False
+    cache_avoided = 0  # bytes written without leaving them in the page cache
+
+    def write(self, chunks: List) -> int:
+        raise NotImplementedError
+
+    def copy_from(self, copier: KernelCopier, src_fd: int, offset: int, length: int) -> Optional[int]:
+        """Copy length bytes at offset of src_fd in the kernel; None when this sink cannot"""
+        return None
+
+    def sync(self):
+        """Make everything written so far durable"""
+
+    def state(self) -> dict:
+        return {}
+
+    def resume(self, state: dict):
+        raise EngineError(f"{type(self).__name__} cannot resume a partial image")
+
+    def read_committed(self) -> Iterator[bytes]:
+        """Bytes written so far, for re-hashing a resumed image"""
+        raise EngineError(f"{type(self).__name__} cannot read back a partial image")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class FileSink(Sink):
+    """Regular file or block device written with gathered pwritev calls
+
+    ZeroRun markers become holes in freshly truncated regular files and
+    are written out as zeros everywhere else (e.g. on block devices).
+
+    With direct=True the page cache is bypassed: block devices are written
+    with O_DIRECT through an aligned staging buffer, whose unaligned tail
+    is also written through the cache and rewritten aligned later; regular
+    files are dropped from the cache a window behind the writer.
+    """
+
+    resumable = True
+
+    def __init__(self, path: str, truncate: bool = True, sudo_password: Optional[str] = None, direct: bool = False):
+        self.path = path
+        flags = os.O_WRONLY | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        try:
+            self.fd = os.open(path, flags, 0o644)
+        except PermissionError:
+            if not sudo_password:
+                raise
+            self.fd = open_privileged(path, flags, sudo_password)
+        self.sparse = truncate and stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.offset = 0
+        self.drop_cache = direct
+        self.direct = direct and stat.S_ISBLK(os.fstat(self.fd).st_mode) and set_direct(self.fd, True)
+        self.staging = memoryview(allocate_buffer(DEFAULT_BLOCK_SIZE)) if self.direct else None
+        self.staged = 0  # unaligned tail at the start of staging, already written through the cache
+        self.dropped = self.drop_pending = 0
+        self.cache_avoided = 0
+
+    def _write_zeros(self, length: int) -> int:
+        zeros = memoryview(_ZERO_BLOCK)
+        written = 0
+        while written < length:
+            written += pwritev_all(self.fd, [zeros[:min(len(zeros), length - written)]], self.offset + written)
+        return written
+
+    def _write_aligned(self, length: int, offset: int):
+        if self.direct:
+            try:
+                pwritev_all(self.fd, [self.staging[:length]], offset)
+                self.cache_avoided += length
+                return
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # The device wants a larger alignment: continue through the cache
+                set_direct(self.fd, False)
+                self.direct = False
+        pwritev_all(self.fd, [self.staging[:length]], offset)
+
+    def _write_direct(self, chunks: List) -> int:
+        base = self.offset - self.staged
+        written = 0
+        for chunk in chunks:
+            remaining = len(chunk)
+            view = None if isinstance(chunk, ZeroRun) else memoryview(chunk).cast('B')
+            while remaining:
+                take = min(remaining, len(self.staging) - self.staged)
+                if view is None:
+                    self.staging[self.staged:self.staged + take] = memoryview(_ZERO_BLOCK)[:take]
+                else:
+                    self.staging[self.staged:self.staged + take] = view[len(view) - remaining:len(view) - remaining + take]
+                self.staged += take
+                remaining -= take
+                written += take
+                if self.staged == len(self.staging):
+                    self._write_aligned(self.staged, base)
+                    base += self.staged
+                    self.staged = 0
+        aligned = self.staged // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT
+        if aligned:
+            self._write_aligned(aligned, base)
+            self.staging[:self.staged - aligned] = self.staging[aligned:self.staged]
+            base += aligned
+            self.staged -= aligned
+        if self.staged:
+            if self.direct:
+                set_direct(self.fd, False)
+            try:
+                pwritev_all(self.fd, [self.staging[:self.staged]], base)
+            finally:
+                if self.direct:
+                    set_direct(self.fd, True)
+        self.offset = base + self.staged
+        if not self.direct:
+            self.staged = 0
+        return written
+
+    def _drop_written(self):
+        if self.offset - self.drop_pending >= CACHE_DROP_WINDOW:
+            # DONTNEED starts writeback of the newest window and drops the one before, written back by now
+            drop_cache(self.fd, self.dropped, self.offset - self.dropped)
+            self.cache_avoided += self.drop_pending - self.dropped
+            self.dropped, self.drop_pending = self.drop_pending, self.offset
+
+    def write(self, chunks: List) -> int:
+        if self.direct:
+            return self._write_direct(chunks)
+        written = 0
+        batch = []
+        for chunk in chunks:
+            if isinstance(chunk, ZeroRun):
+                if batch:
+                    count = pwritev_all(self.fd, batch, self.offset)
+                    self.offset += count
+                    written += count
+                    batch = []
+                if not self.sparse:
+                    written += self._write_zeros(chunk.length)
+                self.offset += chunk.length
+            else:
+                batch.append(chunk)
+        if batch:
+            count = pwritev_all(self.fd, batch, self.offset)
+            self.offset += count
+            written += count
+        if self.drop_cache:
+            self._drop_written()
+        return written
+
+    def write_at(self, data, offset: int) -> int:
+        """Write data at offset outside the sequential stream, e.g. when rescuing ranges out of order"""
+        count = pwritev_all(self.fd, [data], offset)
+        self.offset = max(self.offset, offset + count)
+        return count
+
+    def extend(self, size: int):
+        """Give a regular file at least size bytes; the unwritten part stays a hole"""
+        self.offset = max(self.offset, size)
+        if stat.S_ISREG(os.fstat(self.fd).st_mode) and os.fstat(self.fd).st_size < self.offset:
+            os.ftruncate(self.fd, self.offset)
+
+    def copy_from(self, copier: KernelCopier, src_fd: int, offset: int, length: int) -> Optional[int]:
+        count = copier.copy(src_fd, offset, self.fd, self.offset, length)
+        if count:
+            self.offset += count
+        return count
+
+    def _drop_synced(self):
+        if self.drop_cache and not self.direct:
+            drop_cache(self.fd, self.dropped, self.offset - self.dropped)
+            self.cache_avoided += max(0, self.offset - self.dropped)
+            self.dropped = self.drop_pending = self.offset
+
+    def sync(self):
+        if self.sparse:
+            os.ftruncate(self.fd, self.offset)
+        os.fsync(self.fd)
+        self._drop_synced()
+
+    def state(self) -> dict:
+        return {"offset": self.offset}
+
+    def resume(self, state: dict):
+        # Everything past the checkpoint is discarded, so it may become holes again
+        self.offset = state["offset"]
+        self.dropped = self.drop_pending = self.offset
+        self.sparse = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        if self.sparse:
+            os.ftruncate(self.fd, self.offset)
+        if self.direct and self.offset % BUFFER_ALIGNMENT:
+            # The partial block before the checkpoint is not staged, so continue through the cache
+            set_direct(self.fd, False)
+            self.direct = False
+
+    def read_committed(self) -> Iterator[bytes]:
+        with open(self.path, "rb") as f:
+            remaining = self.offset
+            while remaining:
+                data = f.read(min(remaining, DEFAULT_BLOCK_SIZE))
+                if not data:
+                    raise EngineError(f"{self.path} is shorter than its checkpoint")
+                remaining -= len(data)
+                yield data
+
+    def close(self):
+        if self.fd is not None:
+            if self.sparse:
+                # Materialise a trailing hole so the file has its full logical size
+                os.ftruncate(self.fd, self.offset)
+            os.fsync(self.fd)
+            self._drop_synced()
+            os.close(self.fd)
+            self.fd = None
+
+
+class Stage:
+    """In-process pipeline stage transforming the byte stream
+
+    process() receives a view that is only valid for the duration of the
+    call; stages that keep data around must copy it.
+
+    Resumable stages describe their position in the stream with state()
+    after checkpoint() has drained their in-flight output, and pick it up
+    again in resume(). Stages with replay set cannot store their state and
+    are fed the stream up to the checkpoint again instead.
+    """
+
+    name = "stage"
+    kind = "transform"
+    suffix = ""
+    resumable = True
+    replay = False
+
+    def describe(self) -> dict:
+        """Parameters recorded in the image header (never secrets)"""
+        return {"kind": self.kind, "name": self.name}
+
+    def process(self, data: memoryview) -> List:
+        return [data]
+
+    def flush(self) -> List:
+        return []
+
+    def checkpoint(self) -> List:
+        """Output that is ready, without ending the stream"""
+        return []
+
+    def state(self) -> dict:
+        return {}
+
+    def resume(self, state: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class SubprocessStage(Stage):
+    """Stage adapter piping the stream through an external filter program"""
+
+    name = "subprocess"
+    # The external program's state cannot be captured
+    resumable = False
+
+    def __init__(self, cmd: List[str], env: Optional[dict] = None):
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        self._output = []
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._drain, daemon=True)
+        self._reader.start()
+
+    def _drain(self):
+        while True:
+            data = self.proc.stdout.read1(DEFAULT_BLOCK_SIZE)
+            if not data:
+                break
+            with self._lock:
+                self._output.append(data)
+
+    def _take_output(self) -> List:
+        with self._lock:
+            output, self._output = self._output, []
+        return output
+
+    def process(self, data: memoryview) -> List:
+        self.proc.stdin.write(data)
+        return self._take_output()
+
+    def flush(self) -> List:
+        self.proc.stdin.close()
+        self._reader.join()
+        if self.proc.wait() != 0:
+            raise EngineError(f"{self.name} failed with return code: {self.proc.returncode}")
+        return self._take_output()
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def default_threads() -> int:
+    return os.cpu_count() or 1
+
+
+class ParallelChunkStage(Stage):
+    """Splits the stream into fixed-size chunks transformed on a thread pool
+
+    Chunks are transformed independently by transform_chunk() and emitted in
+    input order. Every chunk but the last is exactly chunk_size bytes; the
+    last one is passed with final=True and is only empty for an empty stream.
+    cpu_budget is an optional semaphore shared by the stages of concurrent
+    jobs, bounding how many chunks are transformed at once across all of them.
+    """
+
+    def __init__(self, threads: Optional[int] = None, chunk_size: int = DEFAULT_BLOCK_SIZE):
+        self.threads = max(1, threads or default_threads())
+        self.chunk_size = max(64 * 1024, chunk_size)
+        self.pending = bytearray()
+        self.futures = deque()
+        self.chunks_submitted = 0
+        self.cpu_budget = None
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=self.name)
+
+    def transform_chunk(self, index: int, data: bytes, final: bool) -> bytes:
+        raise NotImplementedError
+
+    def _transform(self, index: int, data: bytes, final: bool):
+        if self.cpu_budget is None:
+            return self.transform_chunk(index, data, final)
+        with self.cpu_budget:
+            return self.transform_chunk(index, data, final)
+
+    def _submit(self, data: bytes, final: bool = False):
+        self.futures.append(self.executor.submit(self._transform, self.chunks_submitted, data, final))
+        self.chunks_submitted += 1
+
+    def _collect(self, wait_all: bool = False) -> List:
+        output = []
+        # Bound the number of in-flight chunks so a slow sink applies backpressure
+        while self.futures and (wait_all or self.futures[0].done() or len(self.futures) > self.threads * 2):
+            output.append(self.futures.popleft().result())
+        return output
+
+    def process(self, data: memoryview) -> List:
+        self.pending += data
+        # Hold back the last full chunk until more data arrives, so flush() can flag it as final
+        while len(self.pending) > self.chunk_size:
+            self._submit(bytes(self.pending[:self.chunk_size]))
+            del self.pending[:self.chunk_size]
+        return self._collect()
+
+    def flush(self) -> List:
+        if self.pending or not self.chunks_submitted:
+            self._submit(bytes(self.pending), final=True)
+            self.pending = bytearray()
+        return self._collect(wait_all=True)
+
+    def checkpoint(self) -> List:
+        # Only called mid-stream, so a held back full chunk is not the final one
+        if len(self.pending) == self.chunk_size:
+            self._submit(bytes(self.pending))
+            self.pending = bytearray()
+        return self._collect(wait_all=True)
+
+    def state(self) -> dict:
+        return {"chunks": self.chunks_submitted, "pending": base64.b64encode(self.pending).decode()}
+
+    def resume(self, state: dict):
+        self.chunks_submitted = state["chunks"]
+        self.pending = bytearray(base64.b64decode(state["pending"]))
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=True)
+
+
+class BufferPool:
+    """Fixed set of aligned block buffers, allocated once and passed between pipeline stages
+
+    acquire() waits while every buffer is in use, so a stage that falls
+    behind holds back the reader instead of letting memory grow.
+    """
+
+    def __init__(self, block_size: int, count: int):
+        self.block_size = block_size
+        self.count = max(1, count)
+        stride = (block_size + BUFFER_ALIGNMENT - 1) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT
+        self.memory = stride * self.count
+        self.area = allocate_buffer(self.memory)
+        view = memoryview(self.area)
+        self.free = [view[index * stride:index * stride + block_size] for index in range(self.count)]
+        self.condition = threading.Condition()
+        self.waits = 0  # acquires that found the pool empty
+
+    @property
+    def in_use(self) -> int:
+        return self.count - len(self.free)
+
+    def acquire(self, block: bool = True, stop: Optional[Callable[[], bool]] = None) -> Optional[memoryview]:
+        """A free buffer; None when block is False and none is free, or when stop() turns true while waiting"""
+        with self.condition:
+            if not self.free:
+                if not block:
+                    return None
+                self.waits += 1
+            while not self.free:
+                if stop and stop():
+                    return None
+                self.condition.wait(QUEUE_POLL)
+            return self.free.pop()
+
+    def release(self, buffer: memoryview):
+        with self.condition:
+            self.free.append(buffer)
+            self.condition.notify()
+
+
+class StageQueue:
+    """Bounded FIFO between two pipeline stages; put() waits while it is full
+
+    fill is a moving average of the occupancy (0 to 1): a queue that stays
+    full waits on the stage after it, one that stays empty on the stage
+    before it.
+    """
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.items = deque()
+        self.unfinished = 0
+        self.condition = threading.Condition()
+        self.fill = 0.0
+        self.fill_total = 0.0
+        self.samples = 0
+
+    @property
+    def average_fill(self) -> float:
+        return self.fill_total / self.samples if self.samples else 0.0
+
+    def _sample(self):
+        occupancy = len(self.items) / self.capacity
+        self.fill += (occupancy - self.fill) * FILL_SMOOTHING
+        self.fill_total += occupancy
+        self.samples += 1
+
+    def put(self, item, stop: Optional[Callable[[], bool]] = None) -> bool:
+        """Append item; False when stop() turned true while waiting for room"""
+        with self.condition:
+            self._sample()
+            while len(self.items) >= self.capacity:
+                if stop and stop():
+                    return False
+                self.condition.wait(QUEUE_POLL)
+            self.items.append(item)
+            self.unfinished += 1
+            self.condition.notify_all()
+            return True
+
+    def get(self, stop: Optional[Callable[[], bool]] = None):
+        """Oldest item; None when stop() turned true while waiting for one"""
+        with self.condition:
+            while not self.items:
+                if stop and stop():
+                    return None
+                self.condition.wait(QUEUE_POLL)
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def join(self, stop: Optional[Callable[[], bool]] = None) -> bool:
+        """Wait until every item put has been processed; False when stop() turned true first"""
+        with self.condition:
+            while self.unfinished:
+                if stop and stop():
+                    return False
+                self.condition.wait(QUEUE_POLL)
+            return True
+
+
+def read_ahead_depth(block_size: int, queue_depth: int) -> int:
+    """queue_depth capped so the blocks in flight stay within READ_AHEAD_LIMIT"""
+    return max(1, min(queue_depth, READ_AHEAD_LIMIT // max(1, block_size)))
+
+
+class ParallelReader:
+    """Keeps up to queue_depth positioned reads of a source in flight and hands the blocks over in order
+
+    Reads run on a thread pool (preadv releases the GIL, so the requests
+    overlap on the device) into buffers of a BufferPool. Without a pool of
+    its own the reader keeps a ring of queue_depth + 1 buffers, and the block
+    returned by next() stays valid until the following call. With a shared
+    pool the caller releases every block it gets, and fewer reads are issued
+    while the pool runs low. A throttle is asked before every request.
+    """
+
+    def __init__(self, source: Source, block_size: int, queue_depth: int, throttle=None,
+                 cancel_check: Optional[Callable[[], bool]] = None, pool: Optional[BufferPool] = None):
+        self.source = source
+        self.block_size = block_size
+        self.queue_depth = read_ahead_depth(block_size, queue_depth)
+        self.throttle = throttle
+        self.cancel_check = cancel_check
+        self.recycle = pool is None
+        self.pool = pool or BufferPool(block_size, self.queue_depth + 1)
+        self.pending = deque()  # (future, buffer, length) in source order
+        self.handed = None
+        self.executor = ThreadPoolExecutor(max_workers=self.queue_depth, thread_name_prefix="reader")
+        self.position = None  # source offset of the block next() returns
+        self.end = None
+        self.submitted = 0
+        self.exhausted = False
+        self.waits = 0
+        self.in_flight_total = 0
+
+    @property
+    def average_in_flight(self) -> float:
+        """Reads outstanding when a block was waited for, on average"""
+        return self.in_flight_total / self.waits if self.waits else 0.0
+
+    def start(self, offset: int, end: Optional[int]):
+        """Read from offset up to end (None: until the source ends)"""
+        self._drain()
+        self.position = self.submitted = offset
+        self.end = end
+        self.exhausted = False
+
+    def _submit(self):
+        while len(self.pending) < self.queue_depth and not self.exhausted and \
+                (self.end is None or self.submitted < self.end):
+            # Only wait for a buffer when nothing is in flight, or the blocks already read could never be handed over
+            buffer = self.pool.acquire(block=not self.pending, stop=self.cancel_check)
+            if buffer is None:
+                return
+            length = self.block_size if self.end is None else min(self.block_size, self.end - self.submitted)
+            if self.throttle:
+                self.throttle.acquire(length, self.cancel_check, len(self.pending), self.queue_depth)
+            self.pending.append((self.executor.submit(self.source.readinto, buffer[:length], self.submitted), buffer, length))
+            self.submitted += length
+
+    def _drain(self):
+        for future, buffer, _ in self.pending:
+            if not future.cancel():
+                future.exception()  # the buffer is only free once the read is over
+            self.pool.release(buffer)
+        self.pending.clear()
+
+    def next(self) -> Tuple[Optional[memoryview], int]:
+        """(buffer, byte count) of the block at self.position; (None, 0) at the end of the range or of the source"""
+        if self.handed is not None:
+            self.pool.release(self.handed)
+            self.handed = None
+        self._submit()
+        if not self.pending:
+            return None, 0
+        self.waits += 1
+        self.in_flight_total += len(self.pending)
+        future, buffer, length = self.pending.popleft()
+        try:
+            count = future.result()
+        except BaseException:
+            self.pool.release(buffer)
+            raise
+        self.position += count
+        if count < length:
+            # The source ended: the requests behind this one read nothing
+            self._drain()
+            self.exhausted = True
+        else:
+            # Keep queue_depth reads running while the caller processes this block
+            self._submit()
+        if count == 0:
+            self.pool.release(buffer)
+            return None, 0
+        if self.recycle:
+            self.handed = buffer
+        return buffer, count
+
+    def close(self):
+        self._drain()
+        if self.handed is not None:
+            self.pool.release(self.handed)
+            self.handed = None
+        self.executor.shutdown(wait=True)
+
+
+@dataclass
+class EngineStats:
+    bytes_read: int = 0
+    bytes_written: int = 0
+    position: int = 0  # source offset processed, including extents that were not read
+    elapsed: float = 0.0
+    kernel_copied: int = 0  # bytes copied without passing through user space
+    cache_avoided: int = 0  # bytes read or written without staying in the page cache
+    queue_depth: int = 1  # reads the engine keeps in flight
+    in_flight: float = 0.0  # reads outstanding while waiting for the next block, on average
+    queue_fill: Dict[str, float] = field(default_factory=dict)  # occupancy of the queues between stages, 0 to 1
+    buffers_in_use: int = 0
+
+    @property
+    def throughput(self):
+        return self.position / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def bottleneck(self) -> Optional[str]:
+        """Part of a pipelined copy holding the others back: read, stages or write"""
+        if not self.queue_fill:
+            return None
+        if self.queue_fill.get("write", 0.0) > 0.5:
+            return "write"
+        if self.queue_fill.get("read", 0.0) > 0.5:
+            return "stages"
+        return "read"
+
+
+class CopyEngine:
+    """Copies a source into a sink through a chain of in-process stages
+
+    With a checkpoint_callback the engine drains the pipeline every
+    checkpoint_interval seconds, syncs the sink and passes the callback
+    the state needed to resume() the copy from that point later.
+
+    A plain copy without stages is done in the kernel (copy_file_range,
+    splice or sendfile) when the source and sink allow it, falling back
+    to the buffered path otherwise; zero_copy_skipped then says why.
+    With cache_bypass, meant for sources and sinks opened with
+    direct=True, the engine keeps to the buffered path, since kernel
+    copies go through the page cache. A throttle
+    (dd_core.throttle.RateLimiter) is asked before every read. With a
+    queue_depth above 1 and a source that allows concurrent reads, the
+    buffered path keeps that many reads in flight (ParallelReader).
+
+    With buffer_memory the buffered path is pipelined: reading and writing
+    run on threads of their own, joined to the stages by bounded queues,
+    and blocks are read into a BufferPool of that many bytes (at least
+    enough for the reads in flight and two blocks). A stage that falls
+    behind fills the queue before it and the pool, which stops the reader;
+    stats.queue_fill shows where the blocks wait.
+    """
+
+    def __init__(self, source: Source, sink: Sink, stages: Optional[List[Stage]] = None, block_size: int = DEFAULT_BLOCK_SIZE,
+                 size: Optional[int] = None, progress_callback: Optional[Callable[[EngineStats], None]] = None,
+                 cancel_check: Optional[Callable[[], bool]] = None, extents: Optional[List[Tuple[int, int]]] = None,
+                 checkpoint_callback: Optional[Callable[[dict], None]] = None,
+                 checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL, zero_copy: bool = True,
+                 cache_bypass: bool = False, throttle=None, queue_depth: int = 1,
+                 buffer_memory: Optional[int] = None):
+        self.source = source
+        self.sink = sink
+        self.stages = stages or []
+        self.block_size = block_size
+        self.size = size if size is not None else source.size
+        self.progress_callback = progress_callback
+        self.cancel_check = cancel_check
+        self.extents = extents
+        self.checkpoint_callback = checkpoint_callback
+        self.checkpoint_interval = checkpoint_interval
+        self.zero_copy = zero_copy
+        self.cache_bypass = cache_bypass
+        self.throttle = throttle
+        self.queue_depth = queue_depth if source.concurrent else 1
+        self.buffer_memory = buffer_memory
+        self.copier = None
+        self.zero_copy_skipped = None  # why a requested kernel copy fell back to the buffered path
+        self.reader = None
+        self.pool = None
+        self.queues = []
+        self.write_queue = None
+        self.failures = []  # exceptions raised on the reading and writing threads
+        self.last_checkpoint = 0.0
+        self.resume_state = None
+        self.stats = EngineStats()
+
+    @property
+    def resumable(self) -> bool:
+        return self.sink.resumable and all(stage.resumable for stage in self.stages)
+
+    def resume(self, state: dict):
+        """Continue from a checkpoint instead of the start when run() is called"""
+        if not self.resumable:
+            raise EngineError("This pipeline cannot resume a partial image")
+        if len(state["stages"]) != len(self.stages):
+            raise EngineError("Checkpoint does not match the pipeline")
+        self.resume_state = state
+
+    def _push(self, chunks: List, start: int = 0, end: Optional[int] = None):
+        for stage in self.stages[start:end]:
+            output = []
+            for chunk in chunks:
+                output.extend(stage.process(chunk))
+            chunks = output
+        if chunks and end is None:
+            if self.write_queue is None:
+                self.stats.bytes_written += self.sink.write(chunks)
+            elif not self.write_queue.put(chunks, self._failed):
+                raise self.failures[0]
+
+    def _flush_stages(self):
+        for index, stage in enumerate(self.stages):
+            chunks = stage.flush()
+            if chunks:
+                self._push(chunks, index + 1)
+
+    def _checkpoint_stages(self, end: Optional[int] = None):
+        for index, stage in enumerate(self.stages[:end]):
+            chunks = stage.checkpoint()
+            if chunks:
+                self._push(chunks, index + 1, end)
+
+    def checkpoint(self) -> dict:
+        """Drain the pipeline, make the image durable and return its resume state"""
+        self._checkpoint_stages()
+        if self.write_queue is not None and not self.write_queue.join(self._failed):
+            raise self.failures[0]
+        self.sink.sync()
+        return {"position": self.stats.position, "bytes_read": self.stats.bytes_read, "bytes_written": self.stats.bytes_written,
+                "stages": [stage.state() for stage in self.stages], "sink": self.sink.state()}
+
+    def _plan(self, start: int = 0, stop: Optional[int] = None):
+        """Yield (offset, length, copy) regions covering the source between start and stop"""
+        if self.extents is None:
+            if not self.size:
+                # Unknown size: copy until EOF
+                yield 0, 0, True
+                return
+            regions = [(0, self.size, True)]
+        else:
+            regions = []
+            position = 0
+            for offset, length in self.extents:
+                if offset > position:
+                    regions.append((position, offset - position, False))
+                regions.append((offset, length, True))
+                position = offset + length
+            if self.size > position:
+                regions.append((position, self.size - position, False))
+
+        stop = self.size if stop is None else stop
+        for offset, length, copy in regions:
+            begin, end = max(offset, start), min(offset + length, stop)
+            if begin < end:
+                yield begin, end - begin, copy
+
+    def _copy_region(self, view: memoryview, offset: int, length: int, started: float, end_stage: Optional[int] = None) -> bool:
+        """Copy one region (length 0 means until EOF) through stages[:end_stage]; returns False on EOF"""
+        end = offset + length if length else None
+        while end is None or offset < end:
+            if self.cancel_check and self.cancel_check():
+                raise CopyCancelled("Operation cancelled by user")
+
+            count = None
+            if self.copier is not None and end_stage is None:
+                # Throttled copies keep to block-sized requests so the rate stays smooth
+                chunk = self.block_size if self.throttle else max(self.block_size, KERNEL_COPY_CHUNK)
+                chunk = chunk if end is None else min(chunk, end - offset)
+                if self.throttle:
+                    self.throttle.acquire(chunk, self.cancel_check)
+                count = self.sink.copy_from(self.copier, self.source.fileno(), offset, chunk)
+                if count is None:
+                    self.zero_copy_skipped = "the target cannot take kernel copies from this source"
+                    self.copier.close()
+                    self.copier = None
+                else:
+                    self.stats.bytes_written += count
+                    self.stats.kernel_copied += count
+            if count is None and self.queue_depth > 1:
+                if self.reader is None:
+                    self.reader = ParallelReader(self.source, self.block_size, self.queue_depth, self.throttle,
+                                                 self.cancel_check)
+                if self.reader.position != offset or self.reader.end != end:
+                    self.reader.start(offset, end)
+                buffer, count = self.reader.next()
+                if count:
+                    self._push([buffer[:count]], end=end_stage)
+                self.stats.queue_depth = self.reader.queue_depth
+                self.stats.in_flight = self.reader.average_in_flight
+            elif count is None:
+                want = self.block_size if end is None else min(self.block_size, end - offset)
+                if self.throttle:
+                    self.throttle.acquire(want, self.cancel_check)
+                count = self.source.readinto(view[:want], offset)
+                if count:
+                    self._push([view[:count]], end=end_stage)
+            if count == 0:
+                return False
+
+            offset += count
+            self.stats.bytes_read += count
+            if end_stage is not None:
+                continue
+
+            self._after_block(offset, started)
+        return True
+
+    def _failed(self) -> bool:
+        return bool(self.failures)
+
+    def _after_block(self, offset: int, started: float):
+        """Progress report and checkpoint once the source is processed up to offset"""
+        self.stats.position = offset
+        self.stats.elapsed = time.monotonic() - started
+        self.stats.cache_avoided = self.source.cache_avoided + self.sink.cache_avoided
+        if self.queues:
+            self.stats.queue_fill = {queue.name: queue.fill for queue in self.queues}
+            self.stats.buffers_in_use = self.pool.in_use
+        if self.progress_callback:
+            self.progress_callback(self.stats)
+        if self.checkpoint_callback and offset < self.size and time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint_callback(self.checkpoint())
+            self.last_checkpoint = time.monotonic()
+
+    def _read_blocks(self, start: int, reads: StageQueue, reader: ParallelReader, stopping: threading.Event):
+        """Reading thread: every region from start, as (offset, buffer, count) items; buffer None for a zero region"""
+        try:
+            for offset, length, copy in self._plan(start):
+                if not copy:
+                    if not reads.put((offset, None, length), stopping.is_set):
+                        return
+                    continue
+                reader.start(offset, offset + length if length else None)
+                while True:
+                    buffer, count = reader.next()
+                    if buffer is None:
+                        break
+                    if not reads.put((reader.position - count, buffer, count), stopping.is_set):
+                        self.pool.release(buffer)
+                        return
+                if stopping.is_set() or (self.cancel_check and self.cancel_check()):
+                    return
+                if reader.exhausted:
+                    break
+            reads.put(None, stopping.is_set)
+        except BaseException as e:
+            self.failures.append(e)
+        finally:
+            reader.close()
+
+    def _write_blocks(self, writes: StageQueue, stopping: threading.Event):
+        """Writing thread: chunk lists go to the sink, buffers back to the pool once everything before them is written"""
+        while True:
+            item = writes.get(stopping.is_set)
+            if item is None:
+                return
+            try:
+                if isinstance(item, list):
+                    # After a failure or cancellation the queue is still drained, so no other thread waits for room
+                    if not self.failures and not stopping.is_set():
+                        self.stats.bytes_written += self.sink.write(item)
+                else:
+                    self.pool.release(item)
+            except BaseException as e:
+                self.failures.append(e)
+            finally:
+                writes.task_done()
+
+    def _run_pipelined(self, start: int, started: float):
+        """Copy from start with reading, stages and writing overlapped (see the class docstring)"""
+        depth = read_ahead_depth(self.block_size, self.queue_depth)
+        self.pool = BufferPool(self.block_size, max(self.buffer_memory // self.block_size, depth + 2))
+        reads = StageQueue("read", self.pool.count - depth)
+        self.write_queue = StageQueue("write", self.pool.count)
+        self.queues = [reads, self.write_queue]
+        stopping = threading.Event()
+
+        def stop_reading() -> bool:
+            return stopping.is_set() or bool(self.cancel_check and self.cancel_check())
+
+        # The reader tells the throttle how many of its reads are outstanding; blocks waiting in the queues are
+        # finished reads the disk no longer counts, so an adaptive limiter only reacts to other I/O
+        reader = ParallelReader(self.source, self.block_size, self.queue_depth, self.throttle, stop_reading, self.pool)
+        self.stats.queue_depth = reader.queue_depth
+        threads = [threading.Thread(target=self._read_blocks, args=(start, reads, reader, stopping), name="engine-read",
+                                    daemon=True),
+                   threading.Thread(target=self._write_blocks, args=(self.write_queue, stopping), name="engine-write",
+                                    daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = reads.get(lambda: self._failed() or bool(self.cancel_check and self.cancel_check()))
+                if self.failures:
+                    raise self.failures[0]
+                if self.cancel_check and self.cancel_check():
+                    raise CopyCancelled("Operation cancelled by user")
+                if item is None:
+                    break
+                offset, buffer, count = item
+                if buffer is None:
+                    # Unallocated region: passed downstream without reading it
+                    self._push([ZeroRun(count)])
+                else:
+                    self._push([buffer[:count]])
+                    # Queued behind the chunks made from it, so the buffer is only reused once they are written
+                    if not self.write_queue.put(buffer, self._failed):
+                        raise self.failures[0]
+                    self.stats.bytes_read += count
+                    self.stats.in_flight = reader.average_in_flight
+                self._after_block(offset + count, started)
+
+            self._flush_stages()
+            if not self.write_queue.join(self._failed):
+                raise self.failures[0]
+            if self.failures:
+                raise self.failures[0]
+        finally:
+            stopping.set()
+            for thread in threads:
+                thread.join()
+            self.stats.queue_fill = {queue.name: queue.average_fill for queue in self.queues}
+            self.write_queue = None
+
+    def _resume(self, view: memoryview, started: float):
+        state = self.resume_state
+        position = state["position"]
+        replayed = [index for index, stage in enumerate(self.stages) if stage.replay]
+        if replayed:
+            # Stages that cannot store their state see the stream up to the checkpoint again
+            end_stage = replayed[-1] + 1
+            for offset, length, copy in self._plan(stop=position):
+                if copy:
+                    self._copy_region(view, offset, length, started, end_stage)
+                else:
+                    self._push([ZeroRun(length)], end=end_stage)
+            self._checkpoint_stages(end_stage)
+        for stage, stage_state in zip(self.stages, state["stages"]):
+            stage.resume(stage_state)
+        self.sink.resume(state["sink"])
+        self.stats.position = position
+        self.stats.bytes_read = state["bytes_read"]
+        self.stats.bytes_written = state["bytes_written"]
+        return position
+
+    def _zero_copy_obstacle(self) -> Optional[str]:
+        """Why this copy cannot be done in the kernel, or None when it can"""
+        if self.cache_bypass:
+            return "the page cache is bypassed"
+        if self.stages:
+            names = ", ".join(stage.name for stage in self.stages)
+            return f"stages {names} need the data in user space" if len(self.stages) > 1 \
+                else f"stage {names} needs the data in user space"
+        if self.source.fileno() is None:
+            return "the source has no file descriptor"
+        return None
+
+    def run(self) -> EngineStats:
+        """Run the copy to completion and return final statistics"""
+        buffer = allocate_buffer(self.block_size)
+        view = memoryview(buffer)[:self.block_size]
+        started = time.monotonic()
+        self.last_checkpoint = started
+        if self.zero_copy:
+            self.zero_copy_skipped = self._zero_copy_obstacle()
+            if self.zero_copy_skipped is None:
+                self.copier = KernelCopier()
+        try:
+            start = self._resume(view, started) if self.resume_state else 0
+            if self.buffer_memory and self.copier is None:
+                if self.reader is not None:
+                    self.reader.close()
+                    self.reader = None
+                self._run_pipelined(start, started)
+            else:
+                for offset, length, copy in self._plan(start):
+                    if copy:
+                        if not self._copy_region(view, offset, length, started):
+                            break
+                    else:
+                        # Unallocated region: passed downstream without reading it
+                        self._push([ZeroRun(length)])
+                        self.stats.position = offset + length
+                self._flush_stages()
+            self.stats.elapsed = time.monotonic() - started
+            self.stats.cache_avoided = self.source.cache_avoided + self.sink.cache_avoided
+            return self.stats
+        finally:
+            if self.copier is not None:
+                self.copier.close()
+                self.copier = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+            for stage in self.stages:
+                stage.close()
@@ -0,0 +1,175 @@
+# dd_core/estimate.py
+
+"""
+Pre-flight estimate of image size and duration from sampled reads.
+
+A few hundred randomly spaced blocks of the source give the fraction of
+all-zero granules and the compression ratio and speed of the chosen
+codec; one sequential stretch gives the read throughput. Reads bypass
+the page cache so a recently read source does not look faster than it is.
+Incremental and deduplicated images can only be smaller than predicted.
+"""
+
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core.utils import format_duration, format_size
+from dd_core.compression import get_codec
+from dd_core.engine import CopyCancelled, Source, allocate_buffer
+from dd_core.sparse import ZERO_GRANULE
+
+DEFAULT_SAMPLES = 256
+SAMPLE_SIZE = 256 * 1024
+SEQUENTIAL_READ = 32 * 1024 * 1024
+SEQUENTIAL_BLOCK = 4 * 1024 * 1024
+SPACE_MARGIN = 1.05  # headers, manifests and estimation error
+
+_ZERO_GRANULE = bytes(ZERO_GRANULE)
+
+
+@dataclass
+class ImageEstimate:
+    data_size: int  # bytes the job reads (used extents only when enabled)
+    sampled_bytes: int
+    zero_fraction: float
+    compression_ratio: float  # compressed size of non-zero data / its size, 1.0 without compression
+    read_throughput: float  # bytes per second
+    compress_throughput: float  # bytes per second over all threads, 0 without compression
+    image_size: int
+    duration: float
+    free_space: Optional[int] = None
+
+    @property
+    def fits(self) -> bool:
+        return self.free_space is None or self.image_size * SPACE_MARGIN <= self.free_space
+
+    def summary(self) -> str:
+        parts = [f"~{format_size(self.image_size)}", f"~{format_duration(self.duration)}",
+                 f"{self.zero_fraction * 100:.0f}% zeros"]
+        if self.compression_ratio < 1.0:
+            parts.append(f"compresses to {self.compression_ratio * 100:.0f}%")
+        parts.append(f"reads at {format_size(self.read_throughput)}/s")
+        if self.free_space is not None:
+            parts.append(f"{format_size(self.free_space)} free on target")
+        return ", ".join(parts)
+
+
+def _filesystem_dir(path: str) -> str:
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory and not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return directory or "/"
+
+
+def free_space(path: str) -> Optional[int]:
+    """Bytes available to unprivileged users on the filesystem that will hold path"""
+    try:
+        st = os.statvfs(_filesystem_dir(path))
+    except OSError:
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+def _sample_offsets(regions: List[Tuple[int, int]], count: int, rng: random.Random) -> List[Tuple[int, int]]:
+    """count (offset, length) samples spread uniformly over the regions, in disk order"""
+    total = sum(length for _, length in regions)
+    if not total:
+        return []
+    samples = []
+    for _ in range(count):
+        point = rng.randrange(total)
+        for offset, length in regions:
+            if point < length:
+                start = offset + point // 4096 * 4096
+                samples.append((start, min(SAMPLE_SIZE, offset + length - start)))
+                break
+            point -= length
+    return sorted(set(samples))
+
+
+def _is_zero(data) -> bool:
+    return data == _ZERO_GRANULE[:len(data)]
+
+
+def estimate_image(source: Source, options: Dict[str, Any], target: Optional[str] = None,
+                   extents: Optional[List[Tuple[int, int]]] = None, samples: int = DEFAULT_SAMPLES,
+                   seed: Optional[int] = None, cancel_check: Optional[Callable[[], bool]] = None) -> ImageEstimate:
+    """Predict image size and duration for image creation options (the keys used by build_stages)"""
+    regions = extents if extents is not None else [(0, source.size)]
+    data_size = sum(length for _, length in regions)
+    rng = random.Random(seed)
+    buffer = memoryview(allocate_buffer(max(SAMPLE_SIZE, SEQUENTIAL_BLOCK)))
+
+    # Sequential throughput from one stretch in the middle of the data
+    read_bytes = 0
+    started = time.monotonic()
+    offset, length = max(regions, key=lambda region: region[1]) if regions else (0, 0)
+    position = offset + max(0, length - SEQUENTIAL_READ) // 2 // 4096 * 4096
+    end = min(offset + length, position + SEQUENTIAL_READ)
+    while position < end:
+        count = source.readinto(buffer[:min(SEQUENTIAL_BLOCK, end - position)], position)
+        if count == 0:
+            break
+        position += count
+        read_bytes += count
+    read_throughput = read_bytes / max(time.monotonic() - started, 1e-6)
+
+    compress = options.get('compress', False) or options.get('repository')
+    codec = get_codec(options.get('compress_codec', 'gzip')) if compress else None
+    level = options.get('compress_level') or (codec.default_level if codec else 0)
+    sampled = zero_bytes = nonzero_bytes = compressed_bytes = 0
+    compress_time = 0.0
+    for offset, length in _sample_offsets(regions, samples, rng):
+        if cancel_check and cancel_check():
+            raise CopyCancelled("Estimate cancelled by user")
+        count = source.readinto(buffer[:length], offset)
+        data = buffer[:count]
+        sampled += count
+        nonzero = bytearray()
+        for start in range(0, count, ZERO_GRANULE):
+            granule = data[start:start + ZERO_GRANULE]
+            if _is_zero(granule):
+                zero_bytes += len(granule)
+            else:
+                nonzero += granule
+        nonzero_bytes += len(nonzero)
+        if codec and nonzero:
+            compress_started = time.monotonic()
+            compressed_bytes += len(codec.compress(bytes(nonzero), level))
+            compress_time += time.monotonic() - compress_started
+
+    zero_fraction = zero_bytes / sampled if sampled else 0.0
+    compression_ratio = compressed_bytes / nonzero_bytes if codec and nonzero_bytes else 1.0
+    threads = options.get('compress_threads') or os.cpu_count() or 1
+    compress_throughput = nonzero_bytes / compress_time * threads if codec and compress_time else 0.0
+
+    # Zero granules cost nothing in sparse, zero-record and seekable images and next to nothing compressed
+    nonzero_size = data_size * (1 - zero_fraction)
+    skips_zeros = compress or options.get('sparse', False) or options.get('used_only', False) \
+        or options.get('parent_image')
+    image_size = int(nonzero_size * compression_ratio + (0 if skips_zeros else data_size - nonzero_size))
+
+    duration = data_size / read_throughput if read_throughput else 0.0
+    if compress_throughput:
+        duration = max(duration, nonzero_size / compress_throughput)
+
+    return ImageEstimate(data_size, sampled, zero_fraction, compression_ratio, read_throughput, compress_throughput,
+                         image_size, duration, free_space(target) if target else None)
+
+
+def space_shortfalls(estimates: List[Tuple[str, ImageEstimate]]) -> List[Tuple[str, int, int]]:
+    """(target directory, predicted bytes, free bytes) for every filesystem the images would not fit on together"""
+    groups: Dict[int, List[Tuple[str, ImageEstimate]]] = {}
+    for target, estimate in estimates:
+        if estimate.free_space is not None:
+            groups.setdefault(os.stat(_filesystem_dir(target)).st_dev, []).append((target, estimate))
+    shortfalls = []
+    for group in groups.values():
+        needed = int(sum(estimate.image_size for _, estimate in group) * SPACE_MARGIN)
+        free = group[0][1].free_space
+        if needed > free:
+            shortfalls.append((_filesystem_dir(group[0][0]), needed, free))
+    return shortfalls
@@ -0,0 +1,147 @@
+# dd_core/fanout.py
+
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+
+from dd_core.engine import EngineError, Sink, ZeroRun
+
+DEFAULT_RING_SIZE = 256 * 1024 * 1024
+DEFAULT_STALL_TIMEOUT = 30.0
+
+
+class FanOutTarget:
+    """One target of a fan-out copy and its writer state"""
+
+    def __init__(self, name: str, sink: Sink):
+        self.name = name
+        self.sink = sink
+        self.cursor = 0  # sequence number of the next ring item to write
+        self.written = 0
+        self.error: Optional[BaseException] = None
+        self.dropped = False
+
+    @property
+    def active(self) -> bool:
+        return self.error is None and not self.dropped
+
+    @property
+    def state(self) -> str:
+        if self.error is not None:
+            return f"failed: {self.error}"
+        if self.dropped:
+            return "dropped: too slow"
+        return "ok"
+
+
+class FanOutSink(Sink):
+    """Writes one stream to several sinks, each from its own writer thread
+
+    Every write is copied once into a shared ring of at most ring_size
+    bytes and every target consumes the ring at its own pace. The producer
+    only waits when the ring is full; a target that keeps it full for
+    stall_timeout seconds is dropped (None waits for it indefinitely), as
+    is a target whose sink raises, so neither stalls the others. close()
+    raises only when no target is left.
+    """
+
+    def __init__(self, targets: List[FanOutTarget], ring_size: int = DEFAULT_RING_SIZE,
+                 stall_timeout: Optional[float] = DEFAULT_STALL_TIMEOUT):
+        if not targets:
+            raise ValueError("Fan-out needs at least one target")
+        self.targets = targets
+        self.ring_size = ring_size
+        self.stall_timeout = stall_timeout
+        self.ring = deque()
+        self.ring_bytes = 0
+        self.base_seq = 0
+        self.next_seq = 0
+        self.total = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._writer, args=(target,), name=f"fanout-{target.name}", daemon=True)
+                        for target in targets]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def active_targets(self) -> List[FanOutTarget]:
+        return [target for target in self.targets if target.active]
+
+    def _writer(self, target: FanOutTarget):
+        while True:
+            with self.condition:
+                while target.active and target.cursor >= self.next_seq and not self.closed:
+                    self.condition.wait()
+                if not target.active or target.cursor >= self.next_seq:
+                    return
+                chunks = self.ring[target.cursor - self.base_seq]
+            try:
+                target.sink.write(chunks)
+            except Exception as e:
+                target.error = e
+            with self.condition:
+                target.cursor += 1
+                target.written += sum(len(chunk) for chunk in chunks)
+                self._trim()
+                self.condition.notify_all()
+
+    def _trim(self):
+        """Drop ring items every active target has written"""
+        active = self.active_targets
+        oldest = min((target.cursor for target in active), default=self.next_seq)
+        while self.base_seq < oldest:
+            chunks = self.ring.popleft()
+            self.ring_bytes -= sum(len(chunk) for chunk in chunks if not isinstance(chunk, ZeroRun))
+            self.base_seq += 1
+
+    def write(self, chunks: List) -> int:
+        # The engine reuses its buffers, so the ring keeps its own copy
+        chunks = [chunk if isinstance(chunk, ZeroRun) else bytes(chunk) for chunk in chunks]
+        size = sum(len(chunk) for chunk in chunks if not isinstance(chunk, ZeroRun))
+        with self.condition:
+            waiting_since = time.monotonic()
+            while self.ring and self.ring_bytes + size > self.ring_size:
+                if not self.active_targets:
+                    break
+                if self.stall_timeout is not None and time.monotonic() - waiting_since >= self.stall_timeout:
+                    # The targets still at the head of the ring hold everyone up
+                    for target in self.active_targets:
+                        if target.cursor == self.base_seq:
+                            target.dropped = True
+                    self._trim()
+                    self.condition.notify_all()
+                    waiting_since = time.monotonic()
+                    continue
+                self.condition.wait(0.5)
+            if not self.active_targets:
+                raise EngineError("All targets failed: " + "; ".join(f"{target.name}: {target.state}" for target in self.targets))
+            self.ring.append(chunks)
+            self.ring_bytes += size
+            self.next_seq += 1
+            self.total += sum(len(chunk) for chunk in chunks)
+            self.condition.notify_all()
+        return sum(len(chunk) for chunk in chunks)
+
+    def lag(self) -> int:
+        """Bytes the slowest remaining target is behind the source"""
+        with self.condition:
+            return self.total - min((target.written for target in self.active_targets), default=self.total)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for target, thread in zip(self.targets, self.threads):
+            # A dropped target may be stuck in a write; it is abandoned rather than waited for
+            thread.join(self.stall_timeout if target.dropped else None)
+            if thread.is_alive():
+                continue
+            try:
+                target.sink.close()
+            except Exception as e:
+                if target.error is None:
+                    target.error = e
+        if not self.active_targets:
+            raise EngineError("All targets failed: " + "; ".join(f"{target.name}: {target.state}" for target in self.targets))
@@ -0,0 +1,396 @@
+# dd_core/fsmaps.py
+
+"""
+Allocation maps of supported filesystems for used-blocks-only imaging.
+
+Every parser takes a read(offset, length) callable over the partition and
+returns a sorted list of (offset, length) byte extents that must be copied.
+Parsers are conservative: metadata and anything that cannot be proven free
+is reported as used.
+"""
+
+import re
+import struct
+from array import array
+from typing import Callable, List, Optional, Tuple
+
+Extent = Tuple[int, int]
+ReadFunc = Callable[[int, int], bytes]
+
+# Gaps smaller than this between used extents are copied anyway to keep reads large
+DEFAULT_MIN_GAP = 1024 * 1024
+
+_NONZERO_RUN = re.compile(rb"[^\x00]+")
+
+
+class FilesystemMapError(Exception):
+    """Raised when an allocation map is present but cannot be parsed"""
+
+
+def merge_extents(extents: List[Extent], min_gap: int = 0) -> List[Extent]:
+    """Sort extents and merge overlapping ones and those closer than min_gap"""
+    merged = []
+    for offset, length in sorted(e for e in extents if e[1] > 0):
+        if merged and offset <= merged[-1][0] + merged[-1][1] + min_gap:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def bitmap_to_extents(bitmap: bytes, unit: int, base: int = 0, nbits: Optional[int] = None) -> List[Extent]:
+    """Convert an LSB-first allocation bitmap to byte extents
+
+    Runs of non-zero bytes are found with a regex and trimmed to exact bit
+    positions at their edges; clear bits inside a run are reported as used.
+    """
+    if nbits is None:
+        nbits = len(bitmap) * 8
+    extents = []
+    for match in _NONZERO_RUN.finditer(bitmap):
+        first, last = match.start(), match.end() - 1
+        start_bit = first * 8 + ((bitmap[first] & -bitmap[first]).bit_length() - 1)
+        end_bit = min(nbits, last * 8 + bitmap[last].bit_length())
+        if start_bit < end_bit:
+            extents.append((base + start_bit * unit, (end_bit - start_bit) * unit))
+    return extents
+
+
+def _set_bits(bitmap: bytearray, start: int, count: int):
+    """Mark count bits starting at start as used"""
+    end = min(start + count, len(bitmap) * 8)
+    while start < end and start % 8:
+        bitmap[start // 8] |= 1 << (start % 8)
+        start += 1
+    full_bytes = (end - start) // 8
+    if full_bytes > 0:
+        bitmap[start // 8:start // 8 + full_bytes] = b"\xff" * full_bytes
+        start += full_bytes * 8
+    while start < end:
+        bitmap[start // 8] |= 1 << (start % 8)
+        start += 1
+
+
+def _or_bits(bitmap: bytearray, start: int, bits: bytes):
+    """OR an LSB-first bitmap into bitmap at bit position start"""
+    first = start // 8
+    length = min(len(bits) + 1, len(bitmap) - first)
+    if length <= 0:
+        return
+    value = int.from_bytes(bits, "little") << (start % 8)
+    value &= (1 << (length * 8)) - 1
+    current = int.from_bytes(bitmap[first:first + length], "little")
+    bitmap[first:first + length] = (current | value).to_bytes(length, "little")
+
+
+# ext2 / ext3 / ext4
+
+EXT_MAGIC = 0xEF53
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_FEATURE_INCOMPAT_META_BG = 0x10
+EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x1
+EXT4_BG_BLOCK_UNINIT = 0x2
+
+
+def _ext_has_super(group: int, sparse_super: bool) -> bool:
+    if not sparse_super or group <= 1:
+        return True
+    for base in (3, 5, 7):
+        value = base
+        while value < group:
+            value *= base
+        if value == group:
+            return True
+    return False
+
+
+def ext_used_extents(read: ReadFunc, size: int) -> Optional[List[Extent]]:
+    sb = read(1024, 1024)
+    if len(sb) < 1024 or struct.unpack_from("<H", sb, 56)[0] != EXT_MAGIC:
+        return None
+
+    blocks_lo, = struct.unpack_from("<I", sb, 4)
+    first_data_block, log_block_size = struct.unpack_from("<II", sb, 20)
+    blocks_per_group, = struct.unpack_from("<I", sb, 32)
+    inodes_per_group, = struct.unpack_from("<I", sb, 40)
+    incompat, ro_compat = struct.unpack_from("<II", sb, 96)
+    inode_size, = struct.unpack_from("<H", sb, 88)
+    reserved_gdt, = struct.unpack_from("<H", sb, 0xCE)
+    desc_size, = struct.unpack_from("<H", sb, 0xFE)
+    blocks_hi, = struct.unpack_from("<I", sb, 0x150)
+
+    if incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+        raise FilesystemMapError("ext4 meta_bg layout is not supported")
+
+    block_size = 1024 << log_block_size
+    is_64bit = bool(incompat & EXT4_FEATURE_INCOMPAT_64BIT)
+    blocks_count = blocks_lo | (blocks_hi << 32 if is_64bit else 0)
+    if not is_64bit or desc_size < 32:
+        desc_size = 32
+    if inode_size == 0:
+        inode_size = 128
+    group_count = -(-(blocks_count - first_data_block) // blocks_per_group)
+    gdt_blocks = -(-(group_count * desc_size) // block_size)
+    inode_table_blocks = -(-(inodes_per_group * inode_size) // block_size)
+    sparse_super = bool(ro_compat & EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER)
+
+    descriptors = read((first_data_block + 1) * block_size, gdt_blocks * block_size)
+    bitmap = bytearray(-(-blocks_count // 8))
+    _set_bits(bitmap, 0, first_data_block + 1 + gdt_blocks + reserved_gdt)
+
+    for group in range(group_count):
+        desc = descriptors[group * desc_size:(group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc, 0)
+        flags, = struct.unpack_from("<H", desc, 0x12)
+        if desc_size >= 64:
+            hi = struct.unpack_from("<III", desc, 0x20)
+            block_bitmap |= hi[0] << 32
+            inode_bitmap |= hi[1] << 32
+            inode_table |= hi[2] << 32
+
+        group_start = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks_count - group_start)
+
+        # Group metadata may live in another group (flex_bg), so mark it explicitly
+        _set_bits(bitmap, block_bitmap, 1)
+        _set_bits(bitmap, inode_bitmap, 1)
+        _set_bits(bitmap, inode_table, inode_table_blocks)
+        if _ext_has_super(group, sparse_super):
+            _set_bits(bitmap, group_start, 1 + gdt_blocks + reserved_gdt)
+
+        if flags & EXT4_BG_BLOCK_UNINIT:
+            continue
+
+        _or_bits(bitmap, group_start, read(block_bitmap * block_size, block_size)[:-(-group_blocks // 8)])
+
+    return bitmap_to_extents(bytes(bitmap), block_size, nbits=blocks_count)
+
+
+# FAT12 / FAT16 / FAT32
+
+def fat_used_extents(read: ReadFunc, size: int) -> Optional[List[Extent]]:
+    boot = read(0, 512)
+    if len(boot) < 512 or boot[510:512] != b"\x55\xaa" or boot[0] not in (0xEB, 0xE9):
+        return None
+
+    bytes_per_sector, sectors_per_cluster, reserved, fat_count, root_entries, total16 = struct.unpack_from("<HBHBHH", boot, 11)
+    fat_size16, = struct.unpack_from("<H", boot, 22)
+    total32, fat_size32 = struct.unpack_from("<II", boot, 32)
+    if bytes_per_sector not in (512, 1024, 2048, 4096) or sectors_per_cluster == 0 or fat_count == 0:
+        return None
+    if boot[54:57] != b"FAT" and boot[82:85] != b"FAT":
+        return None
+
+    fat_size = fat_size16 or fat_size32
+    total_sectors = total16 or total32
+    root_sectors = -(-(root_entries * 32) // bytes_per_sector)
+    data_start = (reserved + fat_count * fat_size + root_sectors) * bytes_per_sector
+    cluster_size = sectors_per_cluster * bytes_per_sector
+    cluster_count = (total_sectors * bytes_per_sector - data_start) // cluster_size
+
+    fat = read(reserved * bytes_per_sector, fat_size * bytes_per_sector)
+    if cluster_count < 4085:
+        entries = []
+        for cluster in range(cluster_count + 2):
+            pair = struct.unpack_from("<H", fat + b"\x00", cluster * 3 // 2)[0]
+            entries.append(pair >> 4 if cluster & 1 else pair & 0x0FFF)
+    elif cluster_count < 65525:
+        entries = array("H", fat[:(cluster_count + 2) * 2])
+    else:
+        entries = array("I", fat[:(cluster_count + 2) * 4])
+        entries = [entry & 0x0FFFFFFF for entry in entries]
+
+    used = bytes(1 if entry else 0 for entry in entries[2:cluster_count + 2])
+    extents = [(0, data_start)]
+    for match in _NONZERO_RUN.finditer(used):
+        extents.append((data_start + match.start() * cluster_size, (match.end() - match.start()) * cluster_size))
+    return extents
+
+
+# NTFS
+
+NTFS_BITMAP_RECORD = 6
+NTFS_ATTR_DATA = 0x80
+NTFS_ATTR_END = 0xFFFFFFFF
+NTFS_FIXUP_STRIDE = 512  # update sequence entries protect every 512 bytes, whatever the sector size
+
+
+def _ntfs_apply_fixups(record: bytearray) -> bytearray:
+    usa_offset, usa_count = struct.unpack_from("<HH", record, 4)
+    usn = record[usa_offset:usa_offset + 2]
+    for i in range(1, usa_count):
+        end = i * NTFS_FIXUP_STRIDE
+        if record[end - 2:end] != usn:
+            raise FilesystemMapError("NTFS MFT record fixup mismatch")
+        record[end - 2:end] = record[usa_offset + i * 2:usa_offset + i * 2 + 2]
+    return record
+
+
+def _ntfs_data_runs(runs: bytes) -> List[Tuple[int, int]]:
+    result = []
+    position = 0
+    lcn = 0
+    while position < len(runs) and runs[position]:
+        header = runs[position]
+        length_size, offset_size = header & 0x0F, header >> 4
+        position += 1
+        length = int.from_bytes(runs[position:position + length_size], "little")
+        position += length_size
+        if offset_size:
+            lcn += int.from_bytes(runs[position:position + offset_size], "little", signed=True)
+            result.append((lcn, length))
+        else:
+            result.append((None, length))
+        position += offset_size
+    return result
+
+
+def ntfs_used_extents(read: ReadFunc, size: int) -> Optional[List[Extent]]:
+    boot = read(0, 512)
+    if len(boot) < 512 or boot[3:11] != b"NTFS    ":
+        return None
+
+    bytes_per_sector, sectors_per_cluster = struct.unpack_from("<HB", boot, 11)
+    if sectors_per_cluster > 0x80:
+        sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+    total_sectors, mft_lcn = struct.unpack_from("<QQ", boot, 0x28)
+    clusters_per_record = struct.unpack_from("<b", boot, 0x40)[0]
+    cluster_size = bytes_per_sector * sectors_per_cluster
+    record_size = clusters_per_record * cluster_size if clusters_per_record > 0 else 1 << -clusters_per_record
+    cluster_count = total_sectors * bytes_per_sector // cluster_size
+
+    record = bytearray(read(mft_lcn * cluster_size + NTFS_BITMAP_RECORD * record_size, record_size))
+    if record[:4] != b"FILE":
+        raise FilesystemMapError("NTFS $Bitmap MFT record not found")
+    record = _ntfs_apply_fixups(record)
+
+    attr_offset, = struct.unpack_from("<H", record, 0x14)
+    runs = None
+    while attr_offset + 8 <= len(record):
+        attr_type, attr_length = struct.unpack_from("<II", record, attr_offset)
+        if attr_type == NTFS_ATTR_END or attr_length == 0:
+            break
+        if attr_type == NTFS_ATTR_DATA and record[attr_offset + 8]:
+            runs_offset, = struct.unpack_from("<H", record, attr_offset + 0x20)
+            runs = _ntfs_data_runs(bytes(record[attr_offset + runs_offset:attr_offset + attr_length]))
+            break
+        attr_offset += attr_length
+    if runs is None:
+        raise FilesystemMapError("NTFS $Bitmap has no non-resident data")
+
+    bitmap = bytearray()
+    for lcn, length in runs:
+        if lcn is None:
+            bitmap += bytes(length * cluster_size)
+        else:
+            bitmap += read(lcn * cluster_size, length * cluster_size)
+
+    extents = bitmap_to_extents(bytes(bitmap[:-(-cluster_count // 8)]), cluster_size, nbits=cluster_count)
+    # Boot sector and the backup boot sector past the last cluster
+    extents.append((0, cluster_size))
+    tail = cluster_count * cluster_size
+    if size > tail:
+        extents.append((tail, size - tail))
+    return extents
+
+
+# XFS
+
+XFS_SB_MAGIC = b"XFSB"
+XFS_AGF_MAGIC = b"XAGF"
+XFS_BNOBT_MAGICS = {b"ABTB": 16, b"AB3B": 56}
+
+
+def _xfs_free_extents(read: ReadFunc, ag_base: int, block_size: int, root: int) -> List[Tuple[int, int]]:
+    free = []
+    block = read(ag_base + root * block_size, block_size)
+    # Walk down the leftmost path to the first leaf
+    while True:
+        magic = block[:4]
+        if magic not in XFS_BNOBT_MAGICS:
+            raise FilesystemMapError("XFS free space btree block has bad magic")
+        header = XFS_BNOBT_MAGICS[magic]
+        level, count = struct.unpack_from(">HH", block, 4)
+        if level == 0:
+            break
+        max_records = (block_size - header) // 12
+        child, = struct.unpack_from(">I", block, header + max_records * 8)
+        block = read(ag_base + child * block_size, block_size)
+
+    # Then follow the right sibling chain across all leaves
+    while True:
+        header = XFS_BNOBT_MAGICS[block[:4]]
+        count, = struct.unpack_from(">H", block, 6)
+        right, = struct.unpack_from(">I", block, 12)
+        for i in range(count):
+            free.append(struct.unpack_from(">II", block, header + i * 8))
+        if right == 0xFFFFFFFF:
+            return free
+        block = read(ag_base + right * block_size, block_size)
+        if block[:4] not in XFS_BNOBT_MAGICS:
+            raise FilesystemMapError("XFS free space btree block has bad magic")
+
+
+def xfs_used_extents(read: ReadFunc, size: int) -> Optional[List[Extent]]:
+    sb = read(0, 512)
+    if len(sb) < 512 or sb[:4] != XFS_SB_MAGIC:
+        return None
+
+    block_size, = struct.unpack_from(">I", sb, 4)
+    dblocks, = struct.unpack_from(">Q", sb, 8)
+    ag_blocks, ag_count = struct.unpack_from(">II", sb, 84)
+    sector_size, = struct.unpack_from(">H", sb, 102)
+
+    extents = []
+    for ag in range(ag_count):
+        ag_base = ag * ag_blocks * block_size
+        ag_length = min(ag_blocks, dblocks - ag * ag_blocks)
+        agf = read(ag_base + sector_size, sector_size)
+        if agf[:4] != XFS_AGF_MAGIC:
+            raise FilesystemMapError(f"XFS AGF {ag} has bad magic")
+        bno_root, = struct.unpack_from(">I", agf, 16)
+
+        cursor = 0
+        for start, count in sorted(_xfs_free_extents(read, ag_base, block_size, bno_root)):
+            if start > cursor:
+                extents.append((ag_base + cursor * block_size, (start - cursor) * block_size))
+            cursor = max(cursor, start + count)
+        if ag_length > cursor:
+            extents.append((ag_base + cursor * block_size, (ag_length - cursor) * block_size))
+
+    # The log and anything past dblocks are kept whole
+    tail = dblocks * block_size
+    if size > tail:
+        extents.append((tail, size - tail))
+    return extents
+
+
+PARSERS = {
+    "ext2": ext_used_extents,
+    "ext3": ext_used_extents,
+    "ext4": ext_used_extents,
+    "ntfs": ntfs_used_extents,
+    "xfs": xfs_used_extents,
+    "vfat": fat_used_extents,
+    "fat": fat_used_extents,
+}
+
+
+def used_extents(read: ReadFunc, size: int, fstype: Optional[str] = None,
+                 min_gap: int = DEFAULT_MIN_GAP) -> Optional[List[Extent]]:
+    """Return merged used extents, or None when the filesystem is not supported
+
+    fstype is a hint (lsblk FSTYPE); without it every parser probes its magic.
+    """
+    if fstype and fstype in PARSERS:
+        candidates = [PARSERS[fstype]]
+    else:
+        candidates = list(dict.fromkeys(PARSERS.values()))
+
+    for parser in candidates:
+        extents = parser(read, size)
+        if extents is not None:
+            clipped = [(offset, min(length, size - offset)) for offset, length in extents if offset < size]
+            return merge_extents(clipped, min_gap)
+    return None
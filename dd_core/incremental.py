@@ -0,0 +1,186 @@
+# dd_core/incremental.py
+
+"""
+Block hash manifests and incremental images.
+
+<image>.blockmap (big-endian):
+
+    magic "HCBLKMAP", block size (I), source size (Q), block count (I),
+    then one 16 byte BLAKE2b digest per block
+
+An incremental image is an ordinary image of the whole source in which
+every block whose digest matches the parent's manifest was replaced by a
+zero run, so it costs nothing in sparse, zero-record or seekable images.
+The changed blocks are stored as its extent map and the header points to
+the parent, which restore applies first.
+"""
+
+import base64
+import hashlib
+import os
+import struct
+from typing import List, Optional, Tuple
+
+from dd_core.engine import ParallelChunkStage, ZeroRun
+
+BLOCK_MANIFEST_SUFFIX = ".blockmap"
+BLOCK_MANIFEST_MAGIC = b"HCBLKMAP"
+BLOCK_MANIFEST_HEADER = struct.Struct(">8sIQI")
+DEFAULT_HASH_BLOCK = 4 * 1024 * 1024
+DIGEST_SIZE = 16
+_ZEROS = bytes(4 * 1024 * 1024)
+
+
+def block_manifest_path(image_file: str) -> str:
+    return image_file + BLOCK_MANIFEST_SUFFIX
+
+
+def _digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def _is_zero(data) -> bool:
+    view = memoryview(data)
+    return all(_ZEROS.startswith(view[start:start + len(_ZEROS)]) for start in range(0, len(view), len(_ZEROS)))
+
+
+class BlockManifest:
+    """Per-block digests of one image"""
+
+    def __init__(self, block_size: int, source_size: int, digests: List[bytes]):
+        self.block_size = block_size
+        self.source_size = source_size
+        self.digests = digests
+
+    def write(self, image_file: str) -> str:
+        path = block_manifest_path(image_file)
+        with open(path, "wb") as f:
+            f.write(BLOCK_MANIFEST_HEADER.pack(BLOCK_MANIFEST_MAGIC, self.block_size, self.source_size, len(self.digests)))
+            f.write(b"".join(self.digests))
+        return path
+
+    @classmethod
+    def read(cls, image_file: str) -> "BlockManifest":
+        with open(block_manifest_path(image_file), "rb") as f:
+            data = f.read()
+        magic, block_size, source_size, count = BLOCK_MANIFEST_HEADER.unpack_from(data)
+        if magic != BLOCK_MANIFEST_MAGIC:
+            raise ValueError(f"{block_manifest_path(image_file)} is not a block manifest")
+        start = BLOCK_MANIFEST_HEADER.size
+        digests = [data[start + i * DIGEST_SIZE:start + (i + 1) * DIGEST_SIZE] for i in range(count)]
+        return cls(block_size, source_size, digests)
+
+
+class BlockHashStage(ParallelChunkStage):
+    """Hashes fixed-size blocks on a thread pool, optionally dropping blocks unchanged since a parent
+
+    Without a parent the stream passes through unchanged. With one, blocks
+    whose digest matches the parent's become ZeroRun markers.
+    """
+
+    name = "blockmap"
+    kind = "blockmap"
+
+    def __init__(self, block_size: int = DEFAULT_HASH_BLOCK, parent: Optional[BlockManifest] = None,
+                 threads: Optional[int] = None):
+        super().__init__(threads, block_size)
+        self.parent = parent
+        self.digests = {}
+        self.zero_digests = {}
+        self.changed_bytes = 0
+
+    def describe(self) -> dict:
+        return dict(super().describe(), block_size=self.chunk_size, incremental=self.parent is not None,
+                    changed_bytes=self.changed_bytes)
+
+    def _block_digest(self, data: bytes) -> bytes:
+        if _is_zero(data):
+            if len(data) not in self.zero_digests:
+                self.zero_digests[len(data)] = _digest(data)
+            return self.zero_digests[len(data)]
+        return _digest(data)
+
+    def transform_chunk(self, index: int, data: bytes, final: bool):
+        digest = self._block_digest(data)
+        self.digests[index] = digest
+        if self.parent is not None and index < len(self.parent.digests) and self.parent.digests[index] == digest:
+            return ZeroRun(len(data))
+        return data
+
+    def _collect(self, wait_all: bool = False) -> List:
+        output = super()._collect(wait_all)
+        self.changed_bytes += sum(len(chunk) for chunk in output if not isinstance(chunk, ZeroRun))
+        return output
+
+    def process(self, data) -> List:
+        if not isinstance(data, ZeroRun):
+            return super().process(data)
+        output = []
+        remaining = data.length
+        while remaining:
+            step = min(remaining, len(_ZEROS))
+            output.extend(super().process(memoryview(_ZEROS)[:step]))
+            remaining -= step
+        return output
+
+    def state(self) -> dict:
+        digests = b"".join(self.digests[i] for i in range(len(self.digests)))
+        return dict(super().state(), digests=base64.b64encode(digests).decode(), changed_bytes=self.changed_bytes)
+
+    def resume(self, state: dict):
+        super().resume(state)
+        digests = base64.b64decode(state["digests"])
+        self.digests = {i: digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] for i in range(len(digests) // DIGEST_SIZE)}
+        self.changed_bytes = state["changed_bytes"]
+
+    def manifest(self, source_size: int) -> BlockManifest:
+        return BlockManifest(self.chunk_size, source_size, [self.digests[i] for i in range(len(self.digests))])
+
+    def changed_extents(self, source_size: int) -> List[Tuple[int, int]]:
+        """Byte ranges of the blocks that differ from the parent"""
+        extents = []
+        for index in range(len(self.digests)):
+            parent = self.parent.digests[index] if index < len(self.parent.digests) else None
+            if self.digests[index] == parent:
+                continue
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, source_size - offset)
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+        return extents
+
+
+def load_parent(parent_image: str, source_size: Optional[int] = None) -> BlockManifest:
+    if not os.path.exists(block_manifest_path(parent_image)):
+        raise ValueError(f"Parent image {parent_image} has no block manifest ({BLOCK_MANIFEST_SUFFIX})")
+    manifest = BlockManifest.read(parent_image)
+    if source_size is not None and manifest.source_size != source_size:
+        raise ValueError(f"Parent image is {manifest.source_size} bytes, source is {source_size} bytes")
+    return manifest
+
+
+def parent_reference(image_file: str, parent_image: str) -> str:
+    """Parent path as stored in the header, relative when both images share a directory tree"""
+    return os.path.relpath(os.path.abspath(parent_image), os.path.dirname(os.path.abspath(image_file)))
+
+
+def resolve_parent(image_file: str, reference: str) -> str:
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(image_file)), reference))
+
+
+def intersect_extents(a: List[Tuple[int, int]], b: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Ranges covered by both sorted, non-overlapping extent lists"""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][0] + a[i][1], b[j][0] + b[j][1])
+        if start < end:
+            result.append((start, end - start))
+        if a[i][0] + a[i][1] < b[j][0] + b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
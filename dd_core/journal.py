@@ -0,0 +1,103 @@
+# dd_core/journal.py
+
+"""
+Checkpoint journal for resumable imaging.
+
+<target>.journal is a JSON document rewritten atomically at every engine
+checkpoint. It identifies the run (image file, source, source size,
+options, used extents) and holds the engine's resume state: the committed
+source offset, every stage's chunk counter with its buffered input and
+index or cipher header, and the sink's committed size. Hash stages store
+their digest at the checkpoint; a resumed run hashes the committed part
+again and refuses to continue if the source or the partial image changed.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from dd_core.splitter import fragment_path
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 1
+# Options that do not change the image, so a run may be resumed with different values
+_RUN_OPTIONS = ("resume", "cache_bypass", "rate_limit", "adaptive_throttle", "queue_depth", "buffer_memory")
+
+
+class JournalError(Exception):
+    """Raised when a journal is missing or belongs to a different run"""
+
+
+def journal_path(target_file: str) -> str:
+    return target_file + JOURNAL_SUFFIX
+
+
+def read_journal(target_file: str) -> Optional[Dict[str, Any]]:
+    """The journal left by an interrupted run, or None"""
+    try:
+        with open(journal_path(target_file), "r") as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return journal if journal.get("version") == JOURNAL_VERSION else None
+
+
+def _extents_digest(extents: Optional[List[Tuple[int, int]]]) -> Optional[str]:
+    if extents is None:
+        return None
+    hasher = hashlib.sha256()
+    for offset, length in extents:
+        hasher.update(struct.pack(">QQ", offset, length))
+    return hasher.hexdigest()
+
+
+class CheckpointJournal:
+    """Writes and validates the journal of one imaging run"""
+
+    def __init__(self, target_file: str, image_file: str, source: str, source_size: int, options: Dict[str, Any],
+                 extents: Optional[List[Tuple[int, int]]] = None):
+        self.path = journal_path(target_file)
+        self.target_file = target_file
+        self.identity = {
+            "image": image_file,
+            "source": source,
+            "source_size": source_size,
+            "options": {key: value for key, value in sorted(options.items()) if key not in _RUN_OPTIONS},
+            "extents": _extents_digest(extents),
+        }
+
+    def write(self, checkpoint: Dict[str, Any]):
+        """Atomically replace the journal; called after the sink was synced"""
+        journal = dict(self.identity, version=JOURNAL_VERSION, updated=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                       checkpoint=checkpoint)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def load(self) -> Dict[str, Any]:
+        """Checkpoint to resume from; raises JournalError unless the journal matches this run"""
+        journal = read_journal(self.target_file)
+        if journal is None:
+            raise JournalError(f"No usable checkpoint journal at {self.path}")
+        for key, value in self.identity.items():
+            if json.loads(json.dumps(value)) != journal.get(key):
+                raise JournalError(f"Checkpoint journal does not match this run ({key} differs)")
+        if not os.path.exists(journal["image"]) and not os.path.exists(fragment_path(journal["image"], 0)):
+            raise JournalError(f"Partial image {journal['image']} is missing")
+        return journal["checkpoint"]
+
+    def remove(self):
+        for path in (self.path, self.path + ".tmp"):
+            if os.path.exists(path):
+                os.unlink(path)
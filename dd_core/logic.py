@@ -1,56 +1,187 @@
 # dd_core/logic.py
 
-import subprocess
+import sys
 
-def clone_disk(source, target, block_size="4M", dry_run=False, show_progress=True, verify=False):
+from core.utils import parse_size, format_size
+from dd_core.engine import CopyEngine, DEFAULT_BLOCK_SIZE, DeviceSource, FileSink
+from dd_core.fanout import DEFAULT_STALL_TIMEOUT, FanOutSink, FanOutTarget
+from dd_core.progress import ProgressTracker
+from dd_core.throttle import AdaptiveRateLimiter, RateLimiter
+from dd_core.tuning import tuned_settings
+from dd_core.verify import HashingSink, HashStage, ReadBackSink, VerificationError
+
+
+def _target_sink(target, verify, hash_algorithm, cache_bypass=False):
+    sink = ReadBackSink(FileSink(target, direct=cache_bypass)) if verify else FileSink(target, direct=cache_bypass)
+    return HashingSink(sink, hash_algorithm) if verify else sink
+
+
+def _read_settings(source, block_size, queue_depth, dry_run):
+    """Block size in bytes and read queue depth; what was not given is tuned for the source disk"""
+    block_bytes = parse_size(block_size) if block_size is not None else DEFAULT_BLOCK_SIZE
+    depth = queue_depth or 1
+    if dry_run or (block_size is not None and queue_depth is not None):
+        return block_bytes, depth
+    try:
+        tuning = tuned_settings(source)
+    except OSError as e:
+        print(f"⚠️ Auto-tuning skipped ({e}), using {format_size(block_bytes)} blocks")
+        return block_bytes, depth
+    if not tuning.cached and tuning.throughput:
+        print(f"Tuned {source}: {format_size(tuning.block_size)} blocks, queue depth {tuning.queue_depth} "
+              f"({format_size(tuning.throughput)}/s)")
+    return (block_bytes if block_size is not None else tuning.block_size,
+            depth if queue_depth is not None else tuning.queue_depth)
+
+
+def clone_disk(source, target, block_size=None, dry_run=False, show_progress=True, verify=False, hash_algorithm="sha256",
+               stall_timeout=DEFAULT_STALL_TIMEOUT, cache_bypass=False, rate_limit=None, adaptive=False, queue_depth=None):
     """
-    Clone a disk using the `dd` command.
+    Clone a disk using the in-process copy engine.
+
+    With a list of targets the source is read once and every target is
+    written by its own thread; a target that fails or stays stall_timeout
+    seconds behind the others is dropped and the rest carry on.
 
     Args:
         source (str): Source device path (e.g. /dev/sdX)
-        target (str): Target device path (e.g. /dev/sdY)
-        block_size (str): Block size for dd (default: 4M)
-        dry_run (bool): If True, don't run dd – just print it
-        show_progress (bool): If True, adds 'status=progress'
-        verify (bool): Placeholder for future verification step
+        target (str | list): Target device path(s) (e.g. /dev/sdY)
+        block_size (str): Block size for reads and writes (default: tuned for the source disk, cached per device)
+        dry_run (bool): If True, don't copy – just print the plan
+        show_progress (bool): If True, print progress while copying
+        verify (bool): If True, hash the source inline and read back the target behind the writer
+        hash_algorithm (str): Hash used for the source digest (sha256, blake2b, xxh3)
+        stall_timeout (float): Seconds a fan-out target may hold up the others before it is dropped
+        cache_bypass (bool): If True, use direct I/O so the copy does not fill the page cache
+        rate_limit (str): Bandwidth cap per second (e.g. 50M), None for unlimited
+        adaptive (bool): If True, also back off while other I/O on the source disk is being delayed
+        queue_depth (int): Reads kept in flight at once (default: tuned for the source disk, cached per device)
     """
-    dd_command = [
-        "dd",
-        f"if={source}",
-        f"of={target}",
-        f"bs={block_size}"
-    ]
+    rate = parse_size(rate_limit) if rate_limit else 0
+    throttle = AdaptiveRateLimiter(source, rate) if adaptive else RateLimiter(rate) if rate else None
+    if not isinstance(target, str):
+        return _clone_many(source, list(target), block_size, dry_run, show_progress, verify, hash_algorithm, stall_timeout,
+                           cache_bypass, throttle, queue_depth)
 
-    if show_progress:
-        dd_command.append("status=progress")
+    block_bytes, depth = _read_settings(source, block_size, queue_depth, dry_run)
+    if block_bytes <= 0:
+        print(f"❌ Invalid block size: {block_size}")
+        return
 
     if dry_run:
-        print("Dry run: would execute command:")
-        print(" ".join(dd_command))
+        print("Dry run: would copy:")
+        print(f"{source} -> {target} (block size {format_size(block_bytes) if block_size else 'auto-tuned'})")
         return
 
-    print(f"Running: {' '.join(dd_command)}")
+    print(f"Cloning: {source} -> {target} (block size {format_size(block_bytes)}, queue depth {depth})")
+
+    tracker = None
+
+    def report(stats):
+        progress = tracker.update(stats.position)
+        if progress is not None:
+            sys.stdout.write(f"\r{progress.status()}\033[K")
+            sys.stdout.flush()
+
+    stages = [HashStage(hash_algorithm)] if verify else []
 
     try:
-        process = subprocess.Popen(
-            dd_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True
-        )
+        # The target is only created once the source is open, and closed again if anything after it fails
+        with DeviceSource(source, direct=cache_bypass) as src, FileSink(target, direct=cache_bypass) as sink:
+            with (ReadBackSink(sink) if verify else sink) as dst:
+                tracker = ProgressTracker(src.size)
+                engine = CopyEngine(src, dst, stages, block_size=block_bytes,
+                                    progress_callback=report if show_progress else None, cache_bypass=cache_bypass,
+                                    throttle=throttle, queue_depth=depth)
+                stats = engine.run()
 
-        for line in process.stdout:
-            print(line.strip())
+        if show_progress:
+            print(f"\r{tracker.update(stats.position, force=True).status()}\033[K")
+        print("✅ Cloning completed successfully.")
+        if cache_bypass:
+            print(f"Page cache avoided: {format_size(src.cache_avoided + dst.cache_avoided)}")
+        if verify:
+            print(f"🔍 Verification passed ({hash_algorithm}: {stages[0].hexdigest()})")
 
-        process.wait()
+    except VerificationError as e:
+        print(f"\n❌ Verification failed: {e}")
+    except Exception as e:
+        print(f"❌ Error while cloning: {e}")
 
-        if process.returncode == 0:
-            print("✅ Cloning completed successfully.")
-        else:
-            print(f"❌ Cloning failed with exit code {process.returncode}")
 
+def _clone_many(source, targets, block_size, dry_run, show_progress, verify, hash_algorithm, stall_timeout, cache_bypass,
+                throttle, queue_depth):
+    block_bytes, depth = _read_settings(source, block_size, queue_depth, dry_run)
+    if block_bytes <= 0:
+        print(f"❌ Invalid block size: {block_size}")
+        return
+    if not targets or len(set(targets)) != len(targets) or source in targets:
+        print("❌ Targets must be distinct and must not include the source")
+        return
+
+    if dry_run:
+        print("Dry run: would copy:")
+        for target in targets:
+            print(f"{source} -> {target} (block size {format_size(block_bytes) if block_size else 'auto-tuned'})")
+        return
+
+    print(f"Cloning: {source} -> {len(targets)} targets (block size {format_size(block_bytes)}, queue depth {depth})")
+
+    tracker = None
+    fanout = None
+
+    def report(stats):
+        progress = tracker.update(stats.position)
+        if progress is not None:
+            sys.stdout.write(f"\r{progress.status()}, {len(fanout.active_targets)}/{len(targets)} targets,"
+                             f" slowest {format_size(fanout.lag())} behind\033[K")
+            sys.stdout.flush()
+
+    stages = [HashStage(hash_algorithm)] if verify else []
+    fan_targets = []
+
+    try:
+        for target in targets:
+            try:
+                fan_targets.append(FanOutTarget(target, _target_sink(target, verify, hash_algorithm, cache_bypass)))
+            except Exception as e:
+                print(f"❌ {target}: {e}")
+        if not fan_targets:
+            print("❌ Error while cloning: no target could be opened")
+            return
+        with DeviceSource(source, direct=cache_bypass) as src:
+            tracker = ProgressTracker(src.size)
+            fanout = FanOutSink(fan_targets, stall_timeout=stall_timeout)
+            try:
+                engine = CopyEngine(src, fanout, stages, block_size=block_bytes,
+                                    progress_callback=report if show_progress else None, cache_bypass=cache_bypass,
+                                    throttle=throttle, queue_depth=depth)
+                stats = engine.run()
+            finally:
+                fanout.close()
+
+        if show_progress:
+            print(f"\r{tracker.update(stats.position, force=True).status()}\033[K")
     except Exception as e:
-        print(f"❌ Error while running dd: {e}")
+        if fanout is None:
+            for target in fan_targets:
+                target.sink.close()
+        print(f"\n❌ Error while cloning: {e}")
+        return
 
+    source_digest = stages[0].hexdigest() if verify else None
+    ok = 0
+    for target in fan_targets:
+        if not target.active:
+            print(f"❌ {target.name}: {target.state} after {format_size(target.written)}")
+        elif verify and target.sink.hexdigest() != source_digest:
+            print(f"❌ {target.name}: verification failed ({hash_algorithm}: {target.sink.hexdigest()})")
+        else:
+            ok += 1
+            print(f"✅ {target.name}: {format_size(target.written)} written"
+                  + (f", verified ({hash_algorithm}: {target.sink.hexdigest()})" if verify else ""))
+    print(f"{'✅' if ok == len(targets) else '❌'} Cloned to {ok} of {len(targets)} targets.")
     if verify:
-        print("🔍 Verification not implemented yet.")
+        print(f"🔍 Source {hash_algorithm}: {source_digest}")
+    if cache_bypass:
+        print(f"Page cache avoided: {format_size(src.cache_avoided + sum(t.sink.cache_avoided for t in fan_targets))}")
@@ -0,0 +1,181 @@
+# dd_core/pipeline.py
+
+import json
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from dd_core.compression import CodecStage
+from dd_core.crypto import AEADEncryptStage, aead_available
+from dd_core.engine import ParallelChunkStage, Stage
+from dd_core.incremental import DEFAULT_HASH_BLOCK, BlockHashStage, load_parent
+from dd_core.seekable import SeekableCompressStage
+from dd_core.sparse import ZeroDetectStage
+from dd_core.stages import OpenSSLEncryptStage
+from dd_core.verify import HashStage
+
+HEADER_VERSION = 1
+HEADER_SUFFIX = ".header.json"
+EXTENT_MAP_SUFFIX = ".extents"
+EXTENT_RECORD = struct.Struct(">QQ")
+
+# Canonical stage order between the source reader and the sink. Compression
+# must run before encryption: ciphertext is incompressible. The source digest
+# is taken first, over the full stream; block hashing follows it, since
+# incremental images pass unchanged blocks on as zero runs.
+STAGE_ORDER = ("hash", "blockmap", "zero", "compress", "encrypt", "split", "dedup")
+# Headers written before the digest moved ahead of block hashing
+LEGACY_STAGE_ORDER = ("blockmap", "hash") + STAGE_ORDER[2:]
+
+
+class PipelineError(Exception):
+    """Raised when a stage graph is invalid"""
+
+
+def validate_stage_order(kinds: List[str], order: Tuple[str, ...] = STAGE_ORDER):
+    """Raise PipelineError unless kinds follow order without repeats"""
+    last = -1
+    for kind in kinds:
+        if kind not in order:
+            raise PipelineError(f"Unknown pipeline stage: {kind}")
+        index = order.index(kind)
+        if index <= last:
+            raise PipelineError(f"Invalid pipeline order: {' -> '.join(kinds)} (expected {' -> '.join(order)})")
+        last = index
+
+
+def build_stages(options: Dict[str, Any], encryption_password: Optional[str] = None, source_size: Optional[int] = None,
+                 cpu_budget: Optional[threading.Semaphore] = None) -> List[Stage]:
+    """Build the ordered stage list for image creation options
+
+    cpu_budget is shared with the stages of concurrently running jobs.
+    """
+    stages = {}
+
+    if options.get('verify', False):
+        stages['hash'] = HashStage(options.get('hash_algorithm', 'sha256'))
+
+    if options.get('parent_image'):
+        parent = load_parent(options['parent_image'], source_size)
+        stages['blockmap'] = BlockHashStage(parent.block_size, parent, threads=options.get('compress_threads'))
+    elif options.get('block_manifest', False):
+        stages['blockmap'] = BlockHashStage(DEFAULT_HASH_BLOCK, threads=options.get('compress_threads'))
+
+    # A repository compresses and deduplicates chunks itself; transformed streams would not deduplicate
+    if options.get('repository'):
+        ordered = [stages[kind] for kind in STAGE_ORDER if kind in stages]
+        validate_stage_order([stage.kind for stage in ordered])
+        return _share_budget(ordered, cpu_budget)
+
+    # Seekable compression flags zero chunks in its index and takes zero runs itself
+    seekable = options.get('compress', False) and options.get('seekable', False)
+
+    # Used-blocks-only and incremental imaging pass skipped blocks as zero runs, so they need the zero stage too
+    if (options.get('sparse', False) or options.get('used_only', False) or options.get('parent_image')) and not seekable:
+        # Raw images get real holes; anything transformed afterwards gets zero-run records
+        transformed = options.get('compress', False) or options.get('encrypt', False)
+        stages['zero'] = ZeroDetectStage("records" if transformed else "sparse")
+
+    if options.get('compress', False):
+        compress_class = SeekableCompressStage if seekable else CodecStage
+        stages['compress'] = compress_class(options.get('compress_codec', 'gzip'), level=options.get('compress_level'),
+                                            threads=options.get('compress_threads'),
+                                            chunk_size=options.get('compress_chunk_size', 4) * 1024 * 1024)
+
+    if options.get('encrypt', False) and encryption_password:
+        if aead_available():
+            stages['encrypt'] = AEADEncryptStage(encryption_password, options.get('encrypt_cipher', 'aes-256-gcm'),
+                                                 threads=options.get('compress_threads'))
+        else:
+            # Without the cryptography package fall back to serial openssl CBC
+            stages['encrypt'] = OpenSSLEncryptStage(encryption_password)
+
+    ordered = [stages[kind] for kind in STAGE_ORDER if kind in stages]
+    validate_stage_order([stage.kind for stage in ordered])
+    return _share_budget(ordered, cpu_budget)
+
+
+def _share_budget(stages: List[Stage], cpu_budget: Optional[threading.Semaphore]) -> List[Stage]:
+    for stage in stages:
+        if isinstance(stage, ParallelChunkStage):
+            stage.cpu_budget = cpu_budget
+    return stages
+
+
+def output_path(target_file: str, stages: List[Stage]) -> str:
+    return target_file + "".join(stage.suffix for stage in stages)
+
+
+def header_path(image_file: str) -> str:
+    return image_file + HEADER_SUFFIX
+
+
+def write_header(image_file: str, source: str, source_size: int, block_size: int, stages: List[Stage],
+                 extra: Optional[Dict[str, Any]] = None) -> str:
+    """Write the sidecar header describing how image_file was produced"""
+    header = {
+        "version": HEADER_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "source": source,
+        "source_size": source_size,
+        "block_size": block_size,
+        "stages": [stage.describe() for stage in stages],
+    }
+    if extra:
+        header.update(extra)
+
+    path = header_path(image_file)
+    with open(path, "w") as f:
+        json.dump(header, f, indent=2)
+    return path
+
+
+def extent_map_path(image_file: str) -> str:
+    return image_file + EXTENT_MAP_SUFFIX
+
+
+def write_extent_map(image_file: str, extents: List[Tuple[int, int]]) -> str:
+    """Store the used extents of a used-blocks-only image next to it"""
+    path = extent_map_path(image_file)
+    with open(path, "wb") as f:
+        for offset, length in extents:
+            f.write(EXTENT_RECORD.pack(offset, length))
+    return path
+
+
+def read_extent_map(image_file: str) -> List[Tuple[int, int]]:
+    with open(extent_map_path(image_file), "rb") as f:
+        data = f.read()
+    return [EXTENT_RECORD.unpack_from(data, i) for i in range(0, len(data), EXTENT_RECORD.size)]
+
+
+def read_header(image_file: str) -> Dict[str, Any]:
+    """Read and validate the sidecar header of image_file"""
+    with open(header_path(image_file), "r") as f:
+        header = json.load(f)
+
+    if header.get("version") != HEADER_VERSION:
+        raise PipelineError(f"Unsupported image header version: {header.get('version')}")
+    kinds = [stage["kind"] for stage in header.get("stages", [])]
+    validate_stage_order(kinds, LEGACY_STAGE_ORDER if _legacy_order(kinds) else STAGE_ORDER)
+    return header
+
+
+def _legacy_order(kinds: List[str]) -> bool:
+    return "blockmap" in kinds and "hash" in kinds and kinds.index("blockmap") < kinds.index("hash")
+
+
+def records_source_digest(header: Dict[str, Any]) -> bool:
+    """Whether the header's hash stage covers the full source stream
+
+    Incremental images written in the legacy order hashed the stream after
+    block hashing had replaced the unchanged blocks with zero runs.
+    """
+    kinds = [stage["kind"] for stage in header.get("stages", [])]
+    return "hash" in kinds and not (header.get("parent") and _legacy_order(kinds))
+
+
+def restore_order(header: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Stages to undo on restore, outermost (last applied) first"""
+    return list(reversed(header.get("stages", [])))
@@ -0,0 +1,73 @@
+# dd_core/progress.py
+
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from core.utils import format_duration, format_size
+
+DEFAULT_INTERVAL = 0.2
+DEFAULT_SMOOTHING = 0.3
+
+
+@dataclass
+class ProgressReport:
+    done: int
+    total: int
+    elapsed: float
+    rate: float  # smoothed bytes per second
+    eta: Optional[float]  # seconds, None while unknown
+
+    @property
+    def percent(self) -> int:
+        return min(100, int(self.done * 100 / self.total)) if self.total > 0 else 0
+
+    def status(self) -> str:
+        status = f"Progress: {self.percent}% - {format_size(self.done)}"
+        if self.total > 0:
+            status += f" of {format_size(self.total)}"
+        status += f" - Speed: {self.rate / (1024 ** 2):.1f} MB/s"
+        if self.eta is not None:
+            status += f" - ETA: {format_duration(self.eta)}"
+        return status
+
+
+class ProgressTracker:
+    """Turns exact byte counters into throttled progress reports
+
+    The rate is an exponentially weighted moving average of the throughput
+    between reports, so the ETA follows the current speed (e.g. a slower
+    end of the disk, or a run of zero blocks) rather than the average over
+    the whole copy.
+    """
+
+    def __init__(self, total: int, interval: float = DEFAULT_INTERVAL, smoothing: float = DEFAULT_SMOOTHING,
+                 clock: Callable[[], float] = time.monotonic, done: int = 0):
+        self.total = total
+        self.interval = interval
+        self.smoothing = smoothing
+        self.clock = clock
+        self.started = clock()
+        self.last_time = self.started
+        # A resumed copy starts counting from its checkpoint
+        self.first_done = done
+        self.last_done = done
+        self.rate = 0.0
+
+    def update(self, done: int, force: bool = False) -> Optional[ProgressReport]:
+        """Record done bytes; returns a report at most once per interval (or when forced)"""
+        now = self.clock()
+        delta = now - self.last_time
+        if delta < self.interval and not force:
+            return None
+
+        if delta > 0:
+            sample = (done - self.last_done) / delta
+            self.rate = sample if self.last_done == self.first_done else self.smoothing * sample + (1 - self.smoothing) * self.rate
+        self.last_time = now
+        self.last_done = done
+
+        eta = None
+        if self.total > 0 and self.rate > 0:
+            eta = max(0.0, (self.total - done) / self.rate)
+        return ProgressReport(done, self.total, now - self.started, self.rate, eta)
@@ -0,0 +1,275 @@
+# dd_core/rescue.py
+
+"""
+Rescue imaging of failing disks.
+
+The copy runs in passes over a map of the source. The first pass reads
+large blocks and, after a read error or a slow read, skips ahead (twice as
+far after every consecutive failure) instead of grinding through the bad
+area. Later passes return to the skipped ranges with smaller and smaller
+blocks; what still fails at sector size is marked bad. Readable data is
+written to the same offset of a raw image, unreadable areas stay zero.
+
+<image>.rescuemap records every range as untried (?), skipped (*), bad (-)
+or good (+), one "offset length status" line per range in hex, and is
+rewritten atomically every few seconds, so an interrupted rescue continues
+where it stopped.
+"""
+
+import bisect
+import errno
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dd_core.engine import CopyCancelled, DEFAULT_BLOCK_SIZE, EngineStats, FileSink, Source, allocate_buffer
+
+RESCUE_MAP_SUFFIX = ".rescuemap"
+UNTRIED = "?"
+SKIPPED = "*"
+BAD = "-"
+GOOD = "+"
+STATUSES = (UNTRIED, SKIPPED, BAD, GOOD)
+SECTOR_SIZE = 512
+DEFAULT_SLOW_READ = 2.0
+DEFAULT_MAX_SKIP = 1024 * 1024 * 1024
+MAP_SAVE_INTERVAL = 5.0
+
+# Errors a failing medium reports for unreadable sectors; anything else aborts the rescue
+_MEDIA_ERRORS = {errno.EIO, errno.ENODATA, errno.ENXIO, errno.EILSEQ, errno.ETIMEDOUT}
+
+
+def rescue_map_path(image_file: str) -> str:
+    return image_file + RESCUE_MAP_SUFFIX
+
+
+class RescueMap:
+    """Status of every byte range of the source, as sorted (offset, length, status) entries"""
+
+    def __init__(self, size: int, source: str = "", entries: Optional[List[Tuple[int, int, str]]] = None):
+        self.size = size
+        self.source = source
+        self.entries = entries if entries is not None else [(0, size, UNTRIED)] if size else []
+
+    def mark(self, offset: int, length: int, status: str):
+        end = min(offset + length, self.size)
+        if end <= offset:
+            return
+        first = max(0, bisect.bisect_right(self.entries, (offset, math.inf)) - 1)
+        last = bisect.bisect_left(self.entries, (end,))
+        head, tail = self.entries[first], self.entries[last - 1]
+        replacement = []
+        if head[0] < offset:
+            replacement.append((head[0], offset - head[0], head[2]))
+        replacement.append((offset, end - offset, status))
+        if tail[0] + tail[1] > end:
+            replacement.append((end, tail[0] + tail[1] - end, tail[2]))
+        # Merge with the neighbours on both sides
+        start, stop = max(0, first - 1), min(len(self.entries), last + 1)
+        window = self.entries[start:first] + replacement + self.entries[last:stop]
+        merged = [window[0]]
+        for entry in window[1:]:
+            previous = merged[-1]
+            if previous[2] == entry[2]:
+                merged[-1] = (previous[0], previous[1] + entry[1], previous[2])
+            else:
+                merged.append(entry)
+        self.entries[start:stop] = merged
+
+    def ranges(self, status: str) -> List[Tuple[int, int]]:
+        return [(offset, length) for offset, length, entry_status in self.entries if entry_status == status]
+
+    def totals(self) -> Dict[str, int]:
+        totals = dict.fromkeys(STATUSES, 0)
+        for _, length, status in self.entries:
+            totals[status] += length
+        return totals
+
+    def save(self, path: str):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(f"# Rescue map of {self.source}\n# size 0x{self.size:x}\n")
+            for offset, length, status in self.entries:
+                f.write(f"0x{offset:x} 0x{length:x} {status}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str, size: int, source: str = "") -> Optional["RescueMap"]:
+        """The map left by an earlier run, or None when there is none for a source of this size"""
+        try:
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        entries = []
+        map_size = None
+        for line in lines:
+            if line.startswith("# size "):
+                map_size = int(line[7:], 16)
+            elif line and not line.startswith("#"):
+                offset, length, status = line.split()
+                if status not in STATUSES:
+                    return None
+                entries.append((int(offset, 16), int(length, 16), status))
+        if map_size != size or sum(length for _, length, _ in entries) != size:
+            return None
+        return cls(size, source, entries)
+
+
+class FaultySource(Source):
+    """Source wrapper simulating a failing disk, for testing rescue mode
+
+    Reads overlapping a bad range raise EIO (after failure_delay seconds,
+    as real drives retry internally), reads overlapping a slow range take
+    its extra delay.
+    """
+
+    def __init__(self, inner: Source, bad: Optional[List[Tuple[int, int]]] = None,
+                 slow: Optional[List[Tuple[int, int, float]]] = None, failure_delay: float = 0.0):
+        self.inner = inner
+        self.size = inner.size
+        self.bad = bad or []
+        self.slow = slow or []
+        self.failure_delay = failure_delay
+        self.reads = 0
+        self.failures = 0
+
+    def readinto(self, buffer: memoryview, offset: int) -> int:
+        self.reads += 1
+        end = offset + len(buffer)
+        if any(start < end and offset < start + length for start, length in self.bad):
+            self.failures += 1
+            time.sleep(self.failure_delay)
+            raise OSError(errno.EIO, "Input/output error (injected)")
+        for start, length, delay in self.slow:
+            if start < end and offset < start + length:
+                time.sleep(delay)
+        return self.inner.readinto(buffer, offset)
+
+    def close(self):
+        self.inner.close()
+
+
+class RescueCopier:
+    """Copies a failing source into a raw image in passes driven by a RescueMap"""
+
+    def __init__(self, source: Source, sink: FileSink, rescue_map: RescueMap, map_path: str,
+                 block_size: int = DEFAULT_BLOCK_SIZE, sector_size: int = SECTOR_SIZE,
+                 slow_read: float = DEFAULT_SLOW_READ, max_skip: int = DEFAULT_MAX_SKIP, retries: int = 0,
+                 progress_callback: Optional[Callable[[EngineStats], None]] = None,
+                 cancel_check: Optional[Callable[[], bool]] = None):
+        self.source = source
+        self.sink = sink
+        self.map = rescue_map
+        self.map_path = map_path
+        self.block_size = block_size
+        self.sector_size = sector_size
+        self.slow_read = slow_read
+        self.max_skip = max_skip
+        self.retries = retries
+        self.progress_callback = progress_callback
+        self.cancel_check = cancel_check
+        self.buffer = memoryview(allocate_buffer(block_size))[:block_size]
+        self.stats = EngineStats()
+        self.started = 0.0
+        self.last_save = 0.0
+        self.passes = 0
+
+    def _save_map(self, force: bool = False):
+        if force or time.monotonic() - self.last_save >= MAP_SAVE_INTERVAL:
+            # Data first, so the map never claims ranges that are not on disk
+            self.sink.sync()
+            self.map.save(self.map_path)
+            self.last_save = time.monotonic()
+
+    def _report(self):
+        totals = self.map.totals()
+        self.stats.position = totals[GOOD] + totals[BAD]
+        self.stats.elapsed = time.monotonic() - self.started
+        if self.progress_callback:
+            self.progress_callback(self.stats)
+        self._save_map()
+
+    def _try(self, offset: int, length: int, failed: str) -> str:
+        """Read one block into the image, marking it good or failed; returns 'ok', 'slow' or 'error'"""
+        if self.cancel_check and self.cancel_check():
+            raise CopyCancelled("Operation cancelled by user")
+        started = time.monotonic()
+        try:
+            count = self.source.readinto(self.buffer[:length], offset)
+        except OSError as e:
+            if e.errno not in _MEDIA_ERRORS:
+                raise
+            count = 0
+        if count:
+            self.sink.write_at(self.buffer[:count], offset)
+            self.stats.bytes_read += count
+            self.stats.bytes_written += count
+            self.map.mark(offset, count, GOOD)
+        if count < length:
+            # A short read means the source ends early, which is as unreadable as a bad sector
+            self.map.mark(offset + count, length - count, failed)
+        self._report()
+        if count < length:
+            return "error"
+        return "slow" if time.monotonic() - started > self.slow_read else "ok"
+
+    def _copy_pass(self):
+        """Large blocks over untried ranges, skipping ahead past errors and slow areas"""
+        for offset, length in self.map.ranges(UNTRIED):
+            position, end = offset, offset + length
+            skip = 0
+            while position < end:
+                count = min(self.block_size, end - position)
+                result = self._try(position, count, SKIPPED)
+                position += count
+                if result == "ok":
+                    skip = 0
+                    continue
+                skip = min(max(skip * 2, self.block_size), self.max_skip)
+                jump = min(skip, end - position)
+                self.map.mark(position, jump, SKIPPED)
+                position += jump
+                self._report()
+
+    def _retry_pass(self, status: str, block: int):
+        """Read ranges of one status again in blocks of the given size; failures at sector size are bad"""
+        failed = BAD if block <= self.sector_size else status
+        for offset, length in self.map.ranges(status):
+            for position in range(offset, offset + length, block):
+                self._try(position, min(block, offset + length - position), failed)
+
+    def retry_sizes(self) -> List[int]:
+        """Block sizes of the passes after the first, ending at the sector size"""
+        sizes = []
+        block = self.block_size // 8
+        while block > self.sector_size:
+            sizes.append(block // self.sector_size * self.sector_size)
+            block //= 8
+        return sizes + [self.sector_size]
+
+    def run(self) -> EngineStats:
+        self.started = self.last_save = time.monotonic()
+        try:
+            if self.map.ranges(UNTRIED):
+                self.passes += 1
+                self._copy_pass()
+            for block in self.retry_sizes():
+                if not self.map.ranges(SKIPPED):
+                    break
+                self.passes += 1
+                self._retry_pass(SKIPPED, block)
+            for _ in range(self.retries):
+                if not self.map.ranges(BAD):
+                    break
+                self.passes += 1
+                self._retry_pass(BAD, self.sector_size)
+            # Unreadable areas at the end still belong to the image
+            self.sink.extend(self.map.size)
+            self.stats.elapsed = time.monotonic() - self.started
+            return self.stats
+        finally:
+            self._save_map(force=True)
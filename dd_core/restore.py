@@ -0,0 +1,403 @@
+# dd_core/restore.py
+
+"""
+Streaming image restore.
+
+An image is undone from its outermost layer inwards: fragments are read as
+one stream, HCENC chunks are decrypted on a thread pool, compressed frames
+are decompressed and zero-run records are expanded back into ZeroRun
+markers. Every stage runs on its own thread and neighbouring threads are
+connected by bounded queues, so the stages overlap and a slow target
+throttles everything upstream. The writer coalesces the stream into large
+page-aligned blocks before writing them to the target.
+"""
+
+import bisect
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from dd_core.compression import DecompressStage, codec_for_suffix
+from dd_core.crypto import MAGIC, EncryptedImageReader
+from dd_core.dedup import RecipeSource, is_recipe
+from dd_core.engine import (DEFAULT_BLOCK_SIZE, CopyCancelled, DeviceSource, EngineError, EngineStats, FileSink, Sink, Source,
+                            Stage, StageQueue, ZeroRun, allocate_buffer, default_threads, open_source)
+from dd_core.seekable import SeekableImageReader
+from dd_core.pipeline import (extent_map_path, header_path, read_extent_map, read_header, records_source_digest,
+                              restore_order)
+from dd_core.incremental import resolve_parent
+from dd_core.sparse import ZeroRunExpander
+from dd_core.splitter import FragmentSource, manifest_path
+from dd_core.stages import OpenSSLDecryptStage
+from dd_core.verify import HashStage, VerificationError, new_hasher
+
+QUEUE_DEPTH = 16
+_END = object()
+_FRAGMENT_SUFFIX = re.compile(r"\.\d{3}$")
+
+
+class _Aborted(Exception):
+    """Another pipeline thread failed; unwind quietly"""
+
+
+def resolve_image(path: str) -> str:
+    """Map a selected fragment or manifest file to the image name"""
+    if path.endswith(".manifest.json"):
+        return path[:-len(".manifest.json")]
+    if _FRAGMENT_SUFFIX.search(path) and os.path.exists(manifest_path(path[:-4])):
+        return path[:-4]
+    return path
+
+
+def open_image(image_file: str) -> Source:
+    """Split images are read through their manifest, recipes from their repository, anything else directly"""
+    if os.path.exists(manifest_path(image_file)):
+        return FragmentSource(image_file)
+    if is_recipe(image_file):
+        return RecipeSource(image_file)
+    return DeviceSource(image_file)
+
+
+def _steps_from_suffixes(image_file: str) -> List[Dict[str, Any]]:
+    """Guess the layers of an image without a header (older HardClone versions)"""
+    steps = []
+    name = image_file
+    while True:
+        base, suffix = os.path.splitext(name)
+        codec = codec_for_suffix(suffix)
+        if codec:
+            steps.append({"kind": "compress", "name": codec.name})
+        elif suffix == ".enc":
+            steps.append({"kind": "encrypt", "name": "openssl", "iterations": 100000})
+        elif suffix == ".zr":
+            steps.append({"kind": "zero", "name": "zero", "mode": "records"})
+        else:
+            break
+        name = base
+
+    # An outermost .enc layer may be an HCENC container
+    if steps and steps[0]["kind"] == "encrypt":
+        with open_image(image_file) as source:
+            if source.read(0, len(MAGIC)) == MAGIC:
+                steps[0] = {"kind": "encrypt", "name": "aead"}
+    return steps
+
+
+def restore_plan(image_file: str) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Layers to undo (outermost first) and the image header, if there is one"""
+    if os.path.exists(header_path(image_file)):
+        header = read_header(image_file)
+        return [step for step in restore_order(header) if step["kind"] not in ("split", "dedup", "blockmap")], header
+    return _steps_from_suffixes(image_file), None
+
+
+def needs_password(image_file: str) -> bool:
+    steps, _ = restore_plan(resolve_image(image_file))
+    return any(step["kind"] == "encrypt" for step in steps)
+
+
+class ExtentSink(Sink):
+    """FileSink wrapper writing only the parts of the stream inside extents
+
+    Used-blocks-only images carry the source's unallocated space as zero
+    runs; the filesystem never reads those blocks, so they are skipped on
+    the target instead of being zeroed. Incremental images skip the blocks
+    that are unchanged since their parent, leaving the parent's data in
+    place.
+    """
+
+    def __init__(self, inner: FileSink, extents: List[Tuple[int, int]]):
+        self.inner = inner
+        self.extents = extents
+        self.starts = [offset for offset, _ in extents]
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _split(self, offset: int, length: int) -> Iterator[Tuple[int, bool]]:
+        """Yield (length, used) pieces of the range starting at offset"""
+        end = offset + length
+        index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while offset < end:
+            if index < len(self.extents) and self.extents[index][0] + self.extents[index][1] <= offset:
+                index += 1
+                continue
+            if index < len(self.extents) and self.extents[index][0] <= offset:
+                step = min(end, self.extents[index][0] + self.extents[index][1]) - offset
+                yield step, True
+            else:
+                next_start = self.extents[index][0] if index < len(self.extents) else end
+                step = min(end, next_start) - offset
+                yield step, False
+            offset += step
+
+    def write(self, chunks: List) -> int:
+        written = 0
+        for chunk in chunks:
+            position = 0
+            for length, used in self._split(self.inner.offset, len(chunk)):
+                if not used:
+                    self.inner.offset += length
+                elif isinstance(chunk, ZeroRun):
+                    written += self.inner.write([ZeroRun(length)])
+                else:
+                    written += self.inner.write([memoryview(chunk)[position:position + length]])
+                position += length
+        return written
+
+    def close(self):
+        self.inner.close()
+
+
+class StreamPipeline:
+    """Runs a producer, every stage and the writer on their own threads"""
+
+    def __init__(self, producer: Iterator, stages: List[Stage], sink: Sink, block_size: int = DEFAULT_BLOCK_SIZE,
+                 progress_callback: Optional[Callable[[EngineStats], None]] = None,
+                 cancel_check: Optional[Callable[[], bool]] = None, depth: int = QUEUE_DEPTH):
+        self.producer = producer
+        self.stages = stages
+        self.sink = sink
+        self.block_size = block_size
+        self.progress_callback = progress_callback
+        self.cancel_check = cancel_check
+        self.depth = depth
+        self.stats = EngineStats()
+        self.error = None
+        self.lock = threading.Lock()
+        self.started = 0.0
+
+    def _aborted(self) -> bool:
+        return self.error is not None
+
+    def _put(self, q: StageQueue, item):
+        if self._aborted() or not q.put(item, self._aborted):
+            raise _Aborted()
+
+    def _get(self, q: StageQueue):
+        item = None if self._aborted() else q.get(self._aborted)
+        if item is None:
+            raise _Aborted()
+        return item
+
+    def _produce(self, output: StageQueue):
+        for chunk in self.producer:
+            if self.cancel_check and self.cancel_check():
+                raise CopyCancelled("Operation cancelled by user")
+            self.stats.bytes_read += len(chunk) if not isinstance(chunk, ZeroRun) else 0
+            self._put(output, chunk)
+        self._put(output, _END)
+
+    def _run_stage(self, stage: Stage, source: StageQueue, output: StageQueue):
+        while True:
+            item = self._get(source)
+            if item is _END:
+                break
+            for chunk in stage.process(item):
+                self._put(output, chunk)
+        for chunk in stage.flush():
+            self._put(output, chunk)
+        self._put(output, _END)
+
+    def _write(self, source: StageQueue):
+        buffer = allocate_buffer(self.block_size)
+        view = memoryview(buffer)[:self.block_size]
+        fill = 0
+
+        def drain():
+            nonlocal fill
+            if fill:
+                self.stats.bytes_written += self.sink.write([view[:fill]])
+                fill = 0
+
+        while True:
+            item = self._get(source)
+            if item is _END:
+                break
+            # Checked here as well: with a slow target the reader sits blocked on a full queue
+            if self.cancel_check and self.cancel_check():
+                raise CopyCancelled("Operation cancelled by user")
+            if isinstance(item, ZeroRun):
+                drain()
+                self.stats.bytes_written += self.sink.write([item])
+            else:
+                # Coalesce small pieces into full, page-aligned blocks
+                data = memoryview(item).cast('B')
+                while len(data):
+                    take = min(len(data), self.block_size - fill)
+                    view[fill:fill + take] = data[:take]
+                    fill += take
+                    data = data[take:]
+                    if fill == self.block_size:
+                        drain()
+            self.stats.position += len(item)
+            self.stats.elapsed = time.monotonic() - self.started
+            if self.progress_callback:
+                self.progress_callback(self.stats)
+        drain()
+
+    def _guard(self, target: Callable, *args):
+        try:
+            target(*args)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+
+    def run(self) -> EngineStats:
+        self.started = time.monotonic()
+        # Each queue is named after the stage reading from it
+        queues = [StageQueue(name, self.depth) for name in [stage.name for stage in self.stages] + ["write"]]
+        threads = [threading.Thread(target=self._guard, args=(self._produce, queues[0]), name="restore-read", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._guard, args=(self._run_stage, stage, queues[index], queues[index + 1]),
+                                            name=f"restore-{stage.name}", daemon=True))
+        threads.append(threading.Thread(target=self._guard, args=(self._write, queues[-1]), name="restore-write", daemon=True))
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for stage in self.stages:
+                stage.close()
+        if self.error is not None:
+            raise self.error
+        self.stats.elapsed = time.monotonic() - self.started
+        return self.stats
+
+
+def _read_blocks(source: Source, block_size: int, extents: Optional[List[Tuple[int, int]]] = None) -> Iterator:
+    """Sequential blocks of source; gaps between extents become zero runs without being read"""
+    regions = [(0, source.size)] if extents is None else extents
+    position = 0
+    for offset, length in regions:
+        if offset > position:
+            yield ZeroRun(offset - position)
+        end = offset + length
+        while offset < end:
+            data = source.read(offset, min(block_size, end - offset))
+            if not data:
+                return
+            yield data
+            offset += len(data)
+        position = end
+    if extents is not None and source.size > position:
+        yield ZeroRun(source.size - position)
+
+
+def _verify_target(target: str, size: int, algorithm: str, digest: str, sudo_password: Optional[str], block_size: int,
+                   cancel_check: Optional[Callable[[], bool]]):
+    """Hash the first size bytes of target and compare them with the source digest"""
+    hasher = new_hasher(algorithm)
+    with open_source(target, sudo_password) as source:
+        offset = 0
+        while offset < size:
+            if cancel_check and cancel_check():
+                raise CopyCancelled("Operation cancelled by user")
+            data = source.read(offset, min(block_size, size - offset))
+            if not data:
+                break
+            hasher.update(data)
+            offset += len(data)
+    if hasher.hexdigest() != digest:
+        raise VerificationError(f"Restored data does not match the source {algorithm} digest")
+
+
+def restore_image(image_file: str, target: str, password: Optional[str] = None, sudo_password: Optional[str] = None,
+                  threads: Optional[int] = None, block_size: int = DEFAULT_BLOCK_SIZE,
+                  progress_callback: Optional[Callable[[EngineStats], None]] = None,
+                  cancel_check: Optional[Callable[[], bool]] = None, truncate: bool = True,
+                  verify: bool = True) -> EngineStats:
+    """
+    Stream an image (raw, compressed, encrypted and/or split) back onto target.
+
+    Incremental images restore their parent chain first and then write only
+    their changed blocks. Raises VerificationError when the image header
+    records a source digest and the restored data does not match it; for an
+    incremental image the target is read back once the whole chain is on
+    it, unless verify is False.
+    """
+    image_file = resolve_image(image_file)
+    steps, header = restore_plan(image_file)
+    threads = threads or default_threads()
+
+    if header and header.get("parent"):
+        # Only the top of the chain is read back: it covers what the layers below wrote
+        restore_image(resolve_parent(image_file, header["parent"]), target, password, sudo_password, threads, block_size,
+                      progress_callback, cancel_check, truncate, verify=False)
+        truncate = False
+
+    extents = None
+    if header and (header.get("used_only") or header.get("parent")) and os.path.exists(extent_map_path(image_file)):
+        extents = read_extent_map(image_file)
+
+    source = open_image(image_file)
+    opened = source
+    stages = []
+    hash_stage = None
+    expected_digest = None
+    chain_digest = None  # source digest of an incremental image, checked on the target after its layer
+    try:
+        if any(step["kind"] == "encrypt" for step in steps) and not password:
+            raise EngineError("Image is encrypted, a password is required")
+
+        # HCENC is always the outermost layer and is decrypted in parallel by its reader
+        if steps and steps[0]["kind"] == "encrypt" and steps[0]["name"] == "aead":
+            opened = EncryptedImageReader(opened, password)
+            producer = opened.iter_chunks(threads)
+            steps = steps[1:]
+
+        if steps and steps[0]["kind"] == "compress" and steps[0].get("seekable"):
+            # Indexed frames decompress in parallel; zero chunks are not decompressed at all
+            opened = SeekableImageReader(opened, steps[0]["name"])
+            producer = opened.iter_chunks(threads)
+            steps = steps[1:]
+        elif opened is source:
+            if any(step["kind"] in ("encrypt", "compress") or step.get("mode") == "records" for step in steps):
+                producer = _read_blocks(source, block_size)
+            elif isinstance(source, RecipeSource):
+                producer = source.iter_chunks(threads)
+            else:
+                # Raw image: unallocated regions are not even read
+                producer = _read_blocks(source, block_size, extents)
+
+        for step in steps:
+            if step["kind"] == "encrypt":
+                stages.append(OpenSSLDecryptStage(password, step.get("iterations", 100000)))
+            elif step["kind"] == "compress":
+                stages.append(DecompressStage(step["name"]))
+            elif step["kind"] == "zero" and step.get("mode") == "records":
+                stages.append(ZeroRunExpander(emit_markers=True))
+            elif step["kind"] == "hash" and header.get("parent") and records_source_digest(header):
+                # The layer only holds the changed blocks, so the digest is checked on the target afterwards
+                chain_digest = step
+            elif step["kind"] == "hash":
+                hash_stage = HashStage(step["algorithm"])
+                expected_digest = step.get("digest")
+                stages.append(hash_stage)
+
+        sink = FileSink(target, truncate=truncate, sudo_password=sudo_password)
+        if extents is not None:
+            sink = ExtentSink(sink, extents)
+        with sink:
+            pipeline = StreamPipeline(producer, stages, sink, block_size, progress_callback, cancel_check)
+            stats = pipeline.run()
+    finally:
+        for stage in stages:
+            stage.close()
+        # Readers close the source they wrap
+        opened.close()
+
+    if header and header.get("source_size") and stats.position != header["source_size"]:
+        raise EngineError(f"Restored {stats.position} bytes, image header expects {header['source_size']}")
+    if hash_stage and expected_digest and hash_stage.hexdigest() != expected_digest:
+        raise VerificationError(f"Restored data does not match the source {hash_stage.algorithm} digest")
+    if verify and chain_digest and chain_digest.get("digest") and header.get("source_size"):
+        _verify_target(target, header["source_size"], chain_digest["algorithm"], chain_digest["digest"], sudo_password,
+                       block_size, cancel_check)
+    return stats
@@ -0,0 +1,314 @@
+# dd_core/seekable.py
+
+"""
+Seekable compressed images (HCSEEK).
+
+The stream is an ordinary concatenation of independent gzip, zstd or lz4
+frames, one per chunk_size bytes of input, followed by an index the codec's
+own tools skip over: empty gzip members carrying it in an FEXTRA subfield
+("HC"), or zstd/lz4 skippable frames. `gzip -d` / `zstd -d` / `lz4 -d`
+therefore still restore the full image.
+
+Index payload (big-endian):
+
+    header      II Q   chunk_size, chunk count, uncompressed size
+    entries     I B    compressed frame length, flags (1 = all zeros)
+    footer      Q I 8s stream offset of the first index frame,
+                       payload length, magic b"HCSEEK01"
+
+The footer ends the stream (zstd/lz4) or sits right before the 10 byte
+tail of the last, empty gzip member, so a reader finds it from the end.
+"""
+
+import base64
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from dd_core.compression import DEFAULT_CHUNK_SIZE, CodecStage, get_codec
+from dd_core.engine import DeviceSource, EngineError, ZeroRun, default_threads
+
+MAGIC = b"HCSEEK01"
+INDEX_HEADER = struct.Struct(">IIQ")
+INDEX_ENTRY = struct.Struct(">IB")
+INDEX_FOOTER = struct.Struct(">QI8s")
+FLAG_ZERO = 1
+DEFAULT_CACHE_CHUNKS = 16
+
+# Empty deflate block, CRC32 and ISIZE of an empty gzip member
+_GZIP_EMPTY_TAIL = b"\x03\x00" + bytes(8)
+_GZIP_MAX_FIELD = 65535 - 4
+_SKIPPABLE_MAGIC = 0x184D2A5E
+_ZEROS = bytes(4 * 1024 * 1024)
+
+
+def _gzip_index_frames(payload: bytes) -> List[bytes]:
+    frames = []
+    for start in range(0, len(payload), _GZIP_MAX_FIELD):
+        field = payload[start:start + _GZIP_MAX_FIELD]
+        extra = b"HC" + struct.pack("<H", len(field)) + field
+        frames.append(b"\x1f\x8b\x08\x04" + bytes(4) + b"\x00\xff" + struct.pack("<H", len(extra)) + extra + _GZIP_EMPTY_TAIL)
+    return frames
+
+
+def _skippable_index_frames(payload: bytes) -> List[bytes]:
+    return [struct.pack("<II", _SKIPPABLE_MAGIC, len(payload)) + payload]
+
+
+# Codecs whose tools ignore the index frames
+INDEX_WRITERS = {
+    "gzip": _gzip_index_frames,
+    "zstd": _skippable_index_frames,
+    "lz4": _skippable_index_frames,
+}
+
+
+def seekable_supported(codec_name: str) -> bool:
+    return codec_name in INDEX_WRITERS
+
+
+def _is_zero(data) -> bool:
+    view = memoryview(data)
+    for start in range(0, len(view), len(_ZEROS)):
+        if not _ZEROS.startswith(view[start:start + len(_ZEROS)]):
+            return False
+    return True
+
+
+class SeekableCompressStage(CodecStage):
+    """Parallel chunk compression followed by a trailing chunk index
+
+    Accepts ZeroRun markers, so it needs no zero-detection stage in front
+    of it: all-zero chunks are flagged in the index (and reuse one cached
+    frame), which lets readers return them without decompressing.
+    """
+
+    def __init__(self, codec_name: str = "gzip", level: Optional[int] = None, threads: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        if not seekable_supported(codec_name):
+            raise ValueError(f"Codec {codec_name} cannot carry a seek index")
+        super().__init__(codec_name, level, threads, chunk_size)
+        self.entries = []
+        self.offset = 0
+        self.total = 0
+        self.zero_frames = {}
+        self.zero_lock = threading.Lock()
+
+    def describe(self) -> dict:
+        return dict(super().describe(), seekable=True, format="hcseek1")
+
+    def _zero_frame(self, length: int) -> bytes:
+        with self.zero_lock:
+            if length not in self.zero_frames:
+                self.zero_frames[length] = self.codec.compress(bytes(length), self.level)
+            return self.zero_frames[length]
+
+    def transform_chunk(self, index: int, data: bytes, final: bool) -> Tuple[bytes, int, int]:
+        if data and _is_zero(data):
+            return self._zero_frame(len(data)), FLAG_ZERO, len(data)
+        return self.compress_chunk(data), 0, len(data)
+
+    def _collect(self, wait_all: bool = False) -> List:
+        output = []
+        for frame, flags, length in super()._collect(wait_all):
+            self.entries.append(INDEX_ENTRY.pack(len(frame), flags))
+            self.offset += len(frame)
+            self.total += length
+            output.append(frame)
+        return output
+
+    def process(self, data) -> List:
+        if not isinstance(data, ZeroRun):
+            return super().process(data)
+        output = []
+        remaining = data.length
+        while remaining:
+            step = min(remaining, len(_ZEROS))
+            output.extend(super().process(memoryview(_ZEROS)[:step]))
+            remaining -= step
+        return output
+
+    def state(self) -> dict:
+        return dict(super().state(), entries=base64.b64encode(b"".join(self.entries)).decode(), offset=self.offset,
+                    total=self.total)
+
+    def resume(self, state: dict):
+        super().resume(state)
+        entries = base64.b64decode(state["entries"])
+        self.entries = [entries[i:i + INDEX_ENTRY.size] for i in range(0, len(entries), INDEX_ENTRY.size)]
+        self.offset = state["offset"]
+        self.total = state["total"]
+
+    def flush(self) -> List:
+        output = super().flush()
+        payload = INDEX_HEADER.pack(self.chunk_size, len(self.entries), self.total) + b"".join(self.entries)
+        payload_length = len(payload) + INDEX_FOOTER.size
+        payload += INDEX_FOOTER.pack(self.offset, payload_length, MAGIC)
+        return output + INDEX_WRITERS[self.codec.name](payload)
+
+
+def _index_payload(data: bytes) -> bytes:
+    """Extract the payload from the index frames of a seekable stream"""
+    payload = bytearray()
+    position = 0
+    while position < len(data):
+        if data[position:position + 4] == b"\x1f\x8b\x08\x04":
+            (xlen,) = struct.unpack_from("<H", data, position + 10)
+            (field_length,) = struct.unpack_from("<H", data, position + 14)
+            payload += data[position + 16:position + 16 + field_length]
+            position += 12 + xlen + len(_GZIP_EMPTY_TAIL)
+        elif len(data) - position >= 8 and struct.unpack_from("<I", data, position)[0] == _SKIPPABLE_MAGIC:
+            (length,) = struct.unpack_from("<I", data, position + 4)
+            payload += data[position + 8:position + 8 + length]
+            position += 8 + length
+        else:
+            raise EngineError("Corrupted seek index")
+    return bytes(payload)
+
+
+class SeekableImageReader:
+    """Random-access, file-like view of a seekable compressed image
+
+    source is a path or anything with read(offset, length) and size, e.g.
+    a FragmentSource or an EncryptedImageReader for encrypted images.
+    Decompressed chunks are kept in a small LRU cache, so reads cost
+    O(requested data) no matter where they land in the image.
+    """
+
+    def __init__(self, source, codec_name: str, cache_chunks: int = DEFAULT_CACHE_CHUNKS):
+        self.source = DeviceSource(source) if isinstance(source, str) else source
+        self.codec = get_codec(codec_name)
+        self.cache = OrderedDict()
+        self.cache_chunks = cache_chunks
+        self.lock = threading.Lock()
+        self.position = 0
+        self._load_index()
+
+    def _load_index(self):
+        stream_size = self.source.size
+        tail = self.source.read(max(0, stream_size - 64), min(64, stream_size))
+        for end in (len(tail), len(tail) - len(_GZIP_EMPTY_TAIL)):
+            if end >= INDEX_FOOTER.size and tail[end - len(MAGIC):end] == MAGIC:
+                index_offset, _, _ = INDEX_FOOTER.unpack(tail[end - INDEX_FOOTER.size:end])
+                break
+        else:
+            raise EngineError("Image has no seek index")
+
+        payload = _index_payload(self.source.read(index_offset, stream_size - index_offset))
+        self.chunk_size, count, self.size = INDEX_HEADER.unpack_from(payload)
+        self.frames = []
+        offset = 0
+        for i in range(count):
+            length, flags = INDEX_ENTRY.unpack_from(payload, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+            self.frames.append((offset, length, flags))
+            offset += length
+        if offset != index_offset:
+            raise EngineError("Seek index does not match the compressed stream")
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.frames)
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def is_zero_chunk(self, index: int) -> bool:
+        return bool(self.frames[index][2] & FLAG_ZERO)
+
+    def _decompress(self, index: int) -> bytes:
+        offset, length, flags = self.frames[index]
+        if flags & FLAG_ZERO:
+            return bytes(self.chunk_length(index))
+        decompressor = self.codec.decompressor()
+        data = decompressor.decompress(self.source.read(offset, length))
+        if len(data) != self.chunk_length(index):
+            raise EngineError(f"Chunk {index} decompressed to {len(data)} bytes, expected {self.chunk_length(index)}")
+        return data
+
+    def read_chunk(self, index: int) -> bytes:
+        """Decompressed chunk index, through the LRU cache"""
+        with self.lock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+        data = self._decompress(index)
+        with self.lock:
+            self.cache[index] = data
+            if len(self.cache) > self.cache_chunks:
+                self.cache.popitem(last=False)
+        return data
+
+    def iter_chunks(self, threads: Optional[int] = None, start: int = 0) -> Iterator:
+        """Chunks in order, decompressed on a thread pool; zero chunks come as ZeroRun"""
+        threads = max(1, threads or default_threads())
+
+        def load(index):
+            return ZeroRun(self.chunk_length(index)) if self.is_zero_chunk(index) else self._decompress(index)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            index = start
+            while index < self.chunk_count:
+                batch = range(index, min(self.chunk_count, index + threads * 2))
+                yield from executor.map(load, batch)
+                index = batch.stop
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        length = max(0, min(length, self.size - offset))
+        parts = []
+        while length:
+            index, start = divmod(offset, self.chunk_size)
+            data = self.read_chunk(index)[start:start + length]
+            parts.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b"".join(parts)
+
+    # Source-style access
+
+    def read(self, *args) -> bytes:
+        """read(offset, length) like a Source, or read([size]) like a file"""
+        if len(args) == 2:
+            return self.read_at(*args)
+        size = args[0] if args and args[0] is not None and args[0] >= 0 else self.size - self.position
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer, offset: Optional[int] = None) -> int:
+        position = self.position if offset is None else offset
+        data = self.read_at(position, len(buffer))
+        buffer[:len(data)] = data
+        if offset is None:
+            self.position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
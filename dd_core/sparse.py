@@ -0,0 +1,147 @@
+# dd_core/sparse.py
+
+"""
+Zero-block detection.
+
+In "sparse" mode all-zero regions leave the stage as ZeroRun markers, which
+FileSink turns into holes. In "records" mode, used when the stream is
+compressed or encrypted afterwards, the stage emits a zero-run record
+stream (HCZR): a sequence of records, each a ">BQ" header (type, length)
+where type 0 is followed by length literal bytes and type 1 stands for
+length zero bytes.
+"""
+
+import struct
+from typing import List
+
+from dd_core.engine import Stage, ZeroRun
+
+ZERO_GRANULE = 64 * 1024
+RECORD_HEADER = struct.Struct(">BQ")
+RECORD_DATA = 0
+RECORD_ZERO = 1
+
+# Zero checks are memcmp-speed bytes.startswith() calls against this buffer
+_ZEROS = bytes(4 * 1024 * 1024)
+
+
+class ZeroDetectStage(Stage):
+    """Detects all-zero granules and replaces them with zero runs"""
+
+    name = "zero"
+    kind = "zero"
+
+    def __init__(self, mode: str = "sparse", granule: int = ZERO_GRANULE):
+        if mode not in ("sparse", "records"):
+            raise ValueError(f"Unsupported zero detection mode: {mode}")
+        self.mode = mode
+        self.suffix = ".zr" if mode == "records" else ""
+        self.granule = granule
+        self.zero_run = 0
+        self.skipped_bytes = 0
+
+    def describe(self) -> dict:
+        return dict(super().describe(), mode=self.mode, granule=self.granule)
+
+    def state(self) -> dict:
+        return {"zero_run": self.zero_run, "skipped_bytes": self.skipped_bytes}
+
+    def resume(self, state: dict):
+        self.zero_run = state["zero_run"]
+        self.skipped_bytes = state["skipped_bytes"]
+
+    def _emit_zero_run(self, output: List):
+        if self.zero_run:
+            if self.mode == "sparse":
+                output.append(ZeroRun(self.zero_run))
+            else:
+                output.append(RECORD_HEADER.pack(RECORD_ZERO, self.zero_run))
+            self.zero_run = 0
+
+    def _emit_data(self, output: List, data: memoryview):
+        self._emit_zero_run(output)
+        if self.mode == "records":
+            output.append(RECORD_HEADER.pack(RECORD_DATA, len(data)))
+        output.append(data)
+
+    def process(self, data: memoryview) -> List:
+        output = []
+        if isinstance(data, ZeroRun) or (len(data) <= len(_ZEROS) and _ZEROS.startswith(data)):
+            self.zero_run += len(data)
+            self.skipped_bytes += len(data)
+            return output
+
+        data_start = None
+        for start in range(0, len(data), self.granule):
+            granule = data[start:start + self.granule]
+            if _ZEROS.startswith(granule):
+                if data_start is not None:
+                    self._emit_data(output, data[data_start:start])
+                    data_start = None
+                self.zero_run += len(granule)
+                self.skipped_bytes += len(granule)
+            elif data_start is None:
+                data_start = start
+
+        if data_start is not None:
+            self._emit_data(output, data[data_start:])
+        return output
+
+    def flush(self) -> List:
+        output = []
+        self._emit_zero_run(output)
+        return output
+
+
+class ZeroRunExpander(Stage):
+    """Expands an HCZR record stream back into raw bytes (or ZeroRun markers)"""
+
+    name = "zero-expand"
+    kind = "zero"
+
+    def __init__(self, emit_markers: bool = False):
+        self.emit_markers = emit_markers
+        self.pending = bytearray()
+        self.literal_left = 0
+
+    def _zero_output(self, length: int) -> List:
+        if self.emit_markers:
+            return [ZeroRun(length)]
+        output = []
+        while length:
+            step = min(length, len(_ZEROS))
+            output.append(memoryview(_ZEROS)[:step])
+            length -= step
+        return output
+
+    def process(self, data: memoryview) -> List:
+        output = []
+        view = memoryview(data)
+        while len(view):
+            if self.literal_left:
+                take = min(self.literal_left, len(view))
+                output.append(bytes(view[:take]))
+                self.literal_left -= take
+                view = view[take:]
+                continue
+
+            need = RECORD_HEADER.size - len(self.pending)
+            self.pending += view[:need]
+            view = view[need:]
+            if len(self.pending) < RECORD_HEADER.size:
+                break
+
+            record_type, length = RECORD_HEADER.unpack(self.pending)
+            self.pending.clear()
+            if record_type == RECORD_DATA:
+                self.literal_left = length
+            elif record_type == RECORD_ZERO:
+                output.extend(self._zero_output(length))
+            else:
+                raise ValueError(f"Corrupted zero-run stream (record type {record_type})")
+        return output
+
+    def flush(self) -> List:
+        if self.pending or self.literal_left:
+            raise ValueError("Truncated zero-run stream")
+        return []
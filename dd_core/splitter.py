@@ -0,0 +1,239 @@
+# dd_core/splitter.py
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from dd_core.engine import EngineError, Sink, Source, ZeroRun, pwritev_all
+
+MANIFEST_SUFFIX = ".manifest.json"
+_ZEROS = bytes(1024 * 1024)
+
+
+def fragment_path(image_file: str, index: int) -> str:
+    return f"{image_file}.{index:03d}"
+
+
+def manifest_path(image_file: str) -> str:
+    return image_file + MANIFEST_SUFFIX
+
+
+def read_manifest(image_file: str) -> dict:
+    with open(manifest_path(image_file), "r") as f:
+        return json.load(f)
+
+
+class SplitFileSink(Sink):
+    """Writes the stream into fixed-size fragment files
+
+    Fragments are hashed while they are written. A finished fragment is
+    fsynced and closed on a background thread while the next one is being
+    filled, and a manifest with every fragment's size and hash is written
+    on close.
+    """
+
+    kind = "split"
+    name = "split"
+    resumable = True
+
+    def __init__(self, image_file: str, fragment_size: int, hash_name: str = "sha256"):
+        if fragment_size <= 0:
+            raise ValueError("Fragment size must be positive")
+        self.image_file = image_file
+        self.fragment_size = fragment_size
+        self.hash_name = hash_name
+        self.fragments = []
+        self.closer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="split-close")
+        self.pending_closes = []
+        self.fd = None
+        self.offset = 0
+        self.hash = None
+        self.total = 0
+
+    def describe(self) -> dict:
+        return {"kind": self.kind, "name": self.name, "fragment_size": self.fragment_size, "manifest": manifest_path(self.image_file)}
+
+    def _open_fragment(self):
+        self.fd = os.open(fragment_path(self.image_file, len(self.fragments)), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.offset = 0
+        self.hash = hashlib.new(self.hash_name)
+
+    @staticmethod
+    def _sync_and_close(fd: int, size: int):
+        # Trailing holes need an explicit size
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+        os.close(fd)
+
+    def _finish_fragment(self):
+        self.fragments.append({"name": os.path.basename(fragment_path(self.image_file, len(self.fragments))),
+                               "size": self.offset, self.hash_name: self.hash.hexdigest()})
+        self.pending_closes.append(self.closer.submit(self._sync_and_close, self.fd, self.offset))
+        self.fd = None
+
+    def _write_piece(self, piece) -> int:
+        if isinstance(piece, ZeroRun):
+            remaining = piece.length
+            while remaining:
+                step = min(remaining, len(_ZEROS))
+                self.hash.update(memoryview(_ZEROS)[:step])
+                remaining -= step
+            written = 0
+        else:
+            self.hash.update(piece)
+            written = pwritev_all(self.fd, [piece], self.offset)
+        self.offset += len(piece)
+        self.total += len(piece)
+        if self.offset == self.fragment_size:
+            self._finish_fragment()
+        return written
+
+    def write(self, chunks: List) -> int:
+        written = 0
+        for chunk in chunks:
+            while len(chunk):
+                if self.fd is None:
+                    self._open_fragment()
+                take = min(len(chunk), self.fragment_size - self.offset)
+                if isinstance(chunk, ZeroRun):
+                    piece, chunk = ZeroRun(take), ZeroRun(chunk.length - take)
+                else:
+                    view = memoryview(chunk)
+                    piece, chunk = view[:take], view[take:]
+                written += self._write_piece(piece)
+        return written
+
+    def sync(self):
+        if self.fd is not None:
+            os.ftruncate(self.fd, self.offset)
+            os.fsync(self.fd)
+        for future in self.pending_closes:
+            future.result()
+
+    def state(self) -> dict:
+        return {"fragments": list(self.fragments), "offset": self.offset if self.fd is not None else 0, "total": self.total}
+
+    def resume(self, state: dict):
+        self.fragments = list(state["fragments"])
+        self.total = state["total"]
+        if state["offset"]:
+            self.fd = os.open(fragment_path(self.image_file, len(self.fragments)), os.O_RDWR)
+            self.offset = state["offset"]
+            os.ftruncate(self.fd, self.offset)
+            # Fragment hashes cannot be saved either; the unfinished fragment is hashed again
+            self.hash = hashlib.new(self.hash_name)
+            for position in range(0, self.offset, len(_ZEROS)):
+                self.hash.update(os.pread(self.fd, min(len(_ZEROS), self.offset - position), position))
+        # Fragments written after the checkpoint are stale
+        index = len(self.fragments) + (1 if self.fd is not None else 0)
+        while os.path.exists(fragment_path(self.image_file, index)):
+            os.unlink(fragment_path(self.image_file, index))
+            index += 1
+
+    def read_committed(self):
+        count = len(self.fragments) + (1 if self.fd is not None else 0)
+        for index in range(count):
+            size = self.fragments[index]["size"] if index < len(self.fragments) else self.offset
+            with open(fragment_path(self.image_file, index), "rb") as f:
+                for _ in range(0, size, len(_ZEROS)):
+                    yield f.read(len(_ZEROS))
+
+    def close(self, complete: bool = True):
+        if self.fd is not None or (complete and not self.fragments):
+            if self.fd is None:
+                self._open_fragment()
+            self._finish_fragment()
+        self.closer.shutdown(wait=True)
+        for future in self.pending_closes:
+            future.result()
+
+        # A failed or cancelled run leaves its fragments but no manifest
+        if not complete:
+            return
+
+        manifest = {
+            "fragment_size": self.fragment_size,
+            "total_size": self.total,
+            "hash": self.hash_name,
+            "fragments": self.fragments,
+        }
+        with open(manifest_path(self.image_file), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+class FragmentSource(Source):
+    """Reads a split image as one contiguous stream
+
+    Sequential reads hash every fragment and compare it with the manifest
+    once the fragment has been read completely.
+    """
+
+    def __init__(self, image_file: str, verify: bool = True):
+        manifest = read_manifest(image_file)
+        directory = os.path.dirname(image_file)
+        self.hash_name = manifest.get("hash", "sha256")
+        self.verify = verify
+        self.fragments = []
+        start = 0
+        for fragment in manifest["fragments"]:
+            path = os.path.join(directory, fragment["name"])
+            if os.path.getsize(path) != fragment["size"]:
+                raise EngineError(f"Fragment {fragment['name']} has wrong size")
+            self.fragments.append((start, fragment["size"], path, fragment.get(self.hash_name)))
+            start += fragment["size"]
+        self.size = start
+        self.fds = {}
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.hashed_until = {}
+
+    def _fd(self, path: str) -> int:
+        # Seekable and encrypted readers call in from several threads
+        with self.lock:
+            if path not in self.fds:
+                self.fds[path] = os.open(path, os.O_RDONLY)
+            return self.fds[path]
+
+    def _check_hash(self, index: int, offset: int, data):
+        start, size, path, expected = self.fragments[index]
+        with self.lock:
+            if not self.verify or not expected or self.hashed_until.get(index, 0) != offset - start:
+                # Out-of-order reads cannot be hashed incrementally
+                self.hashed_until[index] = -1
+                return
+            hasher = self.hashes.setdefault(index, hashlib.new(self.hash_name))
+            hasher.update(data)
+            self.hashed_until[index] = offset - start + len(data)
+            if self.hashed_until[index] == size and hasher.hexdigest() != expected:
+                raise EngineError(f"Fragment {os.path.basename(path)} failed {self.hash_name} check")
+
+    def readinto(self, buffer: memoryview, offset: int) -> int:
+        total = 0
+        for index, (start, size, path, _) in enumerate(self.fragments):
+            if total == len(buffer):
+                break
+            position = offset + total
+            if not start <= position < start + size:
+                continue
+            want = min(len(buffer) - total, start + size - position)
+            count = os.preadv(self._fd(path), [buffer[total:total + want]], position - start)
+            self._check_hash(index, position, buffer[total:total + count])
+            total += count
+            if count < want:
+                break
+        return total
+
+    def read(self, offset: int, length: int) -> bytes:
+        buffer = bytearray(length)
+        return bytes(buffer[:self.readinto(memoryview(buffer), offset)])
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
@@ -0,0 +1,35 @@
+# dd_core/stages.py
+
+import os
+
+from dd_core.engine import SubprocessStage
+
+
+class OpenSSLEncryptStage(SubprocessStage):
+    """Encrypts the stream with openssl AES-256-CBC (PBKDF2 key derivation)"""
+
+    name = "openssl"
+    kind = "encrypt"
+    suffix = ".enc"
+
+    def __init__(self, password: str, iterations: int = 100000):
+        self.iterations = iterations
+        # Password goes through the environment so it never shows up in ps output
+        env = dict(os.environ, HARDCLONE_ENC_PASS=password)
+        super().__init__(["openssl", "enc", "-aes-256-cbc", "-pbkdf2", "-iter", str(iterations), "-pass", "env:HARDCLONE_ENC_PASS"],
+                         env=env)
+
+    def describe(self) -> dict:
+        return dict(super().describe(), cipher="aes-256-cbc", kdf="pbkdf2", iterations=self.iterations)
+
+
+class OpenSSLDecryptStage(SubprocessStage):
+    """Decrypts images written by OpenSSLEncryptStage"""
+
+    name = "openssl-decrypt"
+    kind = "encrypt"
+
+    def __init__(self, password: str, iterations: int = 100000):
+        env = dict(os.environ, HARDCLONE_ENC_PASS=password)
+        super().__init__(["openssl", "enc", "-d", "-aes-256-cbc", "-pbkdf2", "-iter", str(iterations), "-pass", "env:HARDCLONE_ENC_PASS"],
+                         env=env)
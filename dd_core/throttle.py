@@ -0,0 +1,207 @@
+# dd_core/throttle.py
+
+"""
+I/O rate limiting for imaging hosts that keep serving traffic.
+
+RateLimiter caps bandwidth and IOPS with token buckets whose rates can be
+changed from another thread while a copy runs. AdaptiveRateLimiter also
+samples /sys/dev/block/<major>:<minor>/stat of the disk under the source:
+when the average queue depth (time_in_queue delta over wall time) rises
+above what the copy itself produces, or more requests are in flight than
+the copy has outstanding, other I/O on the disk is waiting and the rate
+is halved; while the disk keeps up it grows again by a quarter per
+interval, up to the fixed cap. Callers that keep several reads in flight
+pass their outstanding count and queue depth to acquire(), so their own
+requests are not mistaken for someone else's.
+"""
+
+import os
+import stat
+import threading
+import time
+from typing import Callable, Optional
+
+MAX_SLEEP = 0.25  # keeps rate changes and cancellation responsive
+BURST_SECONDS = 0.5
+ADAPT_INTERVAL = 1.0
+DEFAULT_QUEUE_THRESHOLD = 2.0
+MIN_ADAPTIVE_RATE = 1024 * 1024
+
+
+class TokenBucket:
+    """Token bucket allowing a deficit, so one large request waits instead of being split"""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate or None
+        self.tokens = self._burst()
+        self.stamp = time.monotonic()
+
+    def _burst(self) -> float:
+        return self.rate * BURST_SECONDS if self.rate else 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._burst(), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate: Optional[float]):
+        self._refill()
+        self.rate = rate or None
+        if self.rate is None:
+            self.tokens = 0.0
+        else:
+            self.tokens = min(self.tokens, self._burst())
+
+    def take(self, amount: float):
+        self._refill()
+        if self.rate:
+            self.tokens -= amount
+
+    def wait_time(self) -> float:
+        """Seconds until the deficit is paid off"""
+        self._refill()
+        if not self.rate or self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Bandwidth (bytes/s) and IOPS caps; None means unlimited"""
+
+    def __init__(self, bytes_per_second: Optional[float] = None, iops: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.limit = bytes_per_second or None
+        self.bandwidth = TokenBucket(self.limit)
+        self.operations = TokenBucket(iops)
+
+    @property
+    def rate(self) -> Optional[float]:
+        """Bandwidth currently enforced"""
+        return self.bandwidth.rate
+
+    def set_limit(self, bytes_per_second: Optional[float] = None, iops: Optional[float] = None):
+        """Change the caps; safe to call from another thread while a copy runs"""
+        with self.lock:
+            self.limit = bytes_per_second or None
+            self.bandwidth.set_rate(self.limit)
+            self.operations.set_rate(iops)
+
+    def _adapt(self, in_flight: int, depth: int):
+        pass
+
+    def acquire(self, count: int, cancel_check: Optional[Callable[[], bool]] = None, in_flight: int = 0,
+                depth: int = 1):
+        """Account for one request of count bytes, sleeping while over the limits
+
+        in_flight is the number of the caller's own requests still outstanding,
+        depth the number it keeps in flight at most.
+        """
+        with self.lock:
+            self._adapt(in_flight, depth)
+            self.bandwidth.take(count)
+            self.operations.take(1)
+        while not (cancel_check and cancel_check()):
+            with self.lock:
+                delay = max(self.bandwidth.wait_time(), self.operations.wait_time())
+            if delay <= 0:
+                return
+            time.sleep(min(delay, MAX_SLEEP))
+
+
+def disk_sysfs_dir(path: str) -> Optional[str]:
+    """sysfs directory of the whole disk holding path (a device node or a file on a filesystem)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    device = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    directory = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+    if os.path.exists(os.path.join(directory, "partition")):
+        directory = os.path.dirname(directory)
+    return directory if os.path.isdir(directory) else None
+
+
+def disk_stat_path(path: str) -> Optional[str]:
+    directory = disk_sysfs_dir(path)
+    stat_path = os.path.join(directory, "stat") if directory else None
+    return stat_path if stat_path and os.path.exists(stat_path) else None
+
+
+def read_disk_stat(stat_path: str):
+    """(in_flight, io_ticks, time_in_queue) from a block device stat file"""
+    with open(stat_path, "r") as f:
+        fields = [int(field) for field in f.read().split()]
+    return fields[8], fields[9], fields[10]
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """RateLimiter that backs off while other I/O on the source disk is being delayed
+
+    bytes_per_second stays the upper bound (None: no bound). Without a
+    readable stat file the limiter behaves like a plain RateLimiter.
+    """
+
+    def __init__(self, path: str, bytes_per_second: Optional[float] = None, iops: Optional[float] = None,
+                 queue_threshold: float = DEFAULT_QUEUE_THRESHOLD, min_rate: float = MIN_ADAPTIVE_RATE,
+                 interval: float = ADAPT_INTERVAL):
+        super().__init__(bytes_per_second, iops)
+        self.stat_path = disk_stat_path(path)
+        self.queue_threshold = queue_threshold
+        self.min_rate = min_rate
+        self.interval = interval
+        self.backoffs = 0
+        self.queue_depth = 0.0
+        self.sample = None
+        self.moved = 0  # bytes requested since the last sample
+
+    def set_limit(self, bytes_per_second: Optional[float] = None, iops: Optional[float] = None):
+        with self.lock:
+            self.limit = bytes_per_second or None
+            # Keep a backed-off rate below the new cap rather than jumping to it
+            rate = self.bandwidth.rate
+            if rate is None or (self.limit is not None and self.limit < rate):
+                rate = self.limit
+            self.bandwidth.set_rate(rate)
+            self.operations.set_rate(iops)
+
+    def _adapt(self, in_flight: int, depth: int):
+        if self.stat_path is None:
+            return
+        now = time.monotonic()
+        if self.sample is not None and now - self.sample[0] < self.interval:
+            return
+        try:
+            disk_in_flight, io_ticks, time_in_queue = read_disk_stat(self.stat_path)
+        except (OSError, ValueError, IndexError):
+            self.stat_path = None
+            return
+        previous, self.sample = self.sample, (now, io_ticks, time_in_queue)
+        moved, self.moved = self.moved, 0
+        if previous is None:
+            return
+        elapsed_ms = (now - previous[0]) * 1000
+        self.queue_depth = (time_in_queue - previous[2]) / elapsed_ms if elapsed_ms > 0 else 0.0
+        busy = (io_ticks - previous[1]) / elapsed_ms if elapsed_ms > 0 else 0.0
+        # Our own outstanding reads are in the disk's counters too: only the rest belongs to someone else,
+        # and the queue our reads alone build grows with the depth we keep
+        others = disk_in_flight - in_flight
+        if (self.queue_depth > self.queue_threshold * depth and busy > 0.5) or others > self.queue_threshold:
+            # Others are queueing behind us: halve what was actually moved in the last interval
+            measured = moved * 1000 / elapsed_ms
+            rate = min(self.bandwidth.rate, measured) if self.bandwidth.rate else measured
+            self.bandwidth.set_rate(max(self.min_rate, rate / 2))
+            self.backoffs += 1
+        elif self.bandwidth.rate:
+            rate = self.bandwidth.rate * 1.25
+            if self.limit is not None:
+                rate = min(rate, self.limit)
+            elif rate > 64 * 1024 ** 3:
+                rate = None  # recovered beyond anything a disk delivers
+            self.bandwidth.set_rate(rate)
+
+    def acquire(self, count: int, cancel_check: Optional[Callable[[], bool]] = None, in_flight: int = 0,
+                depth: int = 1):
+        with self.lock:
+            self.moved += count
+        super().acquire(count, cancel_check, in_flight, depth)
@@ -0,0 +1,199 @@
+# dd_core/tuning.py
+
+"""
+Block size and queue depth auto-tuning per device.
+
+The candidates come from the disk's queue limits in sysfs (optimal_io_size,
+max_sectors_kb, rotational, nr_requests). A short benchmark of direct reads
+first picks the block size at queue depth 1, then the queue depth at that
+block size; the smallest setting within a few percent of the best wins.
+Results are cached per device model and serial in
+$XDG_CACHE_HOME/hardclone/tuning.json, so later runs reuse them at once.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+from dd_core.engine import DEFAULT_BLOCK_SIZE, DeviceSource, Source, allocate_buffer
+from dd_core.throttle import disk_sysfs_dir
+
+TUNING_VERSION = 1
+BLOCK_SIZES = [64 * 1024 << shift for shift in range(9)]  # 64 KiB .. 16 MiB
+QUEUE_DEPTHS = [1, 2, 4, 8, 16, 32]
+ROTATIONAL_QUEUE_DEPTHS = [1, 2]
+TRIAL_TIME = 0.25
+TRIAL_MIN_REQUESTS = 4
+GOOD_ENOUGH = 0.95  # settings within 5% of the best count as equal
+
+
+@dataclass
+class TuningResult:
+    block_size: int
+    queue_depth: int
+    throughput: float = 0.0  # bytes per second measured with this setting
+    cached: bool = False
+
+
+def _read_sysfs(directory: str, name: str) -> str:
+    try:
+        with open(os.path.join(directory, name), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def queue_limits(path: str) -> Dict[str, int]:
+    """Queue limits of the disk holding path; empty when it has no sysfs entry"""
+    directory = disk_sysfs_dir(path)
+    if directory is None:
+        return {}
+    limits = {}
+    for name in ("optimal_io_size", "max_sectors_kb", "rotational", "nr_requests", "logical_block_size"):
+        value = _read_sysfs(directory, os.path.join("queue", name))
+        if value.isdigit():
+            limits[name] = int(value)
+    return limits
+
+
+def device_identity(path: str) -> Optional[str]:
+    """Model and serial of the disk holding path, stable across reboots and device renames"""
+    directory = disk_sysfs_dir(path)
+    if directory is None:
+        return None
+    model = _read_sysfs(directory, "device/model") or _read_sysfs(directory, "device/vendor") \
+        or _read_sysfs(directory, "dm/name") or os.path.basename(directory)
+    serial = _read_sysfs(directory, "device/serial") or _read_sysfs(directory, "serial") \
+        or _read_sysfs(directory, "wwid") or _read_sysfs(directory, "device/wwid") or _read_sysfs(directory, "dm/uuid")
+    if not serial:
+        # Without a serial the capacity at least tells different disks of one model apart
+        serial = "size-" + _read_sysfs(directory, "size")
+    return f"{model}:{serial}"
+
+
+def candidates(limits: Dict[str, int]):
+    """(block sizes, queue depths) worth trying for a disk with these queue limits"""
+    logical = limits.get("logical_block_size", 512)
+    sizes = [size for size in BLOCK_SIZES if size >= logical]
+    # The preferred request size and the largest request the disk accepts unsplit are worth a trial of their own
+    for preferred in (limits.get("optimal_io_size", 0), limits.get("max_sectors_kb", 0) * 1024):
+        if preferred >= logical and preferred % logical == 0 and preferred not in sizes and preferred <= BLOCK_SIZES[-1]:
+            sizes = sorted(sizes + [preferred])
+    if limits.get("rotational", 0):
+        depths = ROTATIONAL_QUEUE_DEPTHS
+    else:
+        depths = [depth for depth in QUEUE_DEPTHS if depth <= max(1, limits.get("nr_requests", QUEUE_DEPTHS[-1]))]
+    return sizes, depths
+
+
+def _measure(source: Source, block_size: int, depth: int, start: int) -> float:
+    """Throughput of depth readers taking consecutive block_size requests from start"""
+    size = source.size
+    lock = threading.Lock()
+    state = {"next": start, "requests": 0, "bytes": 0}
+    deadline = time.monotonic() + TRIAL_TIME
+
+    def reader():
+        buffer = memoryview(allocate_buffer(block_size))[:block_size]
+        while True:
+            with lock:
+                if state["requests"] >= TRIAL_MIN_REQUESTS * depth and time.monotonic() >= deadline:
+                    return
+                offset = state["next"] % max(size - block_size, 1) // 4096 * 4096
+                state["next"] += block_size
+                state["requests"] += 1
+            count = source.readinto(buffer, offset)
+            with lock:
+                state["bytes"] += count
+
+    started = time.monotonic()
+    if depth == 1:
+        reader()
+    else:
+        with ThreadPoolExecutor(max_workers=depth) as pool:
+            for future in [pool.submit(reader) for _ in range(depth)]:
+                future.result()
+    return state["bytes"] / max(time.monotonic() - started, 1e-6)
+
+
+def _pick(results: Dict[int, float]) -> int:
+    best = max(results.values())
+    return min(value for value, throughput in results.items() if throughput >= best * GOOD_ENOUGH)
+
+
+def benchmark(source: Source, limits: Dict[str, int]) -> TuningResult:
+    """Measure the candidates on source (opened with direct=True, so the page cache does not flatter it)"""
+    sizes, depths = candidates(limits)
+    sizes = [size for size in sizes if size * TRIAL_MIN_REQUESTS <= source.size] or [min(BLOCK_SIZES)]
+    # Every trial reads a region no earlier trial touched, so device caches do not flatter it either
+    position = source.size // 4
+
+    by_size = {}
+    for size in sizes:
+        by_size[size] = _measure(source, size, 1, position)
+        position += int(by_size[size] * TRIAL_TIME) + size
+    block_size = _pick(by_size)
+
+    by_depth = {1: by_size[block_size]}
+    for depth in depths[1:]:
+        by_depth[depth] = _measure(source, block_size, depth, position)
+        position += int(by_depth[depth] * TRIAL_TIME) + block_size * depth
+    queue_depth = _pick(by_depth)
+    return TuningResult(block_size, queue_depth, by_depth[queue_depth])
+
+
+def tuning_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "hardclone", "tuning.json")
+
+
+def _load_cache(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {"version": TUNING_VERSION, "devices": {}}
+    if cache.get("version") != TUNING_VERSION:
+        return {"version": TUNING_VERSION, "devices": {}}
+    return cache
+
+
+def tuned_settings(path: str, opener: Optional[Callable[[], Source]] = None, retune: bool = False,
+                   cache_path: Optional[str] = None) -> TuningResult:
+    """Cached setting for the disk holding path, benchmarking it the first time it is seen
+
+    opener returns the source to benchmark (it should bypass the page
+    cache); by default path is opened with direct I/O. It is only called
+    when the cache has no entry. Devices without a sysfs entry get the
+    engine defaults, with no throughput.
+    """
+    identity = device_identity(path)
+    if identity is None:
+        return TuningResult(DEFAULT_BLOCK_SIZE, 1)
+    cache_path = cache_path or tuning_cache_path()
+    cache = _load_cache(cache_path)
+    entry = cache["devices"].get(identity)
+    if entry and not retune:
+        return TuningResult(entry["block_size"], entry["queue_depth"], entry.get("throughput", 0.0), cached=True)
+
+    with (opener or (lambda: DeviceSource(path, direct=True)))() as source:
+        result = benchmark(source, queue_limits(path))
+    cache["devices"][identity] = dict(asdict(result), tuned=time.strftime("%Y-%m-%dT%H:%M:%S%z"))
+    del cache["devices"][identity]["cached"]
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temporary = cache_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(temporary, cache_path)
+    except OSError:
+        pass  # an unwritable cache only means tuning again next time
+    return result
+
+
+def tuned_devices(cache_path: Optional[str] = None) -> List[str]:
+    return sorted(_load_cache(cache_path or tuning_cache_path())["devices"])
@@ -0,0 +1,242 @@
+# dd_core/verify.py
+
+import hashlib
+import os
+import queue
+import threading
+from typing import Callable, Dict, List
+
+from dd_core.engine import EngineError, FileSink, Sink, Stage, ZeroRun, allocate_buffer
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_READBACK_LAG = 256 * 1024 * 1024
+_ZEROS = bytes(4 * 1024 * 1024)
+
+HASH_ALGORITHMS: Dict[str, Callable] = {
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh3"] = xxhash.xxh3_128
+
+
+class VerificationError(EngineError):
+    """Raised when read-back data does not match what was written"""
+
+
+def new_hasher(name: str):
+    try:
+        return HASH_ALGORITHMS[name]()
+    except KeyError:
+        raise ValueError(f"Unsupported hash algorithm: {name}") from None
+
+
+def update_hasher(hasher, data):
+    """Feed data (or a ZeroRun as zeros) into hasher"""
+    if isinstance(data, ZeroRun):
+        remaining = data.length
+        while remaining:
+            step = min(remaining, len(_ZEROS))
+            hasher.update(memoryview(_ZEROS)[:step])
+            remaining -= step
+    else:
+        hasher.update(data)
+
+
+class HashStage(Stage):
+    """Pass-through stage hashing the stream inline, without an extra read"""
+
+    name = "hash"
+    kind = "hash"
+
+    def __init__(self, algorithm: str = "sha256"):
+        self.algorithm = algorithm
+        self.hasher = new_hasher(algorithm)
+
+    def describe(self) -> dict:
+        return dict(super().describe(), algorithm=self.algorithm, digest=self.hexdigest())
+
+    # Hash objects cannot be saved, so a resumed copy re-hashes the stream up to the checkpoint
+    replay = True
+
+    def process(self, data: memoryview) -> List:
+        update_hasher(self.hasher, data)
+        return [data]
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def state(self) -> dict:
+        return {"digest": self.hexdigest()}
+
+    def resume(self, state: dict):
+        if self.hexdigest() != state["digest"]:
+            raise VerificationError("Source data changed since the checkpoint")
+
+
+class HashingSink(Sink):
+    """Sink wrapper hashing the bytes that reach the image"""
+
+    def __init__(self, inner: Sink, algorithm: str = "sha256"):
+        self.inner = inner
+        self.algorithm = algorithm
+        self.hasher = new_hasher(algorithm)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    @property
+    def resumable(self) -> bool:
+        return self.inner.resumable
+
+    @property
+    def cache_avoided(self) -> int:
+        return self.inner.cache_avoided
+
+    def write(self, chunks: List) -> int:
+        for chunk in chunks:
+            update_hasher(self.hasher, chunk)
+        return self.inner.write(chunks)
+
+    def sync(self):
+        self.inner.sync()
+
+    def state(self) -> dict:
+        return {"digest": self.hexdigest(), "inner": self.inner.state()}
+
+    def resume(self, state: dict):
+        self.inner.resume(state["inner"])
+        for data in self.inner.read_committed():
+            self.hasher.update(data)
+        if self.hexdigest() != state["digest"]:
+            raise VerificationError("Partial image changed since the checkpoint")
+
+    def read_committed(self):
+        return self.inner.read_committed()
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def close(self, *args, **kwargs):
+        self.inner.close(*args, **kwargs)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.inner.__exit__(exc_type, exc, tb)
+
+
+class ReadBackSink(Sink):
+    """FileSink wrapper re-reading written ranges a bounded distance behind the writer
+
+    Every write is queued as (offset, length, digest). A verifier thread
+    reads the range back (O_DIRECT when the target allows it, so the data
+    comes from the device rather than the page cache) and compares digests.
+    The queue holds at most max_lag bytes, so the writer waits when the
+    verifier falls behind.
+    """
+
+    def __init__(self, inner: FileSink, max_lag: int = DEFAULT_READBACK_LAG, algorithm: str = "blake2b"):
+        self.inner = inner
+        self.algorithm = algorithm
+        self.max_lag = max_lag
+        self.lag = 0
+        self.verified_bytes = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.queue = queue.Queue()
+        self.fd, self.direct = self._open_reader(inner.path)
+        self.buffer = allocate_buffer(len(_ZEROS) + 8192)
+        self.thread = threading.Thread(target=self._verify_loop, name="readback", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _open_reader(path: str):
+        if hasattr(os, "O_DIRECT"):
+            try:
+                return os.open(path, os.O_RDONLY | os.O_DIRECT), True
+            except OSError:
+                pass
+        return os.open(path, os.O_RDONLY), False
+
+    def _read_range(self, offset: int, length: int) -> bytes:
+        if not self.direct:
+            data = os.pread(self.fd, length, offset)
+        else:
+            # O_DIRECT needs aligned offset, length and buffer
+            start = offset - offset % 4096
+            end = -(-(offset + length) // 4096) * 4096
+            count = os.preadv(self.fd, [memoryview(self.buffer)[:end - start]], start)
+            data = self.buffer[offset - start:max(offset - start, min(count, offset - start + length))]
+        # A trailing hole only gets its size when the sink closes
+        return data + bytes(length - len(data))
+
+    def _verify_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            offset, length, expected = item
+            try:
+                if self.error is None:
+                    hasher = new_hasher(self.algorithm)
+                    position = offset
+                    while position < offset + length:
+                        step = min(len(_ZEROS), offset + length - position)
+                        hasher.update(self._read_range(position, step))
+                        position += step
+                    if hasher.digest() != expected:
+                        raise VerificationError(f"Read-back mismatch in range {offset}-{offset + length}")
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.lag -= length
+                self.verified_bytes += length
+                self.condition.notify_all()
+
+    @property
+    def resumable(self) -> bool:
+        return self.inner.resumable
+
+    @property
+    def cache_avoided(self) -> int:
+        return self.inner.cache_avoided
+
+    def sync(self):
+        self.inner.sync()
+
+    def state(self) -> dict:
+        return self.inner.state()
+
+    def resume(self, state: dict):
+        self.inner.resume(state)
+
+    def read_committed(self):
+        return self.inner.read_committed()
+
+    def write(self, chunks: List) -> int:
+        if self.error:
+            raise self.error
+        offset = self.inner.offset
+        written = self.inner.write(chunks)
+        length = self.inner.offset - offset
+        if length:
+            hasher = new_hasher(self.algorithm)
+            for chunk in chunks:
+                update_hasher(hasher, chunk)
+            with self.condition:
+                while self.lag + length > self.max_lag and self.lag and self.error is None:
+                    self.condition.wait()
+                self.lag += length
+            self.queue.put((offset, length, hasher.digest()))
+        return written
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.fd)
+        self.inner.close()
+        if self.error:
+            raise self.error
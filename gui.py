@@ -1,15 +1,38 @@
 import os
 import subprocess
-from typing import Optional
+import threading
+from typing import List, Optional, Tuple
 
 from PySide6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QComboBox, QPushButton, QLineEdit, \
-    QCheckBox, QSpinBox, QProgressBar, QTextEdit, QGroupBox, QFileDialog, QMessageBox, QScrollArea, QDialog
+    QCheckBox, QSpinBox, QProgressBar, QTextEdit, QGroupBox, QFileDialog, QMessageBox, QScrollArea, QDialog, QTableWidget, \
+    QTableWidgetItem, QHeaderView
 
-from gui_package.dialogs import SudoPasswordDialog, EncryptionPasswordDialog
-from core.models import DriveInfo
+from gui_package.dialogs import SudoPasswordDialog, EncryptionPasswordDialog, DecryptionPasswordDialog
+from core.jobs import DONE, ImagingJob, JobScheduler
+from core.models import DriveInfo, Partition
 from core.system_info import SystemInfoCollector
+from core.utils import format_size
+from dd_core.compression import CODECS
+from dd_core.crypto import CIPHERS, aead_available
+from dd_core.estimate import space_shortfalls
+from dd_core.incremental import BLOCK_MANIFEST_SUFFIX, block_manifest_path
+from dd_core.journal import read_journal
+from dd_core.seekable import seekable_supported
+from dd_core.restore import needs_password, resolve_image
+from dd_core.verify import HASH_ALGORITHMS
 from gui_package.widgets.drive_widget import DriveWidget
-from workers import DDWorkerThread
+from workers import DDWorkerThread, EstimateWorkerThread, RestoreWorkerThread
+
+
+def job_target(target: str, device: str, multiple: bool) -> str:
+    """Image path for one partition; with several partitions target is a directory or a file name prefix"""
+    if not multiple:
+        return target
+    name = device.replace('/', '_')
+    if os.path.isdir(target):
+        return os.path.join(target, f"disk_image_{name}.img")
+    root, ext = os.path.splitext(target)
+    return f"{root}{name}{ext or '.img'}"
 
 
 class DDGUIManager(QMainWindow):
@@ -19,8 +42,16 @@ class DDGUIManager(QMainWindow):
         super().__init__()
         self.version = self.load_version()
         self.drives = []
+        self.drive_widgets = {}
         self.current_drive_widget = None
         self.worker_thread = None
+        self.estimate_worker = None
+        self.scheduler = None
+        self.job_workers = {}
+        self.job_rows = {}
+        self.cpu_budget = None
+        self.sudo_password = None
+        self.encryption_password = None
         self.setupUI()
         self.loadDrives()
         self.showMaximized()
@@ -90,12 +121,29 @@ class DDGUIManager(QMainWindow):
         config_layout.addWidget(browse_btn, 0, 2)
 
         # Options
-        self.compress_check = QCheckBox("Compress image (gzip)")
+        self.compress_check = QCheckBox("Compress image")
         config_layout.addWidget(self.compress_check, 1, 0)
 
         self.encrypt_check = QCheckBox("Encrypt image")
         config_layout.addWidget(self.encrypt_check, 1, 1)
 
+        self.cipher_combo = QComboBox()
+        for cipher_name in CIPHERS:
+            self.cipher_combo.addItem(cipher_name)
+        self.cipher_combo.setEnabled(False)
+        if aead_available():
+            self.encrypt_check.toggled.connect(self.cipher_combo.setEnabled)
+        else:
+            self.cipher_combo.setToolTip("Install the 'cryptography' package for authenticated encryption")
+        config_layout.addWidget(self.cipher_combo, 1, 2)
+
+        self.sparse_check = QCheckBox("Skip zero blocks (sparse image)")
+        self.sparse_check.setChecked(True)
+        config_layout.addWidget(self.sparse_check, 2, 2)
+
+        self.used_only_check = QCheckBox("Used blocks only (ext2/3/4, FAT, NTFS, XFS)")
+        config_layout.addWidget(self.used_only_check, 3, 2)
+
         # Split into fragments
         self.split_check = QCheckBox("Split into fragments")
         config_layout.addWidget(self.split_check, 2, 0)
@@ -108,8 +156,161 @@ class DDGUIManager(QMainWindow):
         self.split_check.toggled.connect(self.split_size.setEnabled)
         config_layout.addWidget(self.split_size, 2, 1)
 
+        # Compression codec and level
+        config_layout.addWidget(QLabel("Compression codec:"), 3, 0)
+        self.codec_combo = QComboBox()
+        for codec_name in CODECS:
+            self.codec_combo.addItem(codec_name)
+        self.codec_combo.setEnabled(False)
+        self.compress_check.toggled.connect(self.codec_combo.setEnabled)
+        config_layout.addWidget(self.codec_combo, 3, 1)
+
+        config_layout.addWidget(QLabel("Compression level:"), 4, 0)
+        self.compress_level = QSpinBox()
+        self.compress_level.setEnabled(False)
+        self.compress_check.toggled.connect(self.compress_level.setEnabled)
+        self.codec_combo.currentTextChanged.connect(self.on_codec_changed)
+        config_layout.addWidget(self.compress_level, 4, 1)
+        self.on_codec_changed(self.codec_combo.currentText())
+
+        # Parallel compression
+        config_layout.addWidget(QLabel("Compression threads:"), 5, 0)
+        self.compress_threads = QSpinBox()
+        self.compress_threads.setRange(1, 256)
+        self.compress_threads.setValue(os.cpu_count() or 1)
+        self.compress_threads.setEnabled(False)
+        self.compress_check.toggled.connect(self.compress_threads.setEnabled)
+        config_layout.addWidget(self.compress_threads, 5, 1)
+
+        config_layout.addWidget(QLabel("Compression chunk size:"), 6, 0)
+        self.compress_chunk_size = QSpinBox()
+        self.compress_chunk_size.setRange(1, 256)
+        self.compress_chunk_size.setValue(4)
+        self.compress_chunk_size.setSuffix(" MB")
+        self.compress_chunk_size.setEnabled(False)
+        self.compress_check.toggled.connect(self.compress_chunk_size.setEnabled)
+        config_layout.addWidget(self.compress_chunk_size, 6, 1)
+
+        self.seekable_check = QCheckBox("Seekable (chunk index for random access)")
+        self.seekable_check.setToolTip("Supported by gzip, zstd and lz4")
+        self.seekable_check.setEnabled(False)
+        self.compress_check.toggled.connect(self.update_seekable_check)
+        self.codec_combo.currentTextChanged.connect(self.update_seekable_check)
+        config_layout.addWidget(self.seekable_check, 7, 0, 1, 2)
+
+        # Deduplicating repository
+        self.repository_check = QCheckBox("Store in deduplicating repository")
+        self.repository_check.toggled.connect(self.on_repository_toggled)
+        config_layout.addWidget(self.repository_check, 8, 0)
+
+        self.repository_edit = QLineEdit()
+        self.repository_edit.setPlaceholderText("Repository directory")
+        self.repository_edit.setEnabled(False)
+        config_layout.addWidget(self.repository_edit, 8, 1)
+
+        self.repository_browse_btn = QPushButton("Browse...")
+        self.repository_browse_btn.clicked.connect(self.browse_repository)
+        self.repository_browse_btn.setEnabled(False)
+        config_layout.addWidget(self.repository_browse_btn, 8, 2)
+
+        # Incremental images against a parent's block hash manifest
+        self.incremental_check = QCheckBox("Incremental since parent image")
+        self.incremental_check.toggled.connect(self.on_incremental_toggled)
+        config_layout.addWidget(self.incremental_check, 9, 0)
+
+        self.parent_edit = QLineEdit()
+        self.parent_edit.setPlaceholderText("Parent image (needs a .blockmap manifest)")
+        self.parent_edit.setEnabled(False)
+        config_layout.addWidget(self.parent_edit, 9, 1)
+
+        self.parent_browse_btn = QPushButton("Browse...")
+        self.parent_browse_btn.clicked.connect(self.browse_parent_image)
+        self.parent_browse_btn.setEnabled(False)
+        config_layout.addWidget(self.parent_browse_btn, 9, 2)
+
+        self.block_manifest_check = QCheckBox("Write block hash manifest")
+        self.block_manifest_check.setToolTip("Lets later images be taken incrementally against this one; "
+                                             "hashing every block rules out copying in the kernel")
+        config_layout.addWidget(self.block_manifest_check, 10, 0, 1, 2)
+
+        self.cache_bypass_check = QCheckBox("Bypass page cache")
+        self.cache_bypass_check.setToolTip("Uses direct I/O so imaging does not evict the host's cached working set")
+        config_layout.addWidget(self.cache_bypass_check, 10, 2)
+
+        # Throttling, adjustable while jobs run
+        config_layout.addWidget(QLabel("Rate limit per job (MB/s, 0 = unlimited):"), 11, 0)
+        self.rate_limit_spin = QSpinBox()
+        self.rate_limit_spin.setRange(0, 100000)
+        self.rate_limit_spin.setValue(0)
+        self.rate_limit_spin.valueChanged.connect(self.on_rate_limit_changed)
+        config_layout.addWidget(self.rate_limit_spin, 11, 1)
+
+        self.adaptive_throttle_check = QCheckBox("Back off when the source disk is busy")
+        self.adaptive_throttle_check.setToolTip("Watches the disk's queue in /sys/block and slows imaging while other I/O waits")
+        config_layout.addWidget(self.adaptive_throttle_check, 11, 2)
+
+        self.rescue_check = QCheckBox("Rescue mode (failing disk, raw image)")
+        self.rescue_check.setToolTip("Skips unreadable areas on the first pass and retries them with smaller blocks, "
+                                     "keeping a map so the rescue can continue later")
+        config_layout.addWidget(self.rescue_check, 12, 0, 1, 2)
+
+        self.estimate_check = QCheckBox("Estimate size and duration first")
+        self.estimate_check.setToolTip("Samples the source and checks the predicted image size against free space")
+        self.estimate_check.setChecked(True)
+        config_layout.addWidget(self.estimate_check, 12, 2)
+
+        self.auto_tune_check = QCheckBox("Auto-tune block size and queue depth")
+        self.auto_tune_check.setToolTip("Benchmarks each source disk once and reuses the best setting for it on later runs")
+        self.auto_tune_check.setChecked(True)
+        config_layout.addWidget(self.auto_tune_check, 13, 0, 1, 2)
+
+        config_layout.addWidget(QLabel("Read queue depth (0 = auto):"), 14, 0)
+        self.queue_depth_spin = QSpinBox()
+        self.queue_depth_spin.setRange(0, 64)
+        self.queue_depth_spin.setValue(0)
+        self.queue_depth_spin.setToolTip("Reads kept in flight at once; NVMe drives need several to reach full speed")
+        config_layout.addWidget(self.queue_depth_spin, 14, 1)
+
+        config_layout.addWidget(QLabel("Pipeline buffer memory (MB, 0 = off):"), 15, 0)
+        self.buffer_memory_spin = QSpinBox()
+        self.buffer_memory_spin.setRange(0, 8192)
+        self.buffer_memory_spin.setValue(256)
+        self.buffer_memory_spin.setToolTip("Reading, compression/encryption and writing overlap within this much memory "
+                                           "per job; a slow stage holds the others back instead of memory growing")
+        config_layout.addWidget(self.buffer_memory_spin, 15, 1)
+
+        # Inline verification
+        self.verify_check = QCheckBox("Verify (inline hash)")
+        config_layout.addWidget(self.verify_check, 4, 2)
+
+        self.hash_combo = QComboBox()
+        for algorithm in HASH_ALGORITHMS:
+            self.hash_combo.addItem(algorithm)
+        self.hash_combo.setEnabled(False)
+        self.verify_check.toggled.connect(self.hash_combo.setEnabled)
+        config_layout.addWidget(self.hash_combo, 5, 2)
+
+        self.readback_check = QCheckBox("Read back target while writing")
+        self.readback_check.setEnabled(False)
+        self.verify_check.toggled.connect(self.readback_check.setEnabled)
+        config_layout.addWidget(self.readback_check, 6, 2)
+
         config_group.setLayout(config_layout)
 
+        # Restore section
+        restore_group = QGroupBox("Restore Image")
+        restore_layout = QHBoxLayout()
+
+        restore_layout.addWidget(QLabel("Image file:"))
+        self.restore_edit = QLineEdit()
+        restore_layout.addWidget(self.restore_edit)
+
+        restore_browse_btn = QPushButton("Browse...")
+        restore_browse_btn.clicked.connect(self.browse_restore_file)
+        restore_layout.addWidget(restore_browse_btn)
+
+        restore_group.setLayout(restore_layout)
+
         # Action buttons
         action_group = QGroupBox("Actions")
         action_layout = QHBoxLayout()
@@ -135,16 +336,51 @@ class DDGUIManager(QMainWindow):
             }
         """)
 
+        self.restore_btn = QPushButton("Restore Image")
+        self.restore_btn.clicked.connect(self.restore_image)
+        self.restore_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2196F3;
+                color: white;
+                border: none;
+                padding: 10px 20px;
+                font-size: 14px;
+                font-weight: bold;
+                border-radius: 5px;
+            }
+            QPushButton:hover {
+                background-color: #1E88E5;
+            }
+            QPushButton:disabled {
+                background-color: #cccccc;
+                color: #666666;
+            }
+        """)
+
         self.cancel_btn = QPushButton("Cancel")
         self.cancel_btn.clicked.connect(self.cancel_operation)
         self.cancel_btn.setEnabled(False)
 
         action_layout.addWidget(self.create_btn)
+        action_layout.addWidget(self.restore_btn)
         action_layout.addWidget(self.cancel_btn)
         action_layout.addStretch()
 
         action_group.setLayout(action_layout)
 
+        # Job queue, one row per partition being imaged
+        self.jobs_group = QGroupBox("Jobs")
+        jobs_layout = QVBoxLayout()
+        self.jobs_table = QTableWidget(0, 4)
+        self.jobs_table.setHorizontalHeaderLabels(["Source", "Target", "Status", "Progress"])
+        self.jobs_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
+        self.jobs_table.verticalHeader().setVisible(False)
+        self.jobs_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.jobs_table.setMaximumHeight(160)
+        jobs_layout.addWidget(self.jobs_table)
+        self.jobs_group.setLayout(jobs_layout)
+        self.jobs_group.setVisible(False)
+
         # Progress bar
         self.progress_bar = QProgressBar()
         self.progress_bar.setVisible(False)
@@ -168,7 +404,9 @@ class DDGUIManager(QMainWindow):
         main_layout.addWidget(drive_group)
         main_layout.addWidget(partitions_group)
         main_layout.addWidget(config_group)
+        main_layout.addWidget(restore_group)
         main_layout.addWidget(action_group)
+        main_layout.addWidget(self.jobs_group)
         main_layout.addWidget(self.progress_bar)
         main_layout.addWidget(self.status_label)
         main_layout.addWidget(log_group)
@@ -198,6 +436,7 @@ class DDGUIManager(QMainWindow):
         """Load drive information"""
         self.log("Getting drive information...")
         self.drives = SystemInfoCollector.get_block_devices()
+        self.drive_widgets = {}
 
         self.drive_combo.clear()
         for drive in self.drives:
@@ -217,21 +456,73 @@ class DDGUIManager(QMainWindow):
 
     def show_drive_partitions(self, drive: DriveInfo):
         """Show partitions of the selected drive"""
-        # Remove previous widgets
-        for i in reversed(range(self.partitions_layout.count())):
-            child = self.partitions_layout.itemAt(i).widget()
+        # Remove previous widgets; drive widgets are kept so selections on other drives survive
+        while self.partitions_layout.count():
+            child = self.partitions_layout.takeAt(0).widget()
             if child:
                 child.setParent(None)
 
-        # Add new drive widget
-        self.current_drive_widget = DriveWidget(drive)
+        if drive.device not in self.drive_widgets:
+            self.drive_widgets[drive.device] = DriveWidget(drive)
+        self.current_drive_widget = self.drive_widgets[drive.device]
         self.partitions_layout.addWidget(self.current_drive_widget)
         self.partitions_layout.addStretch()
 
+    def get_selected_partitions(self) -> List[Tuple[DriveInfo, Partition]]:
+        """Partitions selected on any drive, with their drive"""
+        return [(widget.drive, partition) for widget in self.drive_widgets.values() for partition in widget.get_selected_partitions()]
+
+    def on_codec_changed(self, codec_name):
+        """Adjust level range to the selected codec"""
+        if codec_name not in CODECS:
+            return
+        codec = CODECS[codec_name]
+        self.compress_level.setRange(codec.min_level, codec.max_level)
+        self.compress_level.setValue(codec.default_level)
+
+    def update_seekable_check(self, *args):
+        """Seekable images need compression with a codec that can carry the index"""
+        self.seekable_check.setEnabled(self.compress_check.isChecked() and seekable_supported(self.codec_combo.currentText()))
+
+    def on_repository_toggled(self, checked):
+        """The repository compresses and deduplicates itself; compressed, encrypted or split streams would not deduplicate"""
+        self.repository_edit.setEnabled(checked)
+        self.repository_browse_btn.setEnabled(checked)
+        for check in (self.compress_check, self.encrypt_check, self.split_check, self.sparse_check):
+            if checked:
+                check.setChecked(False)
+            check.setEnabled(not checked)
+
+    def on_incremental_toggled(self, checked):
+        """Incremental images always carry a manifest, so the next one can build on them"""
+        self.parent_edit.setEnabled(checked)
+        self.parent_browse_btn.setEnabled(checked)
+        if checked:
+            self.block_manifest_check.setChecked(True)
+        self.block_manifest_check.setEnabled(not checked)
+
+    def browse_parent_image(self):
+        """Browse for the parent image of an incremental image"""
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select parent image", "", "Block manifests (*.blockmap);;All files (*)")
+        if file_path:
+            self.parent_edit.setText(file_path[:-len(BLOCK_MANIFEST_SUFFIX)] if file_path.endswith(BLOCK_MANIFEST_SUFFIX)
+                                     else file_path)
+
+    def browse_repository(self):
+        """Browse for repository directory"""
+        directory = QFileDialog.getExistingDirectory(self, "Select repository directory")
+        if directory:
+            self.repository_edit.setText(directory)
+
     def browse_target_file(self):
-        """Browse for target file"""
-        selected_partition_list = self.current_drive_widget.get_selected_partitions()
-        selected_partition_name = selected_partition_list[0].device.replace('/', '_')
+        """Browse for target file, or for a directory when several partitions are selected"""
+        selected = self.get_selected_partitions()
+        if len(selected) > 1:
+            directory = QFileDialog.getExistingDirectory(self, "Select directory for the images")
+            if directory:
+                self.target_edit.setText(directory)
+            return
+        selected_partition_name = selected[0][1].device.replace('/', '_') if selected else "disk"
         # old_selected_partition_name =  self.drive_combo.currentText().split()[0].replace('/', '_')
 
         filename, _ = QFileDialog.getSaveFileName(self, "Save image as...", f"disk_image_{selected_partition_name}.img",
@@ -240,6 +531,14 @@ class DDGUIManager(QMainWindow):
         if filename:
             self.target_edit.setText(filename)
 
+    def browse_restore_file(self):
+        """Browse for image file to restore"""
+        filename, _ = QFileDialog.getOpenFileName(self, "Select image to restore", "",
+                                                  "Image files (*.img *.img.* *.manifest.json);;All files (*)")
+
+        if filename:
+            self.restore_edit.setText(filename)
+
     def check_sudo_needed(self, device_path) -> bool:
         """Check if sudo is needed to access device"""
         try:
@@ -260,13 +559,9 @@ class DDGUIManager(QMainWindow):
         return None
 
     def create_image(self):
-        """Create disk/partition image"""
-        if not self.current_drive_widget:
-            self.show_error("No drive selected")
-            return
-
-        selected_partitions = self.current_drive_widget.get_selected_partitions()
-        if not selected_partitions:
+        """Queue one image per selected partition and start the jobs whose disks are idle"""
+        selected = self.get_selected_partitions()
+        if not selected:
             self.show_error("No partitions selected")
             return
 
@@ -275,16 +570,57 @@ class DDGUIManager(QMainWindow):
             self.show_error("No target file specified")
             return
 
-        # Check if target file already exists
-        if os.path.exists(target_file):
-            reply = QMessageBox.question(self, "File exists", f"File {target_file} already exists. Do you want to overwrite it?",
+        repository = None
+        if self.repository_check.isChecked():
+            repository = self.repository_edit.text().strip()
+            if not repository:
+                self.show_error("No repository directory specified")
+                return
+
+        parent_image = None
+        if self.incremental_check.isChecked():
+            if len(selected) > 1:
+                self.show_error("Incremental images can only be taken of one partition at a time")
+                return
+            parent_image = self.parent_edit.text().strip()
+            if not parent_image:
+                self.show_error("No parent image specified")
+                return
+            if not os.path.exists(block_manifest_path(parent_image)):
+                self.show_error(f"Parent image {parent_image} has no block hash manifest")
+                return
+
+        # With several partitions the target names a directory (or a file name prefix) for one image each
+        targets = [job_target(target_file, partition.device, len(selected) > 1) for _, partition in selected]
+
+        # Offer to continue interrupted runs of the same sources into these targets
+        journals = {}
+        for (_, partition), target in zip(selected, targets):
+            journal = read_journal(target)
+            if journal and journal.get('source') == partition.device:
+                journals[target] = journal
+        if journals:
+            details = "\n".join(f"{journal['source']}: stopped at {format_size(journal['checkpoint']['position'])} of "
+                                f"{format_size(journal['source_size'])} (last checkpoint {journal['updated']})"
+                                for journal in journals.values())
+            reply = QMessageBox.question(self, "Resume image",
+                                         f"Interrupted images were found:\n{details}\n\nResume them with their original settings?",
+                                         QMessageBox.Yes | QMessageBox.No)
+            if reply != QMessageBox.Yes:
+                journals = {}
+
+        # Check if target files already exist
+        existing = [target for target in targets if os.path.exists(target) and target not in journals]
+        if existing:
+            reply = QMessageBox.question(self, "File exists", f"{', '.join(existing)} already exist(s). Do you want to overwrite?",
                                          QMessageBox.Yes | QMessageBox.No)
             if reply == QMessageBox.No:
                 return
 
         # Get encryption password if encryption is enabled
         encryption_password = None
-        if self.encrypt_check.isChecked():
+        if any(journal['options']['encrypt'] for journal in journals.values()) or \
+                (self.encrypt_check.isChecked() and len(journals) < len(targets)):
             dialog = EncryptionPasswordDialog(self)
             if dialog.exec() == QDialog.Accepted:
                 encryption_password = dialog.get_password()
@@ -293,13 +629,13 @@ class DDGUIManager(QMainWindow):
                 return
 
         # Check if we need sudo and get password
-        source_device = selected_partitions[0].device
         sudo_password = None
 
         # First try without sudo
         try:
-            with open(source_device, 'rb') as f:
-                f.read(1)
+            for _, partition in selected:
+                with open(partition.device, 'rb') as f:
+                    f.read(1)
         except PermissionError:
             # Need sudo, ask for password
             self.log("Administrator privileges required for accessing block device")
@@ -320,30 +656,262 @@ class DDGUIManager(QMainWindow):
 
         # Prepare options
         options = {'compress': self.compress_check.isChecked(), 'encrypt': self.encrypt_check.isChecked(),
-                   'split': self.split_check.isChecked(), 'split_size': self.split_size.value() if self.split_check.isChecked() else None}
+                   'sparse': self.sparse_check.isChecked(), 'used_only': self.used_only_check.isChecked(),
+                   'verify': self.verify_check.isChecked(), 'hash_algorithm': self.hash_combo.currentText(),
+                   'readback': self.verify_check.isChecked() and self.readback_check.isChecked(),
+                   'split': self.split_check.isChecked(), 'split_size': self.split_size.value() if self.split_check.isChecked() else None,
+                   'encrypt_cipher': self.cipher_combo.currentText(),
+                   'compress_codec': self.codec_combo.currentText(), 'compress_level': self.compress_level.value(),
+                   'seekable': self.seekable_check.isEnabled() and self.seekable_check.isChecked(),
+                   'repository': repository,
+                   'block_manifest': self.block_manifest_check.isChecked(), 'parent_image': parent_image,
+                   'cache_bypass': self.cache_bypass_check.isChecked(),
+                   'rate_limit': self.rate_limit_spin.value(), 'adaptive_throttle': self.adaptive_throttle_check.isChecked(),
+                   'rescue': self.rescue_check.isChecked(), 'auto_tune': self.auto_tune_check.isChecked(),
+                   'queue_depth': self.queue_depth_spin.value(), 'buffer_memory': self.buffer_memory_spin.value(),
+                   'compress_threads': self.compress_threads.value(), 'compress_chunk_size': self.compress_chunk_size.value()}
 
-        self.log(f"Starting image creation {source_device} -> {target_file}")
         if options['encrypt']:
-            self.log("Encryption enabled (AES-256-CBC)")
+            if aead_available():
+                self.log(f"Encryption enabled ({options['encrypt_cipher']}, chunked)")
+            else:
+                self.log("Encryption enabled (AES-256-CBC via openssl, install 'cryptography' for parallel AEAD)")
         if options['compress']:
-            self.log("Compression enabled (gzip)")
+            self.log(f"Compression enabled ({options['compress_codec']} level {options['compress_level']}, "
+                     f"{options['compress_threads']} threads shared by all jobs, {options['compress_chunk_size']} MB chunks)")
+
+        # Jobs on the same physical disk run one after another, jobs on different disks concurrently
+        roots = SystemInfoCollector.get_device_roots()
+        self.scheduler = JobScheduler()
+        for (drive, partition), target in zip(selected, targets):
+            if target in journals:
+                # Settings that do not change the image come from this run
+                job_options = dict(journals[target]['options'], resume=True,
+                                   **{key: options[key] for key in ('cache_bypass', 'rate_limit', 'adaptive_throttle',
+                                                                    'queue_depth', 'buffer_memory')})
+            else:
+                job_options = dict(options, fstype=partition.fstype)
+            devices = frozenset(roots.get(partition.device) or {drive.device})
+            self.scheduler.add(ImagingJob(partition.device, target, partition.size, devices, job_options))
+            if job_options['used_only'] and partition.mountpoint:
+                self.log(f"Warning: {partition.device} is mounted at {partition.mountpoint}, "
+                         "allocation map may change while imaging")
+
+        # Compression and encryption threads of all jobs share one CPU budget
+        self.cpu_budget = threading.BoundedSemaphore(self.compress_threads.value())
+        self.sudo_password = sudo_password
+        self.encryption_password = encryption_password
+        self.show_jobs()
 
-        # Create and start worker thread
-        self.worker_thread = DDWorkerThread(source_device, target_file, options, sudo_password, encryption_password)
+        # Update UI
+        self.create_btn.setEnabled(False)
+        self.restore_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        self.progress_bar.setVisible(True)
+        self.status_label.setVisible(True)
+        self.progress_bar.setValue(0)
+
+        # Resumed jobs keep their settings, so only new images are estimated
+        new_jobs = [job for job in self.scheduler.jobs if not job.options.get('resume')]
+        if self.estimate_check.isChecked() and new_jobs:
+            self.log("Sampling sources to estimate image size and duration...")
+            self.estimate_worker = EstimateWorkerThread(new_jobs, sudo_password)
+            self.estimate_worker.log_message.connect(self.log)
+            self.estimate_worker.estimates_finished.connect(self.on_estimates_finished)
+            self.estimate_worker.start()
+            return
+
+        self.start_ready_jobs()
+
+    def on_estimates_finished(self, estimates):
+        """Show the predicted size and duration and start the jobs once confirmed"""
+        self.estimate_worker.wait()
+        self.estimate_worker = None
+        if self.scheduler is None or self.scheduler.cancelled:
+            self.log("Operation cancelled")
+            self.reset_ui()
+            return
+
+        lines = []
+        for job in self.scheduler.jobs:
+            if job.id in estimates:
+                summary = estimates[job.id][1].summary()
+                self.log(f"[{job.source}] Estimate: {summary}")
+                lines.append(f"{job.source}: {summary}")
+        summary_text = "\n".join(lines)
+        shortfalls = space_shortfalls(list(estimates.values()))
+        if shortfalls:
+            details = "\n".join(f"{directory}: needs ~{format_size(needed)}, {format_size(free)} free"
+                                 for directory, needed, free in shortfalls)
+            reply = QMessageBox.warning(self, "Not enough space",
+                                        f"{summary_text}\n\nThe images are not expected to fit:\n{details}\n\nStart anyway?",
+                                        QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        elif lines:
+            reply = QMessageBox.question(self, "Estimate", f"{summary_text}\n\nStart imaging?",
+                                         QMessageBox.Yes | QMessageBox.No)
+        else:
+            reply = QMessageBox.Yes
+        if reply != QMessageBox.Yes:
+            self.log("Operation cancelled after the estimate")
+            self.scheduler.cancel()
+            for job in self.scheduler.jobs:
+                self.update_job_row(job)
+            self.reset_ui()
+            return
+
+        self.start_ready_jobs()
+
+    def on_rate_limit_changed(self, value: int):
+        """Apply a new rate limit to the running jobs"""
+        for worker in self.job_workers:
+            worker.set_rate_limit(value)
+        if self.job_workers:
+            self.log(f"Rate limit set to {f'{value} MB/s per job' if value else 'unlimited'}")
+
+    def show_jobs(self):
+        """One row per queued job, with its own progress bar"""
+        self.jobs_table.setRowCount(len(self.scheduler.jobs))
+        self.job_rows = {}
+        for row, job in enumerate(self.scheduler.jobs):
+            self.job_rows[job.id] = row
+            self.jobs_table.setItem(row, 0, QTableWidgetItem(job.source))
+            self.jobs_table.setItem(row, 1, QTableWidgetItem(job.target))
+            self.jobs_table.setItem(row, 2, QTableWidgetItem(job.state))
+            self.jobs_table.setCellWidget(row, 3, QProgressBar())
+        self.jobs_group.setVisible(True)
+
+    def update_job_row(self, job, status: Optional[str] = None):
+        row = self.job_rows[job.id]
+        self.jobs_table.item(row, 2).setText(status or (f"{job.state}: {job.message}" if job.message else job.state))
+        self.jobs_table.cellWidget(row, 3).setValue(job.progress)
+
+    def update_overall_progress(self):
+        self.progress_bar.setValue(self.scheduler.overall_progress())
+        done = sum(1 for job in self.scheduler.jobs if job.finished)
+        self.status_label.setText(f"Jobs: {len(self.scheduler.running)} running, {len(self.scheduler.queued)} queued, "
+                                  f"{done} of {len(self.scheduler.jobs)} finished")
+
+    def start_ready_jobs(self):
+        """Start every queued job whose disks are idle"""
+        for job in self.scheduler.start_ready():
+            worker = DDWorkerThread(job.source, job.target, job.options, self.sudo_password, self.encryption_password,
+                                    self.cpu_budget)
+            worker.progress_updated.connect(self.on_job_progress)
+            worker.operation_finished.connect(self.on_job_finished)
+            worker.log_message.connect(self.on_job_log)
+            worker.set_rate_limit(self.rate_limit_spin.value())
+            self.job_workers[worker] = job
+            self.update_job_row(job)
+            self.log(f"{'Resuming' if job.options.get('resume') else 'Starting'} image creation {job.source} -> {job.target}")
+            worker.start()
+        self.update_overall_progress()
+
+    def on_job_progress(self, progress, status):
+        job = self.job_workers.get(self.sender())
+        if job:
+            job.progress = progress
+            self.update_job_row(job, status)
+            self.update_overall_progress()
+
+    def on_job_log(self, message):
+        job = self.job_workers.get(self.sender())
+        self.log(f"[{job.source}] {message}" if job else message)
+
+    def on_job_finished(self, success, message):
+        worker = self.sender()
+        job = self.job_workers.pop(worker, None)
+        if job is None:
+            return
+        worker.wait()
+        self.scheduler.finish(job, success, message)
+        self.log(f"[{job.source}] {message}")
+        self.update_job_row(job)
+        self.start_ready_jobs()
+        if not self.scheduler.finished:
+            return
+
+        jobs = self.scheduler.jobs
+        failed = [job for job in jobs if job.state != DONE]
+        if len(jobs) == 1:
+            summary = jobs[0].message
+        else:
+            summary = f"{len(jobs) - len(failed)} of {len(jobs)} images created successfully"
+            if failed:
+                summary += "\n" + "\n".join(f"{job.source}: {job.state}{f' - {job.message}' if job.message else ''}" for job in failed)
+        if failed:
+            self.show_error(summary)
+        else:
+            self.show_info(summary)
+            self.progress_bar.setValue(100)
+        self.reset_ui()
+
+    def restore_image(self):
+        """Restore an image onto the selected partition"""
+        selected_partitions = [partition for _, partition in self.get_selected_partitions()]
+        if len(selected_partitions) != 1:
+            self.show_error("Select exactly one target partition")
+            return
+
+        image_file = self.restore_edit.text().strip()
+        if not image_file:
+            self.show_error("No image file specified")
+            return
+        image_file = resolve_image(image_file)
+
+        target_device = selected_partitions[0].device
+        if selected_partitions[0].mountpoint:
+            self.show_error(f"{target_device} is mounted at {selected_partitions[0].mountpoint}. Unmount it first.")
+            return
+
+        reply = QMessageBox.warning(self, "Overwrite partition",
+                                    f"All data on {target_device} will be overwritten with {os.path.basename(image_file)}. Continue?",
+                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+
+        try:
+            encrypted = needs_password(image_file)
+        except Exception as e:
+            self.show_error(f"Cannot read image: {str(e)}")
+            return
+
+        decryption_password = None
+        if encrypted:
+            dialog = DecryptionPasswordDialog(self)
+            if dialog.exec() == QDialog.Accepted:
+                decryption_password = dialog.get_password()
+            else:
+                self.log("Operation cancelled - no image password provided")
+                return
+
+        # Check if we need sudo to write the partition
+        sudo_password = None
+        if not os.access(target_device, os.W_OK):
+            self.log("Administrator privileges required for writing block device")
+            sudo_password = self.get_sudo_password()
+            if sudo_password is None:
+                self.log("Operation cancelled - no password provided")
+                return
+            test_cmd = f"echo '{sudo_password}' | sudo -S -v 2>/dev/null"
+            if subprocess.run(test_cmd, shell=True).returncode != 0:
+                self.show_error("Invalid administrator password")
+                return
+
+        self.log(f"Starting restore {image_file} -> {target_device}")
+
+        self.worker_thread = RestoreWorkerThread(image_file, target_device, sudo_password, decryption_password)
 
-        # Connect signals
         self.worker_thread.progress_updated.connect(self.on_progress_updated)
         self.worker_thread.operation_finished.connect(self.on_operation_finished)
         self.worker_thread.log_message.connect(self.log)
 
-        # Update UI
         self.create_btn.setEnabled(False)
+        self.restore_btn.setEnabled(False)
         self.cancel_btn.setEnabled(True)
         self.progress_bar.setVisible(True)
         self.status_label.setVisible(True)
         self.progress_bar.setValue(0)
 
-        # Start the thread
         self.worker_thread.start()
 
     def on_progress_updated(self, progress, status):
@@ -365,6 +933,19 @@ class DDGUIManager(QMainWindow):
 
     def cancel_operation(self):
         """Cancel operation"""
+        if self.scheduler and not self.scheduler.finished:
+            # Running jobs stop at their next block and report back through on_job_finished
+            self.log("Cancelling all jobs...")
+            self.scheduler.cancel()
+            if self.estimate_worker:
+                self.estimate_worker.cancel()
+            for worker in self.job_workers:
+                worker.cancel()
+            for job in self.scheduler.jobs:
+                self.update_job_row(job)
+            self.cancel_btn.setEnabled(False)
+            return
+
         if self.worker_thread and self.worker_thread.isRunning():
             self.log("Cancelling operation...")
             self.worker_thread.cancel()
@@ -379,10 +960,15 @@ class DDGUIManager(QMainWindow):
     def reset_ui(self):
         """Reset UI after operation"""
         self.create_btn.setEnabled(True)
+        self.restore_btn.setEnabled(True)
         self.cancel_btn.setEnabled(False)
         self.progress_bar.setVisible(False)
         self.status_label.setVisible(False)
         self.worker_thread = None
+        self.scheduler = None
+        self.cpu_budget = None
+        self.sudo_password = None
+        self.encryption_password = None
 
     def log(self, message):
         """Add message to log"""
@@ -404,16 +990,20 @@ class DDGUIManager(QMainWindow):
 
     def closeEvent(self, event):
         """Handle window close event"""
-        if self.worker_thread and self.worker_thread.isRunning():
+        workers = [worker for worker in [self.worker_thread, self.estimate_worker, *self.job_workers]
+                   if worker and worker.isRunning()]
+        if workers:
             reply = QMessageBox.question(self, "Operation in progress", "An operation is in progress. Do you want to cancel it and exit?",
                                          QMessageBox.Yes | QMessageBox.No)
             if reply == QMessageBox.Yes:
-                self.worker_thread.cancel()
-                self.worker_thread.wait(5000)  # Wait up to 5 seconds
-
-                if self.worker_thread.isRunning():
-                    self.worker_thread.terminate()
-                    self.worker_thread.wait()
+                for worker in workers:
+                    worker.cancel()
+                for worker in workers:
+                    worker.wait(5000)  # Wait up to 5 seconds
+
+                    if worker.isRunning():
+                        worker.terminate()
+                        worker.wait()
 
                 event.accept()
             else:
@@ -99,3 +99,35 @@ class EncryptionPasswordDialog(QDialog):
 
     def get_password(self):
         return self.password_edit.text()
+
+
+class DecryptionPasswordDialog(QDialog):
+    """Dialog for entering the password of an encrypted image"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Image Password")
+        self.setModal(True)
+        self.setFixedSize(400, 150)
+
+        layout = QVBoxLayout()
+
+        info_label = QLabel("This image is encrypted.\nPlease enter its password:")
+        layout.addWidget(info_label)
+
+        self.password_edit = QLineEdit()
+        self.password_edit.setEchoMode(QLineEdit.Password)
+        self.password_edit.setPlaceholderText("Enter image password")
+        layout.addWidget(self.password_edit)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+        self.setLayout(layout)
+
+        self.password_edit.setFocus()
+
+    def get_password(self):
+        return self.password_edit.text()
@@ -14,7 +14,6 @@ class DriveWidget(QWidget):
         super().__init__(parent)
         self.drive = drive
         self.partition_widgets = []
-        self.selected_partition_widget = None
         self.setupUI()
 
     def setupUI(self):
@@ -57,24 +56,16 @@ class DriveWidget(QWidget):
         self.setLayout(layout)
 
     def on_partition_clicked(self, partition_widget):
-        """Handle partition click - allow only single selection"""
-        if self.selected_partition_widget == partition_widget:
-            self.selected_partition_widget.selected = False
-            self.selected_partition_widget.updateStyle()
-            self.selected_partition_widget = None
-        else:
-            # Odznacz poprzednio wybraną partycję
-            if self.selected_partition_widget:
-                self.selected_partition_widget.selected = False
-                self.selected_partition_widget.updateStyle()
+        """Handle partition click - toggle selection, several partitions can be queued at once"""
+        partition_widget.selected = not partition_widget.selected
+        partition_widget.updateStyle()
 
-            # Zaznacz nową partycję
-            partition_widget.selected = True
-            partition_widget.updateStyle()
-            self.selected_partition_widget = partition_widget
+    def clear_selection(self):
+        for partition_widget in self.partition_widgets:
+            if partition_widget.selected:
+                partition_widget.selected = False
+                partition_widget.updateStyle()
 
     def get_selected_partitions(self) -> List[Partition]:
-        """Returns list of selected partitions (max 1)"""
-        if self.selected_partition_widget:
-            return [self.selected_partition_widget.partition]
-        return []
+        """Returns list of selected partitions in disk order"""
+        return [widget.partition for widget in self.partition_widgets if widget.selected]
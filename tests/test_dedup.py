@@ -0,0 +1,20 @@
+import os
+
+from dd_core.dedup import DedupSink
+from dd_core.engine import CopyEngine, DeviceSource
+
+SIZE = 4 * 1024 * 1024
+
+
+def test_bytes_written_counts_the_stream_accepted(tmp_path):
+    source_path = str(tmp_path / "source.bin")
+    with open(source_path, "wb") as f:
+        f.write(os.urandom(SIZE // 2) + bytes(SIZE // 2))
+    repository = str(tmp_path / "repository")
+    with DeviceSource(source_path) as source:
+        for name in ("first.recipe", "second.recipe"):
+            with DedupSink(repository, str(tmp_path / name)) as sink:
+                stats = CopyEngine(source, sink).run()
+            assert stats.bytes_written == sink.total == SIZE
+    # The second copy found every chunk in the repository already
+    assert sink.new_bytes == 0
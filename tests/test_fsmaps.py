@@ -0,0 +1,54 @@
+import struct
+
+from dd_core.fsmaps import ntfs_used_extents
+
+CLUSTER_SIZE = 4096
+CLUSTER_COUNT = 64
+MFT_LCN = 4
+BITMAP_LCN = 10
+RECORD_SIZE = 1024
+
+
+def ntfs_4kn_volume(used_clusters):
+    """Minimal NTFS volume with 4096-byte sectors: a boot sector, the $Bitmap MFT record and the bitmap"""
+    volume = bytearray(CLUSTER_COUNT * CLUSTER_SIZE)
+    volume[3:11] = b"NTFS    "
+    struct.pack_into("<HB", volume, 11, CLUSTER_SIZE, 1)
+    struct.pack_into("<QQ", volume, 0x28, CLUSTER_COUNT, MFT_LCN)
+    struct.pack_into("<b", volume, 0x40, -10)  # 1 KiB records
+
+    record = bytearray(RECORD_SIZE)
+    record[:4] = b"FILE"
+    struct.pack_into("<HH", record, 4, 0x30, RECORD_SIZE // 512 + 1)
+    struct.pack_into("<H", record, 0x14, 0x38)
+    # Non-resident $DATA with a single run of one cluster at BITMAP_LCN
+    struct.pack_into("<II", record, 0x38, 0x80, 0x48)
+    record[0x38 + 8] = 1
+    struct.pack_into("<H", record, 0x38 + 0x20, 0x40)
+    record[0x78:0x7B] = bytes([0x11, 1, BITMAP_LCN])
+    struct.pack_into("<I", record, 0x80, 0xFFFFFFFF)
+    # Update sequence: the last two bytes of every 512 carry the sequence number, the originals live in the array
+    usn = b"\x07\x00"
+    record[0x30:0x32] = usn
+    for i in range(1, RECORD_SIZE // 512 + 1):
+        end = i * 512
+        record[0x30 + i * 2:0x32 + i * 2] = record[end - 2:end]
+        record[end - 2:end] = usn
+    offset = MFT_LCN * CLUSTER_SIZE + 6 * RECORD_SIZE
+    volume[offset:offset + RECORD_SIZE] = record
+
+    bitmap = bytearray(CLUSTER_COUNT // 8)
+    for cluster in used_clusters:
+        bitmap[cluster // 8] |= 1 << (cluster % 8)
+    volume[BITMAP_LCN * CLUSTER_SIZE:BITMAP_LCN * CLUSTER_SIZE + len(bitmap)] = bitmap
+    return bytes(volume)
+
+
+def test_ntfs_fixups_use_512_byte_stride_on_4kn_volumes():
+    used = set(range(16)) | {40, 41}
+    volume = ntfs_4kn_volume(used)
+    extents = ntfs_used_extents(lambda offset, length: volume[offset:offset + length], len(volume))
+    covered = set()
+    for offset, length in extents:
+        covered.update(range(offset // CLUSTER_SIZE, -(-(offset + length) // CLUSTER_SIZE)))
+    assert covered == used
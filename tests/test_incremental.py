@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from dd_core.engine import CopyEngine, DeviceSource, FileSink
+from dd_core.incremental import parent_reference
+from dd_core.pipeline import build_stages, header_path, output_path, write_extent_map, write_header
+from dd_core.restore import restore_image
+from dd_core.verify import VerificationError
+
+SIZE = 8 * 1024 * 1024
+
+
+def make_image(source_path, base, parent=None):
+    options = {'verify': True, 'block_manifest': True, 'parent_image': parent}
+    stages = build_stages(options, source_size=SIZE)
+    image = output_path(base, stages)
+    with DeviceSource(source_path) as source, FileSink(image) as sink:
+        CopyEngine(source, sink, stages).run()
+    block_stage = next(stage for stage in stages if stage.kind == "blockmap")
+    block_stage.manifest(SIZE).write(image)
+    extra = None
+    if parent:
+        write_extent_map(image, block_stage.changed_extents(SIZE))
+        extra = {'incremental': True, 'parent': parent_reference(image, parent)}
+    write_header(image, source_path, SIZE, 4 * 1024 * 1024, stages, extra)
+    return image, next(stage for stage in stages if stage.kind == "hash")
+
+
+@pytest.fixture
+def chain(tmp_path):
+    first = bytearray(os.urandom(SIZE))
+    first_path = str(tmp_path / "first.bin")
+    with open(first_path, "wb") as f:
+        f.write(first)
+    parent, _ = make_image(first_path, str(tmp_path / "full"))
+
+    second = bytearray(first)
+    second[3 * 1024 * 1024:3 * 1024 * 1024 + 5000] = os.urandom(5000)
+    second_path = str(tmp_path / "second.bin")
+    with open(second_path, "wb") as f:
+        f.write(second)
+    image, hash_stage = make_image(second_path, str(tmp_path / "incremental"), parent)
+    return bytes(second), image, hash_stage
+
+
+def test_incremental_image_records_the_source_digest(chain):
+    source, image, hash_stage = chain
+    expected = hashlib.sha256(source).hexdigest()
+    assert hash_stage.hexdigest() == expected
+    with open(header_path(image)) as f:
+        header = json.load(f)
+    assert next(stage for stage in header["stages"] if stage["kind"] == "hash")["digest"] == expected
+
+
+def test_restore_checks_the_digest_after_the_parent_chain(chain, tmp_path):
+    source, image, _ = chain
+    target = str(tmp_path / "target.bin")
+    restore_image(image, target)
+    with open(target, "rb") as f:
+        assert f.read() == source
+
+    with open(header_path(image)) as f:
+        header = json.load(f)
+    for stage in header["stages"]:
+        if stage["kind"] == "hash":
+            stage["digest"] = hashlib.sha256(b"something else").hexdigest()
+    with open(header_path(image), "w") as f:
+        json.dump(header, f)
+    with pytest.raises(VerificationError):
+        restore_image(image, target)
@@ -0,0 +1,92 @@
+import os
+
+from dd_core.engine import DeviceSource, FileSink
+from dd_core.rescue import BAD, GOOD, SKIPPED, UNTRIED, FaultySource, RescueCopier, RescueMap, rescue_map_path
+
+SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = 256 * 1024
+BAD_RANGES = [(1024 * 1024 + 4096, 1024), (3 * 1024 * 1024, 64 * 1024)]
+
+
+class RecordingSource(FaultySource):
+    """FaultySource remembering the ranges it was asked to read"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    def readinto(self, buffer, offset):
+        self.requests.append((offset, len(buffer)))
+        return super().readinto(buffer, offset)
+
+
+def make_source(tmp_path):
+    path = str(tmp_path / "source.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(SIZE))
+    return path
+
+
+def rescue(source_path, image, bad, rescue_map=None, retries=0):
+    map_path = rescue_map_path(image)
+    rescue_map = rescue_map or RescueMap(SIZE, source_path)
+    source = RecordingSource(DeviceSource(source_path), bad=bad)
+    with source, FileSink(image, truncate=rescue_map.totals()[GOOD] == 0) as sink:
+        copier = RescueCopier(source, sink, rescue_map, map_path, block_size=BLOCK_SIZE, retries=retries)
+        copier.run()
+    return copier, source
+
+
+def test_bad_sectors_are_mapped_and_zero_filled(tmp_path):
+    source_path = make_source(tmp_path)
+    image = str(tmp_path / "image.raw")
+    copier, _ = rescue(source_path, image, BAD_RANGES)
+
+    assert copier.map.ranges(BAD) == BAD_RANGES
+    totals = copier.map.totals()
+    assert totals[GOOD] == SIZE - sum(length for _, length in BAD_RANGES)
+    assert totals[UNTRIED] == totals[SKIPPED] == 0
+    # The first pass skipped whole blocks, the retry passes narrowed them down to the bad sectors
+    assert copier.passes == 1 + len(copier.retry_sizes())
+
+    with open(source_path, "rb") as f:
+        expected = bytearray(f.read())
+    for offset, length in BAD_RANGES:
+        expected[offset:offset + length] = bytes(length)
+    with open(image, "rb") as f:
+        assert f.read() == bytes(expected)
+
+
+def test_first_pass_skips_ahead_after_consecutive_errors(tmp_path):
+    source_path = make_source(tmp_path)
+    image = str(tmp_path / "image.raw")
+    bad = [(BLOCK_SIZE, 8 * BLOCK_SIZE)]
+    rescue_map = RescueMap(SIZE, source_path)
+    source = RecordingSource(DeviceSource(source_path), bad=bad)
+    with source, FileSink(image) as sink:
+        copier = RescueCopier(source, sink, rescue_map, rescue_map_path(image), block_size=BLOCK_SIZE)
+        copier._copy_pass()
+
+    # Skips of one, two and four blocks after the failures, instead of trying every block of the bad area
+    assert source.failures == 3
+    assert rescue_map.ranges(SKIPPED) == [(BLOCK_SIZE, 10 * BLOCK_SIZE)]
+    assert rescue_map.totals()[GOOD] == SIZE - 10 * BLOCK_SIZE
+
+
+def test_second_run_only_retries_bad_ranges(tmp_path):
+    source_path = make_source(tmp_path)
+    image = str(tmp_path / "image.raw")
+    rescue(source_path, image, BAD_RANGES)
+
+    saved = RescueMap.load(rescue_map_path(image), SIZE, source_path)
+    assert saved is not None and saved.ranges(BAD) == BAD_RANGES
+
+    # The sectors have become readable in the meantime
+    copier, source = rescue(source_path, image, [], rescue_map=saved, retries=1)
+    assert source.requests
+    for offset, length in source.requests:
+        assert any(start <= offset and offset + length <= start + size for start, size in BAD_RANGES)
+    assert copier.map.totals()[GOOD] == SIZE
+
+    with open(source_path, "rb") as f, open(image, "rb") as g:
+        assert f.read() == g.read()
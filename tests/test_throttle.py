@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+from dd_core.engine import CopyEngine, DeviceSource, Sink
+from dd_core.throttle import AdaptiveRateLimiter
+from dd_core.verify import HashStage
+
+BLOCK_SIZE = 64 * 1024
+
+
+def write_stat(path, in_flight, io_ticks, time_in_queue):
+    fields = [0] * 11
+    fields[8], fields[9], fields[10] = in_flight, int(io_ticks), int(time_in_queue)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(" ".join(str(field) for field in fields) + "\n")
+    os.replace(temporary, path)
+
+
+class SimulatedDisk(DeviceSource):
+    """File read like a disk whose stat counters only ever see our own reads"""
+
+    def __init__(self, path, stat_path, latency=0.002):
+        super().__init__(path)
+        self.stat_path = stat_path
+        self.latency = latency
+        self.counters = threading.Lock()
+        self.outstanding = 0
+        self.io_ticks = 0.0
+        self.time_in_queue = 0.0
+        self.stamp = time.monotonic()
+        self._account(0)
+
+    def _account(self, change):
+        with self.counters:
+            now = time.monotonic()
+            elapsed_ms = (now - self.stamp) * 1000
+            if self.outstanding:
+                self.io_ticks += elapsed_ms
+            self.time_in_queue += self.outstanding * elapsed_ms
+            self.stamp = now
+            self.outstanding += change
+            write_stat(self.stat_path, self.outstanding, self.io_ticks, self.time_in_queue)
+
+    def readinto(self, buffer, offset):
+        self._account(1)
+        try:
+            time.sleep(self.latency)
+            return super().readinto(buffer, offset)
+        finally:
+            self._account(-1)
+
+
+class NullSink(Sink):
+    def write(self, chunks):
+        return sum(len(chunk) for chunk in chunks)
+
+
+def make_source(tmp_path, size=8 * 1024 * 1024):
+    path = str(tmp_path / "source.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def adaptive_limiter(tmp_path, stat_path):
+    limiter = AdaptiveRateLimiter(str(tmp_path), interval=0.01)
+    limiter.stat_path = stat_path
+    return limiter
+
+
+def run_interval(limiter, stat_path, depth, disk_in_flight):
+    """Two acquire() calls an interval apart, by a reader keeping depth - 1 reads outstanding at each"""
+    write_stat(stat_path, disk_in_flight, 0, 0)
+    started = time.monotonic()
+    limiter.acquire(BLOCK_SIZE, None, depth - 1, depth)
+    time.sleep(0.05)
+    elapsed_ms = (time.monotonic() - started) * 1000
+    # Busy all the time, with depth requests queued on average
+    write_stat(stat_path, disk_in_flight, elapsed_ms, depth * elapsed_ms)
+    limiter.acquire(BLOCK_SIZE, None, depth - 1, depth)
+
+
+def test_own_reads_at_depth_do_not_back_off(tmp_path):
+    stat_path = str(tmp_path / "stat")
+    limiter = adaptive_limiter(tmp_path, stat_path)
+    depth = 8
+    run_interval(limiter, stat_path, depth, depth - 1)
+    assert limiter.backoffs == 0
+
+
+def test_foreign_requests_still_back_off(tmp_path):
+    stat_path = str(tmp_path / "stat")
+    limiter = adaptive_limiter(tmp_path, stat_path)
+    depth = 8
+    run_interval(limiter, stat_path, depth, depth - 1 + 5)
+    assert limiter.backoffs == 1
+
+
+def test_parallel_reader_on_idle_disk_keeps_its_rate(tmp_path):
+    path = make_source(tmp_path)
+    stat_path = str(tmp_path / "stat")
+    limiter = adaptive_limiter(tmp_path, stat_path)
+    with SimulatedDisk(path, stat_path) as source:
+        engine = CopyEngine(source, NullSink(), [HashStage("sha256")], block_size=BLOCK_SIZE, queue_depth=8,
+                            throttle=limiter)
+        stats = engine.run()
+    assert stats.bytes_read == os.path.getsize(path)
+    assert limiter.sample is not None
+    assert limiter.backoffs == 0
+
+
+def test_pipelined_read_stage_on_idle_disk_keeps_its_rate(tmp_path):
+    path = make_source(tmp_path)
+    stat_path = str(tmp_path / "stat")
+    limiter = adaptive_limiter(tmp_path, stat_path)
+    with SimulatedDisk(path, stat_path) as source:
+        engine = CopyEngine(source, NullSink(), [HashStage("sha256")], block_size=BLOCK_SIZE, queue_depth=8,
+                            throttle=limiter, buffer_memory=32 * BLOCK_SIZE)
+        stats = engine.run()
+    assert engine.pool is not None
+    assert stats.bytes_read == os.path.getsize(path)
+    assert limiter.sample is not None
+    assert limiter.backoffs == 0
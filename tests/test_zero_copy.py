@@ -0,0 +1,37 @@
+import os
+
+from dd_core.engine import CopyEngine, DeviceSource, FileSink
+from dd_core.verify import HashStage
+
+SIZE = 4 * 1024 * 1024
+
+
+def copy(tmp_path, stages=(), cache_bypass=False):
+    source_path = str(tmp_path / "source.bin")
+    with open(source_path, "wb") as f:
+        f.write(os.urandom(SIZE))
+    target = str(tmp_path / "target.bin")
+    with DeviceSource(source_path) as source, FileSink(target) as sink:
+        engine = CopyEngine(source, sink, list(stages), cache_bypass=cache_bypass)
+        stats = engine.run()
+    with open(source_path, "rb") as f, open(target, "rb") as g:
+        assert f.read() == g.read()
+    return engine, stats
+
+
+def test_plain_copy_is_done_in_the_kernel(tmp_path):
+    engine, stats = copy(tmp_path)
+    assert stats.kernel_copied == SIZE
+    assert engine.zero_copy_skipped is None
+
+
+def test_stages_say_why_zero_copy_was_skipped(tmp_path):
+    engine, stats = copy(tmp_path, [HashStage("sha256")])
+    assert stats.kernel_copied == 0
+    assert engine.zero_copy_skipped == "stage hash needs the data in user space"
+
+
+def test_cache_bypass_says_why_zero_copy_was_skipped(tmp_path):
+    engine, stats = copy(tmp_path, cache_bypass=True)
+    assert stats.kernel_copied == 0
+    assert engine.zero_copy_skipped == "the page cache is bypassed"
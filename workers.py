@@ -1,9 +1,29 @@
-import re
+import os
 import subprocess
-import time
 
 from PySide6.QtCore import QThread, Signal
 
+from dd_core.engine import CopyEngine, CopyCancelled, FileSink, open_source, DEFAULT_BLOCK_SIZE
+from dd_core.estimate import estimate_image
+from dd_core.fsmaps import FilesystemMapError, used_extents
+from dd_core.incremental import intersect_extents, parent_reference
+from dd_core.journal import CheckpointJournal
+from core.utils import format_size
+from dd_core.crypto import aead_available
+from dd_core.progress import ProgressTracker
+from dd_core.dedup import DedupSink, recipe_path
+from dd_core.pipeline import build_stages, output_path, records_source_digest, write_extent_map, write_header
+from dd_core.restore import open_image, restore_image, restore_plan
+from dd_core.splitter import SplitFileSink, manifest_path
+from dd_core.rescue import BAD, GOOD, RescueCopier, RescueMap, rescue_map_path
+from dd_core.throttle import AdaptiveRateLimiter, RateLimiter
+from dd_core.tuning import tuned_settings
+from dd_core.verify import HashingSink, ReadBackSink, VerificationError
+
+
+# What holds a pipelined copy back, by EngineStats.bottleneck
+BOTTLENECKS = {"read": "source reads", "stages": "compression/encryption/hashing", "write": "target writes"}
+
 
 class DDWorkerThread(QThread):
     """Worker thread for DD operations"""
@@ -12,16 +32,29 @@ class DDWorkerThread(QThread):
     operation_finished = Signal(bool, str)  # success, message
     log_message = Signal(str)
 
-    def __init__(self, source_device, target_file, options, sudo_password=None, encryption_password=None):
+    def __init__(self, source_device, target_file, options, sudo_password=None, encryption_password=None, cpu_budget=None):
         super().__init__()
         self.source_device = source_device
         self.target_file = target_file
         self.options = options
         self.sudo_password = sudo_password
         self.encryption_password = encryption_password  # Dodaj hasło szyfrowania
+        self.cpu_budget = cpu_budget  # shared with concurrently running jobs
         self.should_cancel = False
-        self.process = None
         self.source_size = 0
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.queue_depth = 1
+        self.progress = None
+        self.zero_stage = None
+        self.split_sink = None
+        self.dedup_sink = None
+        self.image_hash = None
+        self.journal = None
+        rate = (options.get('rate_limit') or 0) * 1024 * 1024
+        if options.get('adaptive_throttle', False):
+            self.throttle = AdaptiveRateLimiter(source_device, rate)
+        else:
+            self.throttle = RateLimiter(rate)
 
     def run(self):
         """Main worker thread function"""
@@ -34,8 +67,15 @@ class DDWorkerThread(QThread):
 
             self.log_message.emit(f"Source device size: {self.source_size / (1024 ** 3):.2f} GB")
 
-            # Build and execute command
-            self.execute_dd_command()
+            # Build pipeline and copy
+            if self.options.get('rescue', False):
+                self.execute_rescue()
+            else:
+                if self.options.get('auto_tune', True):
+                    self.tune()
+                if self.options.get('queue_depth'):
+                    self.queue_depth = self.options['queue_depth']
+                self.execute_copy()
 
         except Exception as e:
             self.operation_finished.emit(False, f"Error: {str(e)}")
@@ -63,141 +103,384 @@ class DDWorkerThread(QThread):
 
         return 0
 
-    def execute_dd_command(self):
-        """Execute the DD command with optional compression and encryption"""
+    def tune(self):
+        """Block size and queue depth for the source disk, benchmarked on first use and cached per device"""
         try:
-            # Sprawdź czy openssl jest dostępny dla szyfrowania
-            if self.options.get('encrypt', False):
+            tuning = tuned_settings(self.source_device,
+                                    lambda: open_source(self.source_device, self.sudo_password, direct=True))
+        except OSError as e:
+            self.log_message.emit(f"Auto-tuning skipped ({e}), using {format_size(self.block_size)} blocks")
+            return
+        self.block_size = tuning.block_size
+        self.queue_depth = tuning.queue_depth
+        if tuning.cached:
+            origin = "cached for this device"
+        elif tuning.throughput:
+            origin = f"measured {format_size(tuning.throughput)}/s"
+        else:
+            origin = "defaults, the device has no sysfs entry"
+        self.log_message.emit(f"Auto-tuned: {format_size(self.block_size)} blocks, queue depth {self.queue_depth} ({origin})")
+
+    def execute_copy(self):
+        """Copy the source device into the target file with the in-process engine"""
+        try:
+            # Sprawdź czy openssl jest dostępny dla szyfrowania (tylko bez pakietu cryptography)
+            if self.options.get('encrypt', False) and not aead_available():
                 try:
                     subprocess.run(['openssl', 'version'], capture_output=True, check=True)
                 except (subprocess.CalledProcessError, FileNotFoundError):
                     self.operation_finished.emit(False, "OpenSSL not found. Please install OpenSSL for encryption support.")
                     return
 
-            # Buduj komendę w zależności od opcji
-            cmd_parts = []
-
-            # Część DD
-            if self.sudo_password:
-                dd_cmd = f"echo '{self.sudo_password}' | sudo -S dd if={self.source_device} bs=1M status=progress"
+            # Zbuduj potok etapów (kompresja przed szyfrowaniem) i określ rozszerzenie pliku wyjściowego
+            stages = build_stages(self.options, self.encryption_password, self.source_size, self.cpu_budget)
+            if self.options.get('repository'):
+                output_file = recipe_path(self.target_file)
             else:
-                dd_cmd = f"dd if={self.source_device} bs=1M status=progress"
-
-            cmd_parts.append(dd_cmd)
+                output_file = output_path(self.target_file, stages)
+            self.zero_stage = next((stage for stage in stages if stage.kind == "zero"), None)
+            block_stage = next((stage for stage in stages if stage.kind == "blockmap"), None)
+
+            pipeline = " -> ".join([self.source_device] + [stage.name for stage in stages] + [output_file])
+            self.log_message.emit(f"Pipeline: {pipeline}")
+
+            resume = self.options.get('resume', False)
+            cache_bypass = self.options.get('cache_bypass', False)
+            try:
+                with open_source(self.source_device, self.sudo_password, direct=cache_bypass) as source, \
+                        self.create_sink(output_file, truncate=not resume) as sink:
+                    extents = self.get_used_extents(source)
+                    engine = CopyEngine(source, sink, stages, block_size=self.block_size, size=self.source_size,
+                                        progress_callback=self.on_engine_progress, cancel_check=lambda: self.should_cancel,
+                                        extents=extents, cache_bypass=cache_bypass, throttle=self.throttle,
+                                        queue_depth=self.queue_depth,
+                                        buffer_memory=self.options.get('buffer_memory', 0) * 1024 * 1024 or None)
+                    self.journal = self.create_journal(engine, output_file, extents)
+                    self.progress = ProgressTracker(self.source_size, done=engine.resume_state["position"] if resume else 0)
+                    stats = engine.run()
+            finally:
+                for stage in stages:
+                    stage.close()
+            if self.journal:
+                self.journal.remove()
+
+            header_extra = None
+            if extents is not None:
+                header_extra = {'used_only': True, 'used_bytes': sum(length for _, length in extents)}
+            if block_stage:
+                block_stage.manifest(self.source_size).write(output_file)
+            if block_stage and block_stage.parent is not None:
+                # Incremental image: restore writes only the changed blocks over the parent
+                changed = block_stage.changed_extents(self.source_size)
+                extents = intersect_extents(changed, extents) if extents is not None else changed
+                header_extra = dict(header_extra or {}, incremental=True,
+                                    parent=parent_reference(output_file, self.options['parent_image']))
+            if extents is not None:
+                write_extent_map(output_file, extents)
+            if self.image_hash:
+                header_extra = dict(header_extra or {}, image_hash={'algorithm': self.image_hash.algorithm,
+                                                                   'digest': self.image_hash.hexdigest()})
+            store_sink = self.split_sink or self.dedup_sink
+            header_stages = stages + [store_sink] if store_sink else stages
+            write_header(output_file, self.source_device, self.source_size, self.block_size, header_stages, header_extra)
+            if self.split_sink:
+                self.log_message.emit(f"Image split into {len(self.split_sink.fragments)} fragments, "
+                                      f"manifest: {manifest_path(output_file)}")
+            if self.dedup_sink:
+                self.log_message.emit(f"Repository {self.options['repository']}: {self.dedup_sink.new_chunks} of "
+                                      f"{self.dedup_sink.chunk_count} chunks new, {format_size(self.dedup_sink.new_bytes)} new data "
+                                      f"stored as {format_size(self.dedup_sink.stored_bytes)}")
+
+            hash_stage = next((stage for stage in stages if stage.kind == "hash"), None)
+            if hash_stage:
+                self.log_message.emit(f"Source {hash_stage.algorithm}: {hash_stage.hexdigest()}")
+                self.log_message.emit(f"Image {self.image_hash.algorithm}: {self.image_hash.hexdigest()}")
+            if self.options.get('readback', False) and not (self.split_sink or self.dedup_sink):
+                self.log_message.emit("Read-back verification passed")
+
+            self.log_message.emit(f"Copied {stats.bytes_read} bytes, wrote {stats.bytes_written} bytes "
+                                  f"in {stats.elapsed:.1f} s ({stats.throughput / (1024 ** 2):.1f} MB/s)")
+            if stats.kernel_copied:
+                self.log_message.emit(f"Copied in the kernel: {format_size(stats.kernel_copied)}")
+            if engine.zero_copy_skipped:
+                self.log_message.emit(f"Zero-copy not used: {engine.zero_copy_skipped}")
+            if stats.queue_depth > 1:
+                self.log_message.emit(f"Read queue depth {stats.queue_depth}, {stats.in_flight:.1f} reads in flight on average")
+            if engine.pool is not None:
+                self.log_message.emit(f"Buffer pool: {engine.pool.count} x {format_size(engine.pool.block_size)}, "
+                                      f"waited for a free buffer {engine.pool.waits} times")
+                self.log_message.emit(f"Average queue fill: {self.queue_summary(stats)} - "
+                                      f"bottleneck: {BOTTLENECKS[stats.bottleneck]}")
+            if self.zero_stage:
+                self.log_message.emit(f"Zero and unallocated blocks skipped: {format_size(self.zero_stage.skipped_bytes)}")
+            if isinstance(self.throttle, AdaptiveRateLimiter) and self.throttle.backoffs:
+                self.log_message.emit(f"Backed off {self.throttle.backoffs} times while the source disk was busy")
+            if cache_bypass:
+                self.log_message.emit(f"Page cache avoided: {format_size(source.cache_avoided + sink.cache_avoided)}")
+            if block_stage and block_stage.parent is not None:
+                self.log_message.emit(f"Incremental since {self.options['parent_image']}: "
+                                      f"{format_size(block_stage.changed_bytes)} changed")
+            self.progress_updated.emit(100, "Operation completed successfully!")
+
+            # Dodaj informacje o szyfrowania i kompresji w komunikacie
+            features = []
+            if self.options.get('encrypt', False):
+                features.append("encrypted")
+            if self.options.get('compress', False):
+                features.append("compressed")
+            if self.options.get('compress', False) and self.options.get('seekable', False):
+                features.append("seekable")
+            if self.options.get('sparse', False):
+                features.append("sparse")
+            if self.options.get('split', False):
+                features.append("split")
+            if self.options.get('repository'):
+                features.append("deduplicated")
+            if self.options.get('resume', False):
+                features.append("resumed")
+            if self.options.get('parent_image'):
+                features.append("incremental")
+            if self.options.get('verify', False):
+                features.append("verified")
+
+            if features:
+                message = f"Image created successfully! ({', '.join(features)})"
+            else:
+                message = "Image created successfully!"
 
-            # Opcjonalne szyfrowanie
-            if self.options.get('encrypt', False) and self.encryption_password:
-                # Używamy AES-256-CBC z PBKDF2
-                encrypt_cmd = f"openssl enc -aes-256-cbc -pbkdf2 -iter 100000 -pass pass:'{self.encryption_password}'"
-                cmd_parts.append(encrypt_cmd)
+            self.operation_finished.emit(True, message)
 
-            # Opcjonalna kompresja
-            if self.options.get('compress', False):
-                cmd_parts.append("gzip -c")
+        except CopyCancelled:
+            message = "Operation cancelled by user"
+            if self.journal and os.path.exists(self.journal.path):
+                message += " - the image can be resumed from its last checkpoint"
+            self.operation_finished.emit(False, message)
+        except Exception as e:
+            self.operation_finished.emit(False, f"Error executing copy: {str(e)}")
+
+    def execute_rescue(self):
+        """Copy a failing source into a raw image, skipping bad areas first and retrying them later"""
+        output_file = self.target_file
+        map_path = rescue_map_path(output_file)
+        rescue_map = RescueMap.load(map_path, self.source_size, self.source_device)
+        if rescue_map is not None and os.path.exists(output_file):
+            totals = rescue_map.totals()
+            self.log_message.emit(f"Continuing rescue from {map_path}: {format_size(totals[GOOD])} rescued, "
+                                  f"{format_size(totals[BAD])} bad")
+        else:
+            rescue_map = RescueMap(self.source_size, self.source_device)
+        self.log_message.emit("Rescue mode: raw image, pipeline options are not applied")
+        self.progress = ProgressTracker(self.source_size)
+        try:
+            # Direct reads keep readahead from dragging neighbouring bad sectors into every request
+            with open_source(self.source_device, self.sudo_password, direct=True) as source, \
+                    FileSink(output_file, truncate=rescue_map.totals()[GOOD] == 0) as sink:
+                copier = RescueCopier(source, sink, rescue_map, map_path, block_size=self.block_size,
+                                      progress_callback=self.on_engine_progress, cancel_check=lambda: self.should_cancel)
+                stats = copier.run()
+        except CopyCancelled:
+            self.operation_finished.emit(False, f"Operation cancelled by user - the rescue continues from {map_path}")
+            return
+
+        totals = rescue_map.totals()
+        write_header(output_file, self.source_device, self.source_size, self.block_size, [],
+                     {'rescue': {'good_bytes': totals[GOOD], 'bad_bytes': totals[BAD], 'map': os.path.basename(map_path)}})
+        self.log_message.emit(f"Rescued {format_size(totals[GOOD])} of {format_size(self.source_size)} in "
+                              f"{copier.passes} passes ({stats.elapsed:.1f} s), {format_size(totals[BAD])} unreadable")
+        for offset, length in rescue_map.ranges(BAD)[:20]:
+            self.log_message.emit(f"Unreadable: {offset}-{offset + length - 1}")
+        self.progress_updated.emit(100, "Operation completed successfully!")
+        if totals[BAD]:
+            self.operation_finished.emit(True, f"Image rescued with {format_size(totals[BAD])} unreadable "
+                                               f"(zeros in the image, see {map_path})")
+        else:
+            self.operation_finished.emit(True, "Image rescued completely!")
+
+    def create_journal(self, engine, output_file, extents):
+        """Checkpoint journal for resumable pipelines; loads the checkpoint when resuming"""
+        journal = CheckpointJournal(self.target_file, output_file, self.source_device, self.source_size, self.options, extents)
+        if self.options.get('resume', False):
+            engine.resume(journal.load())
+            position = engine.resume_state["position"]
+            self.log_message.emit(f"Resuming at {format_size(position)} of {format_size(self.source_size)}")
+            if any(stage.replay for stage in engine.stages) or self.image_hash:
+                self.log_message.emit("Re-hashing the part imaged before the interruption")
+        elif not engine.resumable:
+            self.log_message.emit("This pipeline cannot be resumed, no checkpoint journal is written")
+            journal.remove()
+            return None
+        else:
+            # A journal from an earlier run would describe a different partial image
+            journal.remove()
+        engine.checkpoint_callback = journal.write
+        return journal
+
+    def create_sink(self, output_file, truncate=True):
+        """Repository recipe, rotating fragments or a single image file, optionally hashed and read back"""
+        self.split_sink = None
+        self.dedup_sink = None
+        if self.options.get('repository'):
+            sink = self.dedup_sink = DedupSink(self.options['repository'], output_file,
+                                               threads=self.options.get('compress_threads'))
+        elif self.options.get('split', False) and self.options.get('split_size'):
+            sink = self.split_sink = SplitFileSink(output_file, self.options['split_size'] * 1024 * 1024)
+        else:
+            sink = FileSink(output_file, truncate=truncate, direct=self.options.get('cache_bypass', False))
+            if self.options.get('readback', False):
+                sink = ReadBackSink(sink)
+
+        if self.options.get('verify', False):
+            sink = self.image_hash = HashingSink(sink, self.options.get('hash_algorithm', 'sha256'))
+        return sink
+
+    def get_used_extents(self, source):
+        """Allocated extents for used-blocks-only mode, or None to copy everything"""
+        if not self.options.get('used_only', False):
+            return None
+        try:
+            extents = used_extents(source.read, self.source_size, self.options.get('fstype'))
+        except FilesystemMapError as e:
+            self.log_message.emit(f"Used blocks only: {str(e)}, imaging all blocks")
+            return None
+
+        if extents is None:
+            self.log_message.emit(f"Used blocks only: filesystem '{self.options.get('fstype', '')}' not supported, imaging all blocks")
+            return None
+
+        used = sum(length for _, length in extents)
+        self.log_message.emit(f"Used blocks only: {format_size(used)} in {len(extents)} extents")
+        return extents
+
+    def on_engine_progress(self, stats):
+        """Translate engine byte counters into throttled progress signals"""
+        report = self.progress.update(stats.position)
+        if report is None:
+            return
+
+        status = report.status()
+        if self.zero_stage and self.zero_stage.skipped_bytes:
+            status += f" - Skipped: {format_size(self.zero_stage.skipped_bytes)}"
+        if stats.queue_depth > 1:
+            status += f" - QD {stats.queue_depth} ({stats.in_flight:.1f} in flight)"
+        if stats.queue_fill:
+            status += f" - Queues: {self.queue_summary(stats)}"
+        if stats.cache_avoided:
+            status += f" - Cache avoided: {format_size(stats.cache_avoided)}"
+        if self.throttle.rate:
+            status += f" - Limited to {format_size(self.throttle.rate)}/s"
+        self.progress_updated.emit(report.percent, status)
+
+    @staticmethod
+    def queue_summary(stats):
+        return ", ".join(f"{name} {fill * 100:.0f}%" for name, fill in stats.queue_fill.items())
+
+    def set_rate_limit(self, mb_per_second):
+        """Change the bandwidth cap while running (0 = unlimited); called from the GUI thread"""
+        self.throttle.set_limit(mb_per_second * 1024 * 1024 or None)
 
-            # Określ rozszerzenie pliku wyjściowego
-            output_file = self.target_file
-            if self.options.get('encrypt', False):
-                output_file += ".enc"
-            if self.options.get('compress', False):
-                output_file += ".gz"
+    def cancel(self):
+        """Cancel the operation"""
+        self.should_cancel = True
 
-            # Przekierowanie do pliku
-            cmd_parts.append(f"> {output_file}")
 
-            # Połącz wszystkie części
-            full_cmd = " 2>&1 | ".join(cmd_parts[:-1]) + f" {cmd_parts[-1]}"
+class EstimateWorkerThread(QThread):
+    """Worker thread sampling the sources of queued jobs to predict image size and duration"""
 
-            # Ukryj hasła w logach
-            log_cmd = full_cmd
-            if self.sudo_password:
-                log_cmd = log_cmd.replace(self.sudo_password, "***")
-            if self.encryption_password:
-                log_cmd = log_cmd.replace(self.encryption_password, "***")
+    log_message = Signal(str)
+    estimates_finished = Signal(object)  # {job id: (path whose filesystem holds the image, ImageEstimate)}
 
-            self.log_message.emit(f"Executing: {log_cmd}")
+    def __init__(self, jobs, sudo_password=None):
+        super().__init__()
+        self.jobs = jobs
+        self.sudo_password = sudo_password
+        self.should_cancel = False
 
-            # Uruchom proces
-            self.process = subprocess.Popen(full_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
-                                            universal_newlines=True)
+    def run(self):
+        estimates = {}
+        for job in self.jobs:
+            if self.should_cancel:
+                break
+            try:
+                with open_source(job.source, self.sudo_password, direct=True) as source:
+                    extents = None
+                    if job.options.get('used_only', False):
+                        try:
+                            extents = used_extents(source.read, source.size, job.options.get('fstype'))
+                        except FilesystemMapError:
+                            extents = None
+                    # A repository stores the data next to its chunks, not at the target path
+                    space_path = os.path.join(job.options['repository'], "chunks") if job.options.get('repository') \
+                        else job.target
+                    estimates[job.id] = (space_path, estimate_image(source, job.options, space_path, extents,
+                                                                    cancel_check=lambda: self.should_cancel))
+            except CopyCancelled:
+                break
+            except Exception as e:
+                self.log_message.emit(f"Could not estimate {job.source}: {str(e)}")
+        self.estimates_finished.emit(estimates)
 
-            # Monitoruj postęp
-            self.monitor_progress()
+    def cancel(self):
+        self.should_cancel = True
 
-        except Exception as e:
-            self.operation_finished.emit(False, f"Error executing command: {str(e)}")
 
-    def monitor_progress(self):
-        """Monitor DD progress"""
-        try:
-            while self.process and self.process.poll() is None:
-                if self.should_cancel:
-                    if self.process:
-                        self.process.terminate()
-                        time.sleep(1)
-                        if self.process.poll() is None:
-                            self.process.kill()
-                    self.operation_finished.emit(False, "Operation cancelled by user")
-                    return
+class RestoreWorkerThread(QThread):
+    """Worker thread streaming an image back onto a partition"""
 
-                # Try to read output
-                if self.process.stdout:
-                    line = self.process.stdout.readline()
-                    if line:
-                        self.parse_dd_output(line.strip())
-
-                time.sleep(0.1)
-
-            # Process finished
-            if self.process:
-                returncode = self.process.returncode
-                if returncode == 0:
-                    self.progress_updated.emit(100, "Operation completed successfully!")
-
-                    # Dodaj informacje o szyfrowania i kompresji w komunikacie
-                    features = []
-                    if self.options.get('encrypt', False):
-                        features.append("encrypted")
-                    if self.options.get('compress', False):
-                        features.append("compressed")
-
-                    if features:
-                        message = f"Image created successfully! ({', '.join(features)})"
-                    else:
-                        message = "Image created successfully!"
-
-                    self.operation_finished.emit(True, message)
-                else:
-                    self.operation_finished.emit(False, f"Operation failed with return code: {returncode}")
+    progress_updated = Signal(int, str)  # progress percentage, status text
+    operation_finished = Signal(bool, str)  # success, message
+    log_message = Signal(str)
 
-        except Exception as e:
-            self.operation_finished.emit(False, f"Error monitoring progress: {str(e)}")
+    def __init__(self, image_file, target_device, sudo_password=None, decryption_password=None):
+        super().__init__()
+        self.image_file = image_file
+        self.target_device = target_device
+        self.sudo_password = sudo_password
+        self.decryption_password = decryption_password
+        self.should_cancel = False
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.progress = None
+        self.restored_size = 0
 
-    def parse_dd_output(self, line):
-        """Parse DD output for progress information"""
+    def run(self):
+        """Main worker thread function"""
         try:
-            # Look for progress lines like: "1234567890 bytes (1.2 GB) copied, 10 s, 123 MB/s"
-            if "bytes" in line and "copied" in line:
-                # Extract bytes copied
-                match = re.search(r'(\d+) bytes', line)
-                if match:
-                    bytes_copied = int(match.group(1))
-                    if self.source_size > 0:
-                        progress = min(100, int((bytes_copied / self.source_size) * 100))
-
-                        # Extract speed if available
-                        speed_match = re.search(r'(\d+(?:\.\d+)?)\s*([KMG]?B/s)', line)
-                        if speed_match:
-                            speed = speed_match.group(1)
-                            unit = speed_match.group(2)
-                            status = f"Progress: {progress}% - Speed: {speed} {unit}"
-                        else:
-                            status = f"Progress: {progress}%"
-
-                        self.progress_updated.emit(progress, status)
-
+            steps, header = restore_plan(self.image_file)
+            # Without a header the restored size is unknown, so progress follows the image instead
+            self.restored_size = header.get('source_size', 0) if header else 0
+            if self.restored_size:
+                self.progress = ProgressTracker(self.restored_size)
+            else:
+                with open_image(self.image_file) as image:
+                    self.progress = ProgressTracker(image.size)
+
+            layers = " -> ".join([self.image_file] + [step['name'] for step in steps] + [self.target_device])
+            self.log_message.emit(f"Restore pipeline: {layers}")
+            if self.restored_size:
+                self.log_message.emit(f"Restored size: {self.restored_size / (1024 ** 3):.2f} GB")
+
+            stats = restore_image(self.image_file, self.target_device, password=self.decryption_password,
+                                  sudo_password=self.sudo_password, block_size=self.block_size,
+                                  progress_callback=self.on_engine_progress, cancel_check=lambda: self.should_cancel)
+
+            self.log_message.emit(f"Read {stats.bytes_read} bytes, wrote {stats.bytes_written} bytes "
+                                  f"in {stats.elapsed:.1f} s ({stats.throughput / (1024 ** 2):.1f} MB/s)")
+            if header and records_source_digest(header):
+                self.log_message.emit("Restored data matches the source digest")
+            self.progress_updated.emit(100, "Operation completed successfully!")
+            self.operation_finished.emit(True, f"Image restored successfully to {self.target_device}!")
+
+        except CopyCancelled:
+            self.operation_finished.emit(False, "Operation cancelled by user")
+        except VerificationError as e:
+            self.operation_finished.emit(False, f"Verification failed: {str(e)}")
         except Exception as e:
-            self.log_message.emit(f"Error parsing output: {str(e)}")
+            self.operation_finished.emit(False, f"Error restoring image: {str(e)}")
+
+    def on_engine_progress(self, stats):
+        """Translate restore byte counters into throttled progress signals"""
+        report = self.progress.update(stats.position if self.restored_size else stats.bytes_read)
+        if report is not None:
+            self.progress_updated.emit(report.percent, report.status())
 
     def cancel(self):
         """Cancel the operation"""